@@ -1,3 +1,38 @@
+from importlib import import_module
+
 from .utils import run, pipe, Pipe, guess_sample_name
-from .aws import am_i_an_ec2_instance, s3_put, s3_exists, s3_list, s3_list_samples, s3_open, mount_instance_storage, s3_get, boto3_client
+from .stats import save_stats, load_stats, compact_stats, merge_stats
 from .version import __version__
+
+
+
+# The aws helpers pull in boto3, botocore and requests which take longer to
+# import than most console scripts take to run, they are therefore only
+# imported on first access.
+_LAZY = {"am_i_an_ec2_instance": ".aws",
+         "s3_put": ".aws",
+         "s3_exists": ".aws",
+         "s3_list": ".aws",
+         "s3_list_samples": ".aws",
+         "s3_open": ".aws",
+         "mount_instance_storage": ".aws",
+         "s3_get": ".aws",
+         "boto3_client": ".aws"}
+
+__all__ = ["run", "pipe", "Pipe", "guess_sample_name", "save_stats", "load_stats", "compact_stats", "merge_stats", "__version__"] + list(_LAZY)
+
+
+
+def __getattr__(name):
+    try:
+        module = _LAZY[name]
+    except KeyError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
+    value = getattr(import_module(module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY))
@@ -8,10 +8,8 @@ import math
 import glob
 from collections import defaultdict
 from itertools import chain
-from scipy.stats import fisher_exact
 
 from pipeline import run, pipe
-from covermi import Panel, appris
 
 BIOTYPE = defaultdict(int, (("protein_coding", 1), ("pseudogene", -1)))
 IMPACT = {"HIGH": 3, "MODERATE": 2, "LOW": 1, "MODIFIER": 0}
@@ -160,6 +158,7 @@ def annotate_panel(vcf, vep, reference=None, threads=None, output="", panel="",
     needed_genes = set()
     needed_transcripts = set()
     if panel:
+        from covermi import Panel, appris
         panel = Panel(panel)
         if "targets" in panel:
             targets = panel.targets
@@ -200,6 +199,7 @@ def annotate_panel(vcf, vep, reference=None, threads=None, output="", panel="",
                     "canonical" in cons,
                     -int(transcript.translate(DELETE_NON_DIGIT))]
     
+    from scipy.stats import fisher_exact
     annotations = []
     with open(vepjson) as f:
         for line in f:
@@ -4,16 +4,18 @@ import pdb
 import re
 import csv
 import io
+import gzip
 import argparse
 import pdb
 from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import requests
 
 
-from boto3 import client
 from botocore.credentials import InstanceMetadataFetcher
 
 from .utils import run
+from .transfer import client, upload_file, download_file, MB, MAX_CONCURRENCY
 
 
 
@@ -27,9 +29,20 @@ __all__ = ["am_i_an_ec2_instance",
            "mount_instance_storage"]
 
 
+# s3_open fetches READAHEAD bytes per ranged get and uploads writes in parts of
+# PART_SIZE bytes (which must be at least the s3 minimum of 5MB).
+READAHEAD = 8 * MB
+PART_SIZE = 16 * MB
+BUFFER_SIZE = 1 * MB
+
+# Instance metadata service, overridable in the same way as for botocore.
+METADATA_URL = "{}/latest".format(os.environ.get("AWS_EC2_METADATA_SERVICE_ENDPOINT",
+                                                 "http://169.254.169.254").rstrip("/"))
+
+
 
 def aws_region():
-    BASE_URL = "http://169.254.169.254/latest"
+    BASE_URL = METADATA_URL
     metadata = {}
     session = requests.Session()
     try:
@@ -50,7 +63,10 @@ def aws_region():
 
 
 def spot_interuption():
-    BASE_URL = "http://169.254.169.254/latest"
+    """ Return the pending spot instance action, eg {"action": "terminate",
+        "time": "2017-09-18T08:22:00Z"}, or an empty dict if there is none.
+    """
+    BASE_URL = METADATA_URL
     metadata = {}
     session = requests.Session()
     try:
@@ -87,16 +103,14 @@ def s3_get(bucket, key, filename="", prefix=""):
     if prefix:
         prefix = prefix.rstrip("/")
         filename = f"{prefix}/{filename}"
-    s3 = client("s3")
-    s3.download_file(bucket, key, filename)
+    download_file(bucket, key, filename)
 
 
 
 def s3_put(bucket, filename, prefix=""):
-    s3 = client("s3")
     basename = os.path.basename(filename)
     print("Uploading {} to S3.".format(basename))
-    s3.upload_file(filename, bucket, "{}/{}".format(prefix.rstrip("/"), basename) if prefix else basename)
+    upload_file(filename, bucket, "{}/{}".format(prefix.rstrip("/"), basename) if prefix else basename)
 
 
 
@@ -107,9 +121,14 @@ def s3_exists(bucket, prefix):
 
 
 
-def s3_list(bucket, prefix, extension=""):
+def s3_list(bucket, prefix, extension="", threads=1):
     """ Returns a dict of all objects in bucket that have the specified prefix and extension.
+        If threads > 1 then the listing is partitioned by the next level of
+        "directories" below prefix which are listed in parallel.
     """
+    if threads > 1:
+        return _s3_list_partitioned(bucket, prefix, extension, threads)
+    
     s3 = client("s3")
     response = {}
     kwargs = {}
@@ -124,6 +143,28 @@ def s3_list(bucket, prefix, extension=""):
 
 
 
+def _s3_list_partitioned(bucket, prefix, extension, threads):
+    s3 = client("s3")
+    response = {}
+    kwargs = {}
+    keys = {}
+    partitions = []
+    while response.get("IsTruncated", True):
+        response = s3.list_objects_v2(Bucket=bucket, Prefix=prefix, Delimiter="/", **kwargs)
+        for content in response.get("Contents", ()):
+            if content["Key"].endswith(extension):
+                keys[content["Key"]] = content
+        partitions += [common["Prefix"] for common in response.get("CommonPrefixes", ())]
+        kwargs = {"ContinuationToken": response.get("NextContinuationToken", None)}
+    
+    if partitions:
+        with ThreadPoolExecutor(max_workers=min(threads, len(partitions))) as executor:
+            for partition in executor.map(lambda partition: s3_list(bucket, partition, extension), partitions):
+                keys.update(partition)
+    return keys
+
+
+
 def s3_list_samples(bucket, project):
     samples = set()
     for key in s3_list(bucket, "projects/{}".format(project)):
@@ -134,31 +175,207 @@ def s3_list_samples(bucket, project):
 
 
 
-class s3_open(object):
-    def __init__(self, bucket, key, mode="rt"):
-        if mode not in ("rt", "rb", "wt", "wb"):
-            raise ValueError("Invalid mode {}".format(repr(mode)))
+class S3Reader(io.RawIOBase):
+    """ Read only, seekable file like object that streams an s3 object via
+        ranged gets of readahead bytes. The range following the one being
+        read is fetched in a background thread so that network transfer
+        overlaps with processing of the data.
+    """
+    def __init__(self, bucket, key, readahead=None):
         self.s3 = client("s3")
         self.bucket = bucket
         self.key = key
+        self.readahead = readahead or READAHEAD
+        self.size = self.s3.head_object(Bucket=bucket, Key=key)["ContentLength"]
+        self.pos = 0
+        self.chunk = b""
+        self.chunk_start = 0
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.prefetch = None
+        self.prefetch_start = None
+    
+    def _get(self, start):
+        stop = min(start + self.readahead, self.size) - 1
+        response = self.s3.get_object(Bucket=self.bucket, Key=self.key, Range=f"bytes={start}-{stop}")
+        return start, response["Body"].read()
+    
+    def _fill(self):
+        if self.prefetch is not None and self.prefetch_start == self.pos:
+            self.chunk_start, self.chunk = self.prefetch.result()
+        else:
+            # Following a seek any prefetched range is simply discarded.
+            self.chunk_start, self.chunk = self._get(self.pos)
+        self.prefetch = None
+        next_start = self.chunk_start + len(self.chunk)
+        if next_start < self.size:
+            self.prefetch = self.executor.submit(self._get, next_start)
+            self.prefetch_start = next_start
+    
+    def readable(self):
+        return True
+    
+    def seekable(self):
+        return True
+    
+    def readinto(self, b):
+        if self.pos >= self.size:
+            return 0
+        offset = self.pos - self.chunk_start
+        if not 0 <= offset < len(self.chunk):
+            self._fill()
+            offset = 0
+        n = min(len(b), len(self.chunk) - offset)
+        b[:n] = self.chunk[offset:offset + n]
+        self.pos += n
+        return n
+    
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        elif whence == io.SEEK_END:
+            self.pos = self.size + offset
+        else:
+            raise ValueError("Invalid whence {}".format(repr(whence)))
+        if self.pos < 0:
+            raise ValueError("Negative seek position {}".format(self.pos))
+        return self.pos
+    
+    def tell(self):
+        return self.pos
+    
+    def close(self):
+        if not self.closed:
+            self.executor.shutdown(wait=True)
+            self.chunk = b""
+        super().close()
+
+
+
+class S3Writer(io.RawIOBase):
+    """ Write only file like object that streams to an s3 object. Data is
+        buffered until part_size bytes are available and then sent as one
+        part of a multipart upload, up to MAX_CONCURRENCY parts being
+        uploaded at once. Objects smaller than a single part are uploaded
+        with a single put. If abort() is called, or the object is closed
+        while handling an exception, the multipart upload is abandoned and
+        no object is created.
+    """
+    def __init__(self, bucket, key, part_size=None):
+        self.s3 = client("s3")
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size or PART_SIZE
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.executor = None
+        self.aborted = False
+    
+    def writable(self):
+        return True
+    
+    def _upload_part(self, part_number, data):
+        response = self.s3.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                       PartNumber=part_number, Body=data)
+        return {"PartNumber": part_number, "ETag": response["ETag"]}
+    
+    def _flush_part(self):
+        if self.upload_id is None:
+            self.upload_id = self.s3.create_multipart_upload(Bucket=self.bucket, Key=self.key)["UploadId"]
+            self.executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY)
+        # Limit the number of parts held in memory awaiting upload.
+        pending = [part for part in self.parts if not part.done()]
+        if len(pending) >= MAX_CONCURRENCY:
+            wait(pending, return_when=FIRST_COMPLETED)
+        data = bytes(self.buffer[:self.part_size])
+        del self.buffer[:self.part_size]
+        self.parts.append(self.executor.submit(self._upload_part, len(self.parts) + 1, data))
+    
+    def write(self, b):
+        if self.aborted:
+            return len(b)
+        self.buffer += b
+        while len(self.buffer) >= self.part_size:
+            self._flush_part()
+        return len(b)
+    
+    def abort(self):
+        """ Discard anything written so far and any further writes.
+        """
+        self.aborted = True
+        self.buffer = bytearray()
+    
+    def _abort_upload(self):
+        if self.upload_id is not None:
+            self.executor.shutdown(wait=True)
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            self.upload_id = None
+    
+    def close(self):
+        if self.closed:
+            return
+        if self.aborted:
+            self._abort_upload()
+            super().close()
+            return
+        try:
+            if self.upload_id is None:
+                self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))
+            else:
+                if self.buffer:
+                    self._flush_part()
+                parts = [part.result() for part in self.parts]
+                self.s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                  MultipartUpload={"Parts": parts})
+                self.executor.shutdown(wait=True)
+                self.upload_id = None
+        except Exception:
+            self._abort_upload()
+            super().close()
+            raise
+        self.buffer = bytearray()
+        super().close()
+
+
+
+class s3_open(object):
+    """ Open an s3 object as a streaming file. Reads are fetched in ranges as
+        they are needed and are seekable, writes are uploaded in parts as
+        the data is written, therefore memory use is independent of the
+        size of the object. Objects with keys ending in .gz (which includes
+        bgzip compressed files) are transparently decompressed on reading
+        and compressed on writing unless decompress is False.
+    """
+    def __init__(self, bucket, key, mode="rt", decompress=None):
+        if mode not in ("rt", "rb", "wt", "wb"):
+            raise ValueError("Invalid mode {}".format(repr(mode)))
+        if decompress is None:
+            decompress = key.endswith(".gz")
         self.mode = mode
-        self.f_bytes = io.BytesIO()
+        
         if mode.startswith("r"):
-            self.s3.download_fileobj(bucket, key, self.f_bytes)
-            self.f_bytes.seek(0)
-        self.f = io.TextIOWrapper(self.f_bytes) if mode.endswith("t") else self.f_bytes
+            self.raw = S3Reader(bucket, key)
+            self.buffered = io.BufferedReader(self.raw, buffer_size=BUFFER_SIZE)
+        else:
+            self.raw = S3Writer(bucket, key)
+            self.buffered = io.BufferedWriter(self.raw, buffer_size=BUFFER_SIZE)
+        f_bytes = gzip.GzipFile(fileobj=self.buffered, mode=mode[0] + "b") if decompress else self.buffered
+        self.f = io.TextIOWrapper(f_bytes) if mode.endswith("t") else f_bytes
     
-    def close(self):
-        if self.mode.startswith("w"):
-            self.f_bytes.seek(0)
-            self.s3.upload_fileobj(self.f_bytes, self.bucket, self.key)
+    def close(self, abort=False):
+        if abort and self.mode.startswith("w"):
+            self.raw.abort()
+        # GzipFile does not close the file object that it wraps.
         self.f.close()
-            
+        self.buffered.close()
+    
     def __enter__(self):
         return self.f
     
     def __exit__(self, exc_type, exc_value, exc_traceback):
-        self.close()
+        self.close(abort=exc_type is not None)
 
 
 
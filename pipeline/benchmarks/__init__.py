@@ -0,0 +1 @@
+from .generate import Simulation, write_bed, write_vcf
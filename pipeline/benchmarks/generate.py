@@ -0,0 +1,252 @@
+import random
+from bisect import bisect_right
+from itertools import accumulate
+
+
+
+__all__ = ["Simulation", "write_bed", "write_vcf"]
+
+
+READ1 = 0x40
+READ2 = 0x80
+PAIRED = 0x1 | 0x2
+RC = 0x10
+MATE_RC = 0x20
+SUPPLEMENTARY = 0x800
+
+BASES = "ACGT"
+CALLERS = ("varscan", "mutect2", "vardict")
+
+
+
+class Simulation(object):
+    """ Deterministic generator of synthetic paired end reads aligned to a
+        random reference. Every unique molecule is a fragment whose size is
+        drawn from a normal distribution, sequenced from both ends and then
+        duplicated into a family of identical reads sharing a umi, with a
+        small number of sequencing errors in each copy. A proportion of
+        fragments are split reads with a supplementary alignment on another
+        contig and a proportion are discordant pairs with each segment on a
+        different contig. The same seed always produces identical output.
+    """
+    def __init__(self,
+                 fragments=10000,
+                 contigs=3,
+                 contig_length=200000,
+                 read_length=100,
+                 fragment_size=167,
+                 fragment_size_sd=40,
+                 mean_family_size=2.0,
+                 umi_length=6,
+                 supplementary_rate=0.02,
+                 discordant_rate=0.01,
+                 error_rate=0.001,
+                 seed=42):
+        self.fragments = fragments
+        self.read_length = read_length
+        self.fragment_size = fragment_size
+        self.fragment_size_sd = fragment_size_sd
+        self.mean_family_size = mean_family_size
+        self.umi_length = umi_length
+        self.supplementary_rate = supplementary_rate
+        self.discordant_rate = discordant_rate
+        self.error_rate = error_rate
+        self.seed = seed
+
+        rng = random.Random(seed)
+        self.contigs = {f"chr{i + 1}": "".join(rng.choices(BASES, k=contig_length)) for i in range(contigs)}
+        self.names = list(self.contigs)
+        self.cumulative_lengths = list(accumulate(len(seq) for seq in self.contigs.values()))
+
+    def header(self):
+        lines = ["@HD\tVN:1.6\tSO:unsorted\n"]
+        for name, seq in self.contigs.items():
+            lines.append(f"@SQ\tSN:{name}\tLN:{len(seq)}\n")
+        return "".join(lines)
+
+    def _locus(self, rng, size):
+        i = bisect_right(self.cumulative_lengths, rng.randrange(self.cumulative_lengths[-1]))
+        contig = self.names[i]
+        return contig, rng.randrange(1, len(self.contigs[contig]) - size)
+
+    def _mutate(self, rng, seq):
+        if rng.random() > self.error_rate * len(seq):
+            return seq
+        i = rng.randrange(len(seq))
+        return seq[:i] + rng.choice(BASES.replace(seq[i], "")) + seq[i + 1:]
+
+    def _segment(self, qname, flag, contig, pos, cigar, mate_contig, mate_pos, tlen, seq, umi, extra=()):
+        rnext = "=" if mate_contig == contig else mate_contig
+        qual = "F" * len(seq)
+        tags = [f"RX:Z:{umi}"] + list(extra)
+        return [qname, str(flag), contig, str(pos), "60", cigar, rnext, str(mate_pos), str(tlen), seq, qual] + tags
+
+    def molecules(self):
+        """ Yield a list of fragments, each a list of segments as lists of
+            sam fields, for every unique molecule.
+        """
+        rng = random.Random(self.seed + 1)
+        for molecule in range(self.fragments):
+            size = int(rng.gauss(self.fragment_size, self.fragment_size_sd))
+            size = min(max(size, self.read_length // 2), 1000)
+            length = min(self.read_length, size)
+            contig, start = self._locus(rng, size)
+            reverse = rng.random() < 0.5
+            umi = "{}-{}".format("".join(rng.choices(BASES, k=self.umi_length)),
+                                 "".join(rng.choices(BASES, k=self.umi_length)))
+            kind = rng.random()
+            split = kind < self.supplementary_rate
+            discordant = not split and kind < self.supplementary_rate + self.discordant_rate
+
+            left_contig, left_pos = contig, start
+            if discordant:
+                right_contig, right_start = self._locus(rng, size)
+                while right_contig == contig and len(self.names) > 1:
+                    right_contig, right_start = self._locus(rng, size)
+                right_pos = right_start + size - length
+            else:
+                right_contig, right_pos = contig, start + size - length
+            left_seq = self.contigs[left_contig][left_pos - 1:left_pos - 1 + length]
+            right_seq = self.contigs[right_contig][right_pos - 1:right_pos - 1 + length]
+            supplementary_contig, supplementary_pos = contig, None
+            while split and supplementary_contig == contig and len(self.names) > 1:
+                supplementary_contig, supplementary_pos = self._locus(rng, length)
+
+            family_size = 1
+            while rng.random() > 1 / self.mean_family_size:
+                family_size += 1
+
+            family = []
+            for copy in range(family_size):
+                qname = f"frag{molecule:08}:{copy}"
+                lflag, rflag = (READ1, READ2) if not reverse else (READ2, READ1)
+                lseq = self._mutate(rng, left_seq)
+                rseq = self._mutate(rng, right_seq)
+                tlen = 0 if discordant else size
+                paired = PAIRED if not discordant else 0x1
+                left_cigar = f"{length}M"
+                extra = ()
+                if split:
+                    clipped = length // 3
+                    left_cigar = f"{length - clipped}M{clipped}S"
+                    extra = (f"SA:Z:{supplementary_contig},{supplementary_pos},+,{length - clipped}S{clipped}M,60,0;",)
+                left = self._segment(qname, paired | lflag | MATE_RC, left_contig, left_pos, left_cigar,
+                                     right_contig, right_pos, tlen, lseq, umi, extra)
+                right = self._segment(qname, paired | rflag | RC, right_contig, right_pos, f"{length}M",
+                                      left_contig, left_pos, -tlen, rseq, umi)
+                fragment = [left, right]
+                if split:
+                    fragment.append(self._segment(qname, paired | lflag | MATE_RC | SUPPLEMENTARY, supplementary_contig,
+                                                  supplementary_pos, f"{length - clipped}S{clipped}M", right_contig,
+                                                  right_pos, 0, lseq, umi, (f"SA:Z:{left_contig},{left_pos},+,{left_cigar},60,0;",)))
+                family.append(fragment)
+            yield family
+
+    def write_sam(self, path, sort="name"):
+        """ Write the simulated reads to path sorted either by "name", ie
+            with all segments of a fragment adjacent, or by "position".
+            Returns the number of records written.
+        """
+        records = 0
+        with open(path, "wt") as f_out:
+            f_out.write(self.header().replace("SO:unsorted", "SO:queryname" if sort == "name" else "SO:coordinate"))
+            if sort == "name":
+                for family in self.molecules():
+                    for fragment in family:
+                        for segment in fragment:
+                            f_out.write("\t".join(segment) + "\n")
+                            records += 1
+            elif sort == "position":
+                order = {name: i for i, name in enumerate(self.names)}
+                segments = [segment for family in self.molecules() for fragment in family for segment in fragment]
+                segments.sort(key=lambda segment:(order[segment[2]], int(segment[3]), segment[0]))
+                for segment in segments:
+                    f_out.write("\t".join(segment) + "\n")
+                records = len(segments)
+            else:
+                raise ValueError(f"Unknown sort order {sort}")
+        return records
+
+
+
+def write_bed(path, simulation, targets=200, target_size=150, seed=42):
+    """ Write a bed file of randomly placed, possibly overlapping, targets
+        each named after one of a small number of genes.
+    """
+    rng = random.Random(seed)
+    rows = []
+    for i in range(targets):
+        contig, start = simulation._locus(rng, target_size)
+        rows.append((simulation.names.index(contig), start, contig, f"GENE{i % 20 + 1};exon{i}"))
+    with open(path, "wt") as f_out:
+        for _, start, contig, name in sorted(rows):
+            f_out.write(f"{contig}\t{start}\t{start + target_size}\t{name}\n")
+    return targets
+
+
+
+def write_vcf(path, simulation, caller="vardict", variants=10000, seed=42):
+    """ Write a position sorted vcf in the style of caller, one of varscan
+        (pvalue in the format fields and no qual), mutect2 (TLOD and allele
+        specific filters, with some multiallelic sites) or vardict. Returns
+        the number of variant records written.
+    """
+    if caller not in CALLERS:
+        raise ValueError(f"Unknown variant caller {caller}")
+
+    rng = random.Random(seed)
+    sites = []
+    for i in range(variants):
+        contig, pos = simulation._locus(rng, 20)
+        sites.append((simulation.names.index(contig), pos, contig))
+    sites.sort()
+
+    header = ["##fileformat=VCFv4.2\n", f"##source={caller}\n"]
+    for name, seq in simulation.contigs.items():
+        header.append(f"##contig=<ID={name},length={len(seq)}>\n")
+    if caller == "mutect2":
+        header += ['##INFO=<ID=DP,Number=1,Type=Integer,Description="Depth">\n',
+                   '##INFO=<ID=TLOD,Number=A,Type=Float,Description="Log 10 likelihood ratio">\n',
+                   '##INFO=<ID=AS_FilterStatus,Number=A,Type=String,Description="Allele specific filters">\n',
+                   '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n',
+                   '##FORMAT=<ID=AD,Number=R,Type=Integer,Description="Allelic depths">\n',
+                   '##FORMAT=<ID=AF,Number=A,Type=Float,Description="Allele fractions">\n',
+                   '##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Depth">\n']
+    header.append("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSAMPLE\n")
+
+    with open(path, "wt") as f_out:
+        f_out.writelines(header)
+        for _, pos, contig in sites:
+            seq = simulation.contigs[contig]
+            kind = rng.random()
+            ref = seq[pos - 1]
+            if kind < 0.8:
+                alts = [rng.choice(BASES.replace(ref, ""))]
+            elif kind < 0.9:
+                # Deletion with padding base
+                ref = seq[pos - 1:pos - 1 + rng.randint(2, 6)]
+                alts = [ref[0]]
+            else:
+                alts = [ref + "".join(rng.choices(BASES, k=rng.randint(1, 5)))]
+            if caller == "mutect2" and rng.random() < 0.05:
+                alts.append(rng.choice([base for base in BASES if base != ref[0] and base not in alts]))
+
+            depth = rng.randint(100, 2000)
+            alt_reads = [rng.randint(1, depth // 10) for alt in alts]
+            ref_reads = depth - sum(alt_reads)
+            vafs = [f"{reads / depth:.4f}" for reads in alt_reads]
+            if caller == "varscan":
+                pvalue = f"{10 ** -rng.uniform(1, 20):.3E}"
+                row = [contig, pos, ".", ref, alts[0], ".", "PASS", f"ADP={depth}",
+                       "GT:GQ:SDP:DP:RD:AD:FREQ:PVAL", f"0/1:50:{depth}:{depth}:{ref_reads}:{alt_reads[0]}:{vafs[0]}:{pvalue}"]
+            elif caller == "mutect2":
+                tlods = ",".join(f"{rng.uniform(3, 200):.2f}" for alt in alts)
+                filters = "|".join(rng.choice(["SITE", "weak_evidence"]) for alt in alts)
+                row = [contig, pos, ".", ref, ",".join(alts), ".", "multiallelic" if len(alts) > 1 else "PASS",
+                       f"DP={depth};TLOD={tlods};AS_FilterStatus={filters}", "GT:AD:AF:DP",
+                       "0/1:{}:{}:{}".format(",".join(str(reads) for reads in [ref_reads] + alt_reads), ",".join(vafs), depth)]
+            else:
+                row = [contig, pos, ".", ref, alts[0], rng.randint(20, 200), "PASS", f"DP={depth};AF={vafs[0]}",
+                       "GT:DP:AD:AF", f"0/1:{depth}:{ref_reads},{alt_reads[0]}:{vafs[0]}"]
+            f_out.write("\t".join(str(field) for field in row) + "\n")
+    return variants
@@ -0,0 +1,298 @@
+import pdb
+import argparse
+import sys
+import os
+import json
+import time
+import resource
+import tempfile
+import importlib.util
+import queue
+import subprocess
+import multiprocessing
+
+import pipeline
+from .generate import Simulation, write_bed, write_vcf, CALLERS
+
+
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+FRAGMENTS = 20000
+VARIANTS = 50000
+REPEATS = 3
+
+# Modules of short lived console scripts that are launched many times per
+# sample, their import time is a significant part of their run time.
+STARTUP_MODULES = ["pipeline.filter_vcf",
+                   "pipeline.call_variants",
+                   "pipeline.postprocess_mutect2_vcf",
+                   "pipeline.postprocess_varscan_vcf",
+                   "pipeline.annotate_panel",
+                   "pipeline.breakpoint",
+                   "pipeline.size",
+                   "pipeline.multiplexing",
+                   "pipeline.stats"]
+
+BENCHMARKS = {}
+
+
+
+def benchmark(func):
+    """ Register func as a benchmark. It is called with the dict of input
+        paths and an output directory and must return the number of
+        records processed.
+    """
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+
+def load_archive(name):
+    """ Import a module from pipeline/archive. These are not part of the
+        package but use relative imports of pipeline modules so are loaded
+        as if they were.
+    """
+    path = os.path.join(os.path.dirname(pipeline.__file__), "archive", f"{name}.py")
+    spec = importlib.util.spec_from_file_location(f"pipeline.archive_{name}", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+
+def generate(data_dir, fragments=FRAGMENTS, variants=VARIANTS, seed=42):
+    """ Write all benchmark inputs to data_dir and return a dict of their
+        paths and record counts.
+    """
+    simulation = Simulation(fragments=fragments, seed=seed)
+    data = {"name_sorted_sam": os.path.join(data_dir, "name_sorted.sam"),
+            "position_sorted_sam": os.path.join(data_dir, "position_sorted.sam"),
+            "bed": os.path.join(data_dir, "targets.bed")}
+    data["sam_records"] = simulation.write_sam(data["name_sorted_sam"], sort="name")
+    simulation.write_sam(data["position_sorted_sam"], sort="position")
+    write_bed(data["bed"], simulation, seed=seed)
+    for caller in CALLERS:
+        data[f"{caller}_vcf"] = os.path.join(data_dir, f"{caller}.vcf")
+        write_vcf(data[f"{caller}_vcf"], simulation, caller=caller, variants=variants, seed=seed)
+    data["vcf_records"] = variants
+    return data
+
+
+
+@benchmark
+def size(data, output_dir):
+    from pipeline.size import do_sizing
+    do_sizing(data["name_sorted_sam"], stats_file=os.path.join(output_dir, "stats.json"), rnames="chr1", no_plot=True)
+    return data["sam_records"]
+
+
+
+@benchmark
+def ontarget(data, output_dir):
+    from pipeline.ontarget import ontarget
+    ontarget(data["name_sorted_sam"], data["bed"],
+             output_file=os.path.join(output_dir, "ontarget.sam"),
+             stats_file=os.path.join(output_dir, "stats.json"),
+             threads=1)
+    return data["sam_records"]
+
+
+
+@benchmark
+def breakpoint(data, output_dir):
+    from pipeline.breakpoint import breakpoint
+    breakpoint(data["name_sorted_sam"], output=os.path.join(output_dir, "translocations.tsv"))
+    return data["sam_records"]
+
+
+
+@benchmark
+def filter_vcf(data, output_dir):
+    from pipeline.filter_vcf import filter_vcf
+    sys.argv = ["filter_vcf", data["vardict_vcf"], "--bed", data["bed"], "--output", os.path.join(output_dir, "filtered.vcf")]
+    filter_vcf()
+    return data["vcf_records"]
+
+
+
+@benchmark
+def postprocess_varscan_vcf(data, output_dir):
+    from pipeline.postprocess_varscan_vcf import vcf_pvalue_2_phred
+    vcf_pvalue_2_phred(data["varscan_vcf"], os.path.join(output_dir, "varscan.vcf"))
+    return data["vcf_records"]
+
+
+
+@benchmark
+def postprocess_mutect2_vcf(data, output_dir):
+    from pipeline.postprocess_mutect2_vcf import postprocess_mutect2_vcf
+    postprocess_mutect2_vcf(data["mutect2_vcf"], os.path.join(output_dir, "mutect2.vcf"))
+    return data["vcf_records"]
+
+
+
+@benchmark
+def elduderino(data, output_dir):
+    module = load_archive("elduderino")
+    module.elduderino(data["position_sorted_sam"],
+                      output_file=os.path.join(output_dir, "deduped.sam"),
+                      stats_file=os.path.join(output_dir, "stats.json"),
+                      umi="prism")
+    return data["sam_records"]
+
+
+
+@benchmark
+def trim_sam(data, output_dir):
+    module = load_archive("trim_sam")
+    module.trim_sam(data["name_sorted_sam"],
+                    output_file=os.path.join(output_dir, "trimmed.sam"),
+                    stats_file=os.path.join(output_dir, "stats.json"))
+    return data["sam_records"]
+
+
+
+@benchmark
+def trim_fixmate(data, output_dir):
+    from pipeline.trim_fixmate import trim_fixmate
+    trim_fixmate(data["name_sorted_sam"],
+                 output_file=os.path.join(output_dir, "fixed.sam"),
+                 stats_file=os.path.join(output_dir, "stats.json"))
+    return data["sam_records"]
+
+
+
+@benchmark
+def startup(data, output_dir):
+    """ Import each of STARTUP_MODULES in a fresh interpreter. """
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(pipeline.__file__)))
+    for module in STARTUP_MODULES:
+        subprocess.run([sys.executable, "-c", f"import {module}"], env=env, cwd=output_dir, check=True)
+    return len(STARTUP_MODULES)
+
+
+
+def peak_memory():
+    """ High water mark of the resident set size of this process. Unlike
+        ru_maxrss this is not inherited across fork and exec.
+    """
+    with open("/proc/self/status", "rt") as f_in:
+        for line in f_in:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+
+def run_benchmark(name, data, output_dir, result_queue):
+    # Stdout is discarded as several of the stages print progress.
+    sys.stdout = open(os.devnull, "wt")
+    try:
+        start = time.perf_counter()
+        records = BENCHMARKS[name](data, output_dir)
+        elapsed = time.perf_counter() - start
+    except ImportError as e:
+        result_queue.put({"skipped": str(e)})
+        return
+    except BaseException as e:
+        result_queue.put({"error": repr(e)})
+        return
+    result_queue.put({"records": records,
+                      "seconds": round(elapsed, 3),
+                      "records_per_second": round(records / elapsed, 1),
+                      "peak_memory_mb": round(peak_memory() / 1024 / 1024, 1)})
+
+
+
+def run_benchmarks(names=(), fragments=FRAGMENTS, variants=VARIANTS, seed=42, repeats=REPEATS):
+    """ Run each benchmark in a freshly spawned, rather than forked,
+        process so that peak memory is measured independently of this one,
+        and return a dict of results by name. The best of repeats runs is
+        reported.
+    """
+    context = multiprocessing.get_context("spawn")
+    names = names or list(BENCHMARKS)
+    results = {}
+    with tempfile.TemporaryDirectory() as data_dir:
+        data = generate(data_dir, fragments=fragments, variants=variants, seed=seed)
+        for name in names:
+            if name not in BENCHMARKS:
+                sys.exit(f"Unknown benchmark {name}")
+            for repeat in range(repeats):
+                with tempfile.TemporaryDirectory(dir=data_dir) as output_dir:
+                    result_queue = context.Queue()
+                    process = context.Process(target=run_benchmark, args=(name, data, output_dir, result_queue))
+                    process.start()
+                    while True:
+                        try:
+                            result = result_queue.get(timeout=1)
+                            break
+                        except queue.Empty:
+                            if not process.is_alive():
+                                result = {"error": f"exited with code {process.exitcode}"}
+                                break
+                    process.join()
+                if name not in results or result.get("seconds", 0) < results[name].get("seconds", 0):
+                    results[name] = result
+    return results
+
+
+
+def compare(results, baseline, max_regression):
+    """ Print a table of results alongside the baseline and return the
+        names of any benchmarks whose throughput has fallen by more than
+        max_regression.
+    """
+    regressions = []
+    print(f"{'benchmark':<24}{'records/s':>12}{'baseline':>12}{'ratio':>8}{'peak MB':>10}")
+    for name, result in results.items():
+        if "records_per_second" not in result:
+            print(f"{name:<24}{result.get('skipped') or result.get('error')}")
+            continue
+        reference = baseline.get(name, {}).get("records_per_second")
+        ratio = result["records_per_second"] / reference if reference else None
+        print(f"{name:<24}{result['records_per_second']:>12.0f}{reference or '-':>12}" \
+              f"{format(ratio, '.2f') if ratio else '-':>8}{result['peak_memory_mb']:>10}")
+        if ratio is not None and ratio < 1 - max_regression:
+            regressions.append(name)
+    return regressions
+
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmarks", nargs="*", help=f"Benchmarks to run, default all of {', '.join(BENCHMARKS)}.")
+    parser.add_argument("-f", "--fragments", help="Number of unique fragments to simulate.", type=int, default=FRAGMENTS)
+    parser.add_argument("-v", "--variants", help="Number of variants to simulate per vcf.", type=int, default=VARIANTS)
+    parser.add_argument("-r", "--repeats", help="Number of times to run each benchmark, the fastest is reported.", type=int, default=REPEATS)
+    parser.add_argument("-b", "--baseline", help="Baseline results file.", default=BASELINE)
+    parser.add_argument("-s", "--save", help="Save the results as the new baseline.", action="store_const", const=True, default=False)
+    parser.add_argument("-m", "--max-regression", help="Fractional drop in throughput relative to the baseline " \
+                                                       "that is reported as a failure.", type=float, default=0.2)
+    parser.add_argument("-o", "--output", help="Write the results to this json file.", default=None)
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.benchmarks, fragments=args.fragments, variants=args.variants, repeats=args.repeats)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "rt") as f_in:
+            baseline = json.load(f_in)
+    regressions = compare(results, baseline, args.max_regression)
+
+    if args.output:
+        with open(args.output, "wt") as f_out:
+            json.dump(results, f_out, sort_keys=True, indent=4)
+    if args.save:
+        baseline.update({name: result for name, result in results.items() if "records_per_second" in result})
+        with open(args.baseline, "wt") as f_out:
+            json.dump(baseline, f_out, sort_keys=True, indent=4)
+
+    if regressions:
+        sys.exit(f"Performance regression in {', '.join(regressions)}")
+
+
+
+if __name__ == "__main__":
+    main()
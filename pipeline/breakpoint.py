@@ -5,7 +5,7 @@ import sys
 import os
 import glob
 import csv
-from collections import Counter
+from collections import Counter, defaultdict
 from itertools import chain
 from pipeline.utils import string2cigar
 
@@ -39,6 +39,10 @@ CONSUMES_READ = "MIS=X"
 L = 0
 R = 1
 
+TOLERANCE = 10
+DISCORDANT_WINDOW = 500
+COMPACT_INTERVAL = 100000
+
 
 
 def cigar_len(cig, ops):
@@ -46,9 +50,214 @@ def cigar_len(cig, ops):
 
 
 
-def breakpoint(sam, output="translocations.tsv", mapq=10):
+def clipped_position(segment):
+    """ Position of the breakpoint implied by a segment that is soft clipped
+        at one end only, or None.
+    """
+    cigar = string2cigar(segment[CIGAR])
+    if cigar and (cigar[0][1] == "S") != (cigar[-1][1] == "S"):
+        if cigar[0][1] == "S":
+            return int(segment[POS])
+        return int(segment[POS]) + cigar_len(cigar, CONSUMES_REF)
+
+
+
+def discordant_position(segment):
+    """ Approximate position of the breakpoint downstream of a segment in
+        the direction of sequencing.
+    """
+    if int(segment[FLAG]) & RC:
+        return int(segment[POS])
+    return int(segment[POS]) + cigar_len(string2cigar(segment[CIGAR]), CONSUMES_REF)
+
+
+
+class Cluster(object):
+    """ Split read and discordant pair evidence for a single breakpoint.
+        Split reads give the exact position so the location reported is
+        the most common split read position, falling back to the mean of
+        the discordant pair estimates. Partners are binned by window and
+        similarly positioned by split reads in preference.
+        delta is the maximum number of reads that may have been discarded
+        by compaction before the cluster was created.
+    """
+    __slots__ = ("rname", "start", "end", "split_reads", "discordant_pairs", "split_positions", "discordant_sum", "partners", "delta")
+
+    def __init__(self, rname, pos, delta):
+        self.rname = rname
+        self.start = pos
+        self.end = pos
+        self.split_reads = 0
+        self.discordant_pairs = 0
+        self.split_positions = Counter()
+        self.discordant_sum = 0
+        self.partners = {}
+        self.delta = delta
+
+    @property
+    def support(self):
+        return self.split_reads + self.discordant_pairs
+
+    @property
+    def position(self):
+        if self.split_positions:
+            return self.split_positions.most_common(1)[0][0]
+        return round(self.discordant_sum / self.discordant_pairs)
+
+    def add(self, pos, partner, partner_pos, split, window):
+        self.start = min(self.start, pos)
+        self.end = max(self.end, pos)
+        if split:
+            self.split_reads += 1
+            self.split_positions[pos] += 1
+        else:
+            self.discordant_pairs += 1
+            self.discordant_sum += pos
+        key = (partner, partner_pos // window)
+        counts = self.partners.setdefault(key, [0, 0, 0, 0])
+        counts[0 if split else 1] += 1
+        counts[2 if split else 3] += partner_pos
+
+    def merge(self, other):
+        self.start = min(self.start, other.start)
+        self.end = max(self.end, other.end)
+        self.split_reads += other.split_reads
+        self.discordant_pairs += other.discordant_pairs
+        self.split_positions.update(other.split_positions)
+        self.discordant_sum += other.discordant_sum
+        for key, counts in other.partners.items():
+            self.partners[key] = [a + b for a, b in zip(self.partners.get(key, (0, 0, 0, 0)), counts)]
+        self.delta = max(self.delta, other.delta)
+
+    def partner(self):
+        (rname, _), (split, discordant, split_total, discordant_total) = \
+            max(self.partners.items(), key=lambda item:(item[1][0] + item[1][1], item[0]))
+        pos = split_total / split if split else discordant_total / discordant
+        return f"{rname}:{round(pos)}"
+
+
 
-    breakpoints = Counter()
+class Clusters(object):
+    """ Streaming clustering of breakpoint evidence. Evidence within
+        tolerance of an existing cluster's split read positions, or within
+        window for discordant pair estimates, is merged into that cluster.
+        Memory is bounded using lossy counting, every compact_interval
+        pieces of evidence any clusters whose support could not exceed
+        the number of intervals so far are discarded. A cluster with
+        support of more than 1 / compact_interval of all evidence is
+        therefore never lost.
+    """
+    def __init__(self, tolerance=TOLERANCE, window=DISCORDANT_WINDOW, compact_interval=COMPACT_INTERVAL):
+        self.tolerance = tolerance
+        self.window = window
+        self.compact_interval = compact_interval
+        self.bins = defaultdict(list)
+        self.evidence = 0
+        self.compactions = 0
+
+    def add(self, rname, pos, partner, partner_pos, split):
+        distance = self.tolerance if split else self.window
+        b = pos // self.window
+        best = None
+        for key in ((rname, b - 1), (rname, b), (rname, b + 1)):
+            for cluster in self.bins.get(key, ()):
+                gap = max(cluster.start - pos, pos - cluster.end, 0)
+                if gap <= distance and (best is None or gap < best[0]):
+                    best = (gap, cluster)
+        if best is None:
+            cluster = Cluster(rname, pos, self.compactions)
+            self.bins[(rname, b)].append(cluster)
+        else:
+            cluster = best[1]
+        cluster.add(pos, partner, partner_pos, split, self.window)
+
+        self.evidence += 1
+        if self.evidence % self.compact_interval == 0:
+            self.compact()
+
+    def compact(self):
+        self.compactions += 1
+        for key in list(self.bins):
+            clusters = [cluster for cluster in self.bins[key] if cluster.support + cluster.delta > self.compactions]
+            if clusters:
+                self.bins[key] = clusters
+            else:
+                del self.bins[key]
+
+    def clusters(self):
+        """ Return the final clusters sorted by descending support, first
+            merging any neighbours that have grown to within tolerance of
+            each other.
+        """
+        by_rname = defaultdict(list)
+        for (rname, b), clusters in self.bins.items():
+            by_rname[rname].extend(clusters)
+
+        merged = []
+        for rname, clusters in by_rname.items():
+            clusters.sort(key=lambda cluster:cluster.start)
+            current = clusters[0]
+            for cluster in clusters[1:]:
+                distance = self.tolerance if cluster.split_reads and current.split_reads else self.window
+                if cluster.start - current.end <= distance:
+                    current.merge(cluster)
+                else:
+                    merged.append(current)
+                    current = cluster
+            merged.append(current)
+        merged.sort(key=lambda cluster:(-cluster.support, cluster.rname, cluster.position))
+        return merged
+
+
+
+def fragment_evidence(read):
+    """ Yield (rname, pos, partner_rname, partner_pos, split) for every
+        piece of breakpoint evidence in a fragment. Split reads are reads
+        with alignments to more than one reference that are soft clipped
+        at one end, with the partner being the clipped position of the
+        other alignment. Discordant pairs are pairs whose primary
+        alignments are to different references.
+    """
+    primaries = []
+    by_read = defaultdict(list)
+    for segment in read:
+        flag = int(segment[FLAG])
+        if flag & (UNMAPPED | SECONDARY):
+            continue
+        by_read[flag & (READ1 | READ2)].append(segment)
+        if not flag & SUPPPLEMENTARY:
+            primaries.append(segment)
+
+    for segments in by_read.values():
+        if len(set(segment[RNAME] for segment in segments)) > 1:
+            clipped = [(segment[RNAME], clipped_position(segment)) for segment in segments]
+            for rname, pos in clipped:
+                if pos is not None:
+                    for partner, partner_pos in clipped:
+                        if partner != rname:
+                            if partner_pos is not None:
+                                yield (rname, pos, partner, partner_pos, True)
+                                break
+                    else:
+                        for segment in segments:
+                            if segment[RNAME] != rname:
+                                yield (rname, pos, segment[RNAME], int(segment[POS]), True)
+                                break
+
+    if len(primaries) == 2 and primaries[0][RNAME] != primaries[1][RNAME]:
+        left, right = (discordant_position(segment) for segment in primaries)
+        yield (primaries[0][RNAME], left, primaries[1][RNAME], right, False)
+        yield (primaries[1][RNAME], right, primaries[0][RNAME], left, False)
+
+
+
+def breakpoint(sam, output="translocations.tsv", mapq=10, tolerance=TOLERANCE, window=DISCORDANT_WINDOW, compact_interval=COMPACT_INTERVAL):
+    """ Cluster split read and discordant pair evidence for translocations
+        from a name sorted sam file and write a tsv of each breakpoint,
+        its most common partner and the number of supporting split reads
+        and discordant pairs, in descending order of support.
+    """
+    clusters = Clusters(tolerance=tolerance, window=window, compact_interval=compact_interval)
     with open(sam, "rt") as f_in:
         current_qname = ""
         read = []
@@ -65,14 +274,8 @@ def breakpoint(sam, output="translocations.tsv", mapq=10):
                 
                 read = [seg for seg in read if int(seg[MAPQ]) >= mapq]
                 if len(set(seg[RNAME] for seg in read)) > 1:
-                    for segment in read:
-                        cigar = string2cigar(segment[CIGAR])
-                        if cigar and (cigar[0][1] == "S") != (cigar[-1][1] == "S"):
-                            if cigar[0][1] == "S":
-                                pos = int(segment[POS])
-                            elif cigar[-1][1] == "S":
-                                pos = int(segment[POS]) + cigar_len(cigar, CONSUMES_REF)
-                            breakpoints["{}:{}".format(segment[RNAME], pos)] += 1
+                    for evidence in fragment_evidence(read):
+                        clusters.add(*evidence)
                 
                 current_qname = qname
                 read = []
@@ -80,9 +283,9 @@ def breakpoint(sam, output="translocations.tsv", mapq=10):
     
     with open(output, "wt") as f_out:
         writer = csv.writer(f_out, delimiter="\t")
-        writer.writerow(["Location", "Reads"])
-        for loc_count in sorted(breakpoints.items(), key=lambda x:x[1], reverse=True):
-            writer.writerow(loc_count)
+        writer.writerow(["Location", "Partner", "Split_reads", "Discordant_pairs"])
+        for cluster in clusters.clusters():
+            writer.writerow([f"{cluster.rname}:{cluster.position}", cluster.partner(), cluster.split_reads, cluster.discordant_pairs])
 
 
 
@@ -91,6 +294,10 @@ def main():
     parser.add_argument('sam', help="Sam file, must be sorted by name.")
     parser.add_argument("-o", "--output", help="Output file.", default=argparse.SUPPRESS)
     parser.add_argument("-M", "--filter-mapq-less-than", help="Filter fragments with mapq less than.", dest="mapq", type=int, default=argparse.SUPPRESS)
+    parser.add_argument("-t", "--tolerance", help=f"Merge split read breakpoints within this distance (default {TOLERANCE}).", type=int, default=argparse.SUPPRESS)
+    parser.add_argument("-w", "--window", help=f"Merge discordant pairs within this distance (default {DISCORDANT_WINDOW}).", type=int, default=argparse.SUPPRESS)
+    parser.add_argument("-c", "--compact-interval", help="Discard low support breakpoints after this many reads of evidence " \
+                                                         f"(default {COMPACT_INTERVAL}).", type=int, default=argparse.SUPPRESS)
     args = parser.parse_args()
     try:
         breakpoint(**vars(args))
@@ -103,4 +310,3 @@ def main():
 
 if __name__ == "__main__":
     main()
-
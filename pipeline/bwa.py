@@ -0,0 +1,128 @@
+import os
+import sys
+import json
+import fcntl
+import tempfile
+from contextlib import contextmanager
+
+from .utils import run
+
+
+
+__all__ = ["resident", "stage", "release", "resident_indices"]
+
+
+# Set in the environment of pipelines that may leave their bwa index resident
+# in shared memory, ie those run by sqs_dequeue which releases it once the
+# queue has drained. Standalone runs load the index from disk as normal.
+SHM = "PIPELINE_BWA_SHM"
+
+LOCK = os.path.join(tempfile.gettempdir(), "pipeline.bwa_shm.lock")
+STATE = os.path.join(tempfile.gettempdir(), "pipeline.bwa_shm.json")
+
+
+
+@contextmanager
+def locked():
+    with open(LOCK, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+
+def signature(reference):
+    stat = os.stat(f"{reference}.bwt")
+    return [os.path.realpath(reference), stat.st_size, stat.st_mtime_ns]
+
+
+
+def read_state():
+    try:
+        with open(STATE, "rt") as f_in:
+            return json.load(f_in)
+    except (OSError, ValueError):
+        return {}
+
+
+
+def write_state(state):
+    with open(f"{STATE}.tmp", "wt") as f_out:
+        json.dump(state, f_out)
+    os.replace(f"{STATE}.tmp", STATE)
+
+
+
+def resident_indices():
+    """ Return the names of the indices currently held in shared memory by
+        bwa shm.
+    """
+    try:
+        completedprocess = run(["bwa", "shm", "-l"], exit_on_failure=False)
+    except OSError:
+        # bwa is not installed.
+        return set()
+    if completedprocess.returncode:
+        return set()
+    return set(line.split("\t")[0] for line in completedprocess.stdout.splitlines() if line.strip())
+
+
+
+def stage(reference):
+    """ Load the bwa index of reference into shared memory unless it is
+        already there. bwa mem identifies shared indices only by the
+        basename of the reference, therefore if a different index with the
+        same name is resident it is replaced. Processes already using the
+        old index are unaffected but all jobs on a node must use
+        references with distinct names. Returns True if the index is
+        resident. Failure, eg if /dev/shm or memory is too small, is not
+        an error as bwa mem will load the index from disk.
+    """
+    name = os.path.basename(reference)
+    with locked():
+        state = read_state()
+        current = signature(reference)
+        indices = resident_indices()
+        if name in indices and state.get(name) == current:
+            return True
+        if name in indices:
+            print(f"bwa: replacing resident index {name}", file=sys.stderr)
+            if run(["bwa", "shm", "-d"], exit_on_failure=False).returncode:
+                print("bwa: unable to remove resident indices", file=sys.stderr)
+                return False
+            state = {}
+            write_state(state)
+        completedprocess = run(["bwa", "shm", reference], exit_on_failure=False)
+        if completedprocess.returncode:
+            print(f"bwa: unable to load {name} into shared memory, it will be loaded from disk", file=sys.stderr)
+            for line in completedprocess.stderr.splitlines():
+                print(line, file=sys.stderr)
+            return False
+        state[name] = current
+        write_state(state)
+        return True
+
+
+
+def release():
+    """ Remove all bwa indices from shared memory.
+    """
+    with locked():
+        if resident_indices():
+            run(["bwa", "shm", "-d"], exit_on_failure=False)
+        try:
+            os.unlink(STATE)
+        except OSError:
+            pass
+
+
+
+def resident(aligner, reference):
+    """ Ensure the index of reference is resident in shared memory, so that
+        it is loaded once per node rather than for every invocation of bwa
+        mem, if permitted by the environment. bwa-mem2 has no equivalent of
+        bwa shm and is left to load its index from disk, as is bwa if the
+        index cannot be staged. Returns True if the index is resident.
+    """
+    if aligner != "bwa" or not os.environ.get(SHM):
+        return False
+    return stage(reference)
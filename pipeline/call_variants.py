@@ -5,11 +5,163 @@ import pdb
 import sys
 import argparse
 import glob
+from concurrent.futures import ThreadPoolExecutor
 
 from pipeline import run, Pipe
 
 
 
+# Relative share of the available threads given to each caller. mpileup
+# and varscan are single threaded and only need more for annotation.
+CALLER_WEIGHTS = {"varscan": 1,
+                  "vardict": 4,
+                  "mutect2": 3}
+
+
+
+def split_threads(callers, threads):
+    """ Divide threads between callers in proportion to CALLER_WEIGHTS,
+        every caller receiving at least one thread.
+    """
+    total = sum(CALLER_WEIGHTS[caller] for caller in callers)
+    shares = {caller: max(1, threads * CALLER_WEIGHTS[caller] // total) for caller in callers}
+    # Any left over from rounding down go to the most parallel caller.
+    shares[max(callers, key=CALLER_WEIGHTS.get)] += max(threads - sum(shares.values()), 0)
+    return shares
+
+
+
+def varscan(args, pipe, threads, targets_bedfile):
+    """ Call variants with samtools mpileup and varscan, both single threaded.
+    """
+    mpileup = f"{args.name}.mpileup"
+    pipe(["samtools", "mpileup", "-o", mpileup,
+                                 "-f", args.reference,
+                                 "-A",
+                                 "-B",
+                                 "-q", "10",
+                                 "-d", "10000000",
+                                 args.input_bam])
+
+    pvalue_vcf = f"{args.name}.pvalue.vcf"
+    with open(pvalue_vcf, "wb") as f_out:
+        pipe(["varscan", "mpileup2cns", mpileup,
+                                        "--variants",
+                                        "--output-vcf", "1",
+                                        "--min-coverage", "1",
+                                        "--min-var-freq", args.min_vaf,
+                                        "--min-avg-qual", "20",
+                                        "--min-reads2", args.min_alt_reads,
+                                        "--p-value", "0.05",
+                                        "--strand-filter", "1"], stdout=f_out)
+    os.unlink(mpileup)
+
+    vcf = f"{args.name}.varscan.unfiltered.vcf" if targets_bedfile else f"{args.name}.varscan.vcf"
+    pipe(["postprocess_varscan_vcf", pvalue_vcf, "--output", vcf])
+    os.unlink(pvalue_vcf)
+
+    if targets_bedfile:
+        unfiltered_vcf = vcf
+        vcf = f"{args.name}.varscan.vcf"
+        pipe(["filter_vcf", unfiltered_vcf, "--output", vcf, "--bed", targets_bedfile])
+        os.unlink(unfiltered_vcf)
+
+    if args.vep and args.panel:
+        pipe(["annotate_panel", "--vep", args.vep,
+                                "--output", f"{args.name}.varscan.annotation.tsv",
+                                "--reference", args.reference,
+                                "--threads", threads,
+                                "--panel", args.panel,
+                                vcf])
+
+
+
+def vardict(args, pipe, threads, targets_bedfile):
+    """ Call variants with vardict, multithreaded.
+    """
+    vardict_table = f"{args.name}.vardict.tsv"
+    with open(vardict_table, "wb") as f_out:
+        pipe(["vardictjava", "-K", # include Ns in depth calculation
+                             "-deldupvar", # variants are only called if start position is inside the region interest
+                             "-G", args.reference,
+                             "-N", args.name,
+                             "-b", args.input_bam,
+                             "-Q", "10",
+                             "-f", args.min_vaf,
+                             "-r", args.min_alt_reads,
+                             "-th", threads,
+                             "-u", # count mate pair overlap only once
+                             "-fisher", # perform work of teststrandbias.R
+                             targets_bedfile], stdout=f_out)
+
+    unfiltered_vcf = f"{args.name}.vardict.unfiltered.vcf"
+    with open(vardict_table, "rb") as f_in:
+        with open(unfiltered_vcf, "wb") as f_out:
+            pipe(["var2vcf_valid.pl", "-A", # output all variants at same position
+                                      "-f", args.min_vaf,
+                                      "-N", args.name], stdin=f_in, stdout=f_out)
+    os.unlink(vardict_table)
+    
+    vcf = f"{args.name}.vardict.vcf"
+    # Although vardict take the targets bedfile as an argument is does call occasional variants just outside 
+    pipe(["filter_vcf", unfiltered_vcf, "--output", vcf, "--bed", targets_bedfile])
+    os.unlink(unfiltered_vcf)
+
+    if args.vep and args.panel:
+        pipe(["annotate_panel", "--vep", args.vep,
+                                "--output", f"{args.name}.vardict.annotation.tsv",
+                                "--reference", args.reference,
+                                "--threads", threads,
+                                "--panel", args.panel,
+                                vcf])
+
+
+
+def mutect2(args, pipe, threads, targets_bedfile):
+    """ Call variants with gatk Mutect2, multithreaded pair hmm only.
+    """
+    unmutectfiltered_vcf = f"{args.name}.unmutectfiltered.mutect2.vcf"
+    pipe(["gatk", "Mutect2", "-R", args.reference,
+                             "-I", args.input_bam,
+                             "-O", unmutectfiltered_vcf,
+                             "--create-output-variant-index", "false",
+                             "--max-reads-per-alignment-start", "0",
+                             "--disable-read-filter", "NotDuplicateReadFilter",
+                             "--disable-read-filter", "GoodCigarReadFilter",
+                             "--native-pair-hmm-threads", threads])
+
+    multiallelic_vcf = f"{args.name}.multiallelic.mutect2.vcf"
+    pipe(["gatk", "FilterMutectCalls", "-R", args.reference,
+                                       "-V", unmutectfiltered_vcf,
+                                       "-O", multiallelic_vcf,
+                                       "--filtering-stats", "false",
+                                       "--create-output-variant-index", "false"])
+    os.unlink(unmutectfiltered_vcf)
+    os.unlink(f"{unmutectfiltered_vcf}.stats")
+
+    vcf = f"{args.name}.mutect2.unfiltered.vcf" if targets_bedfile else f"{args.name}.mutect2.vcf"
+    pipe(["postprocess_mutect2_vcf", "--output", vcf,
+                                     "--min-alt-reads", args.min_alt_reads,
+                                     "--min-vaf", args.min_vaf,
+                                     multiallelic_vcf])
+    os.unlink(multiallelic_vcf)
+
+    if targets_bedfile:
+        unfiltered_vcf = vcf
+        vcf = f"{args.name}.mutect2.vcf"
+        pipe(["filter_vcf", unfiltered_vcf, "--output", vcf, "--bed", targets_bedfile])
+        os.unlink(unfiltered_vcf)
+
+    if args.vep and args.panel:
+        pipe(["annotate_panel", "--vep", args.vep,
+                                "--output", f"{args.name}.mutect2.annotation.tsv",
+                                "--reference", args.reference,
+                                "--threads", threads,
+                                "--panel", args.panel,
+                                vcf])
+
+
+
 def call_variants():
     """Cell free pipeline2 variant calling.
     """
@@ -33,7 +185,7 @@ def call_variants():
         fn = os.path.basename(args.input_bam)
         args.name = fn[:-4] if fn.endswith(".bam") else fn
 
-    args.callers = args.callers.lower().replace(",", " ").split()
+    args.callers = list(dict.fromkeys(args.callers.lower().replace(",", " ").split()))
     for caller in args.callers:
         if caller not in ("varscan", "vardict", "mutect2"):
             sys.exit(f"{caller} is not a recognised variant caller")
@@ -57,134 +209,14 @@ def call_variants():
     if "mutect2" in args.callers and not os.path.exists(f"{args.input_bam}.bai"):
         sys.exit(f"No index found for {args.input_bam} (required by mutect2)")
 
-    ###############################################################################################################
-    ### VARSCAN                                                                                                 ###
-    ###############################################################################################################
-    if "varscan" in args.callers:
-        mpileup = f"{args.name}.mpileup"
-        pipe(["samtools", "mpileup", "-o", mpileup,
-                                     "-f", args.reference,
-                                     "-A",
-                                     "-B",
-                                     "-q", "10",
-                                     "-d", "10000000",
-                                     args.input_bam])
-
-        pvalue_vcf = f"{args.name}.pvalue.vcf"
-        with open(pvalue_vcf, "wb") as f_out:
-            pipe(["varscan", "mpileup2cns", mpileup,
-                                            "--variants",
-                                            "--output-vcf", "1",
-                                            "--min-coverage", "1",
-                                            "--min-var-freq", args.min_vaf,
-                                            "--min-avg-qual", "20",
-                                            "--min-reads2", args.min_alt_reads,
-                                            "--p-value", "0.05",
-                                            "--strand-filter", "1"], stdout=f_out)
-        os.unlink(mpileup)
-
-        vcf = f"{args.name}.varscan.unfiltered.vcf" if targets_bedfile else f"{args.name}.varscan.vcf"
-        pipe(["postprocess_varscan_vcf", pvalue_vcf, "--output", vcf])
-        os.unlink(pvalue_vcf)
-
-        if targets_bedfile:
-            unfiltered_vcf = vcf
-            vcf = f"{args.name}.varscan.vcf"
-            pipe(["filter_vcf", unfiltered_vcf, "--output", vcf, "--bed", targets_bedfile])
-            os.unlink(unfiltered_vcf)
-
-        if args.vep and args.panel:
-            pipe(["annotate_panel", "--vep", args.vep,
-                                    "--output", f"{args.name}.varscan.annotation.tsv",
-                                    "--reference", args.reference,
-                                    "--threads", threads,
-                                    "--panel", args.panel,
-                                    vcf])
-
-
-    ###############################################################################################################
-    ### VARDICT                                                                                                 ###
-    ###############################################################################################################
-    if "vardict" in args.callers:
-        vardict_table = f"{args.name}.vardict.tsv"
-        with open(vardict_table, "wb") as f_out:
-            pipe(["vardictjava", "-K", # include Ns in depth calculation
-                                 "-deldupvar", # variants are only called if start position is inside the region interest
-                                 "-G", args.reference,
-                                 "-N", args.name,
-                                 "-b", args.input_bam,
-                                 "-Q", "10",
-                                 "-f", args.min_vaf,
-                                 "-r", args.min_alt_reads,
-                                 "-th", threads,
-                                 "-u", # count mate pair overlap only once
-                                 "-fisher", # perform work of teststrandbias.R
-                                 targets_bedfile], stdout=f_out)
-
-        unfiltered_vcf = f"{args.name}.vardict.unfiltered.vcf"
-        with open(vardict_table, "rb") as f_in:
-            with open(unfiltered_vcf, "wb") as f_out:
-                pipe(["var2vcf_valid.pl", "-A", # output all variants at same position
-                                          "-f", args.min_vaf,
-                                          "-N", args.name], stdin=f_in, stdout=f_out)
-        os.unlink(vardict_table)
-        
-        vcf = f"{args.name}.vardict.vcf"
-        # Although vardict take the targets bedfile as an argument is does call occasional variants just outside 
-        pipe(["filter_vcf", unfiltered_vcf, "--output", vcf, "--bed", targets_bedfile])
-        os.unlink(unfiltered_vcf)
-
-        if args.vep and args.panel:
-            pipe(["annotate_panel", "--vep", args.vep,
-                                    "--output", f"{args.name}.vardict.annotation.tsv",
-                                    "--reference", args.reference,
-                                    "--threads", threads,
-                                    "--panel", args.panel,
-                                    vcf])
-
-
-    ###############################################################################################################
-    ### MUTECT2                                                                                                 ###
-    ###############################################################################################################
-    if "mutect2" in args.callers:
-        unmutectfiltered_vcf = f"{args.name}.unmutectfiltered.mutect2.vcf"
-        pipe(["gatk", "Mutect2", "-R", args.reference,
-                                 "-I", args.input_bam,
-                                 "-O", unmutectfiltered_vcf,
-                                 "--create-output-variant-index", "false",
-                                 "--max-reads-per-alignment-start", "0",
-                                 "--disable-read-filter", "NotDuplicateReadFilter",
-                                 "--disable-read-filter", "GoodCigarReadFilter"])
-
-        multiallelic_vcf = f"{args.name}.multiallelic.mutect2.vcf"
-        pipe(["gatk", "FilterMutectCalls", "-R", args.reference,
-                                           "-V", unmutectfiltered_vcf,
-                                           "-O", multiallelic_vcf,
-                                           "--filtering-stats", "false",
-                                           "--create-output-variant-index", "false"])
-        os.unlink(unmutectfiltered_vcf)
-        os.unlink(f"{unmutectfiltered_vcf}.stats")
-
-        vcf = f"{args.name}.mutect2.unfiltered.vcf" if targets_bedfile else f"{args.name}.mutect2.vcf"
-        pipe(["postprocess_mutect2_vcf", "--output", vcf,
-                                         "--min-alt-reads", args.min_alt_reads,
-                                         "--min-vaf", args.min_vaf,
-                                         multiallelic_vcf])
-        os.unlink(multiallelic_vcf)
-
-        if targets_bedfile:
-            unfiltered_vcf = vcf
-            vcf = f"{args.name}.mutect2.vcf"
-            pipe(["filter_vcf", unfiltered_vcf, "--output", vcf, "--bed", targets_bedfile])
-            os.unlink(unfiltered_vcf)
-
-        if args.vep and args.panel:
-            pipe(["annotate_panel", "--vep", args.vep,
-                                    "--output", f"{args.name}.mutect2.annotation.tsv",
-                                    "--reference", args.reference,
-                                    "--threads", threads,
-                                    "--panel", args.panel,
-                                    vcf])
+    shares = split_threads(args.callers, int(threads))
+    callers = {"varscan": varscan, "vardict": vardict, "mutect2": mutect2}
+    # The callers are independent, therefore each runs, along with its own
+    # postprocessing, filtering and annotation, in a separate thread.
+    with ThreadPoolExecutor(max_workers=max(len(args.callers), 1)) as executor:
+        futures = [executor.submit(callers[caller], args, pipe, shares[caller], targets_bedfile) for caller in args.callers]
+    for future in futures:
+        future.result()
 
 
     print(pipe.durations, file=sys.stderr, flush=True)
@@ -3,10 +3,14 @@
 import os
 import pdb
 import sys
+import atexit
 import argparse
 import glob
+from concurrent.futures import ThreadPoolExecutor
 
-from pipeline import run, Pipe, guess_sample_name, __version__
+from pipeline import run, Pipe, guess_sample_name, compact_stats, merge_stats, __version__
+from pipeline.bwa import resident
+from pipeline.utils import fastq_fifo, available_threads
 
 
 
@@ -27,17 +31,19 @@ def cfPipeline():
     parser.add_argument("-f", "--min-vaf", help="Minimum variant allele frequency for a variant to be called when using VarDict.", type=float, default=None)
     parser.add_argument("-a", "--min-alt-reads", help="Minimum number of alt reads for a variant to be called.", type=float, default=2)
     parser.add_argument("-c", "--cnv", help="Whitespace separated list of target names, as specified in targets bedfile, over which to calculate copy number variation.", default="")
+    parser.add_argument("-P", "--pon", help="Panel of normals, built with cnv, against which to compare copy numbers.", default="")
     parser.add_argument("-d", "--sizes", help="Whitespace separated list of reference names over which to calculate fragment size distribution.", default="")
     parser.add_argument("-b", "--translocations", help="Call translocations (supplementary reads aligned to different chromosomes).", action="store_const", const=True, default=False)
     parser.add_argument("-i", "--interleaved", help="Each input fastq contains alternating reads 1 and 2.", action="store_const", const=True, default=False)
     parser.add_argument("-o", "--output", help="Path to write output files to.", default=".")
-    parser.add_argument("-t", "--threads", help="Number of threads to use, defaults to all available threads if not specified.", type=int, default=None)
+    parser.add_argument("-t", "--threads", help="Number of threads to use, defaults to $PIPELINE_THREADS if set otherwise all available threads.", type=int, default=None)
     parser.add_argument("-s", "--sam-only", help="Quit after producing initial undeduplicated sam.", action="store_const", const=True, default=False)
+    parser.add_argument("-N", "--no-plot", help="Only calculate statistics, do not draw pdfs. These can be drawn later from the stats file with report.", action="store_const", const=True, default=False)
     parser.add_argument("-C", "--callers", help="Variant callers to use. Valid values are varscan, vardict and mutect2. Defaults to 'varscan,vardict'.", default="varscan,vardict")
     parser.add_argument("-D", "--optical-duplicate-distance", help="Maximum pixel distance between two cluster to be considered optical duplicates.", default=None)
     args = parser.parse_args()
 
-    threads = args.threads or run(["getconf", "_NPROCESSORS_ONLN"]).stdout.strip()
+    threads = args.threads or available_threads()
 
     if not args.name:
         args.name = guess_sample_name(args.input_fastqs)
@@ -56,6 +62,8 @@ def cfPipeline():
         args.panel = os.path.abspath(args.panel)
     if args.vep:
         args.vep = os.path.abspath(args.vep)
+    if args.pon:
+        args.pon = os.path.abspath(args.pon)
     os.chdir(args.output)
 
     args.reference = (glob.glob(f"{args.reference}/*.fna") + glob.glob(f"{args.reference}/*.fa") + glob.glob(f"{args.reference}/*.fasta") + [args.reference])[0]
@@ -68,17 +76,47 @@ def cfPipeline():
         sys.exit("Invalid bwa indexes")
     targets_bedfile = (glob.glob(f"{args.panel}/*.bed") + [None])[0] if args.panel else ""
     stats = f"{args.name}.stats.json"
-    pipe = Pipe()
+    no_plot = ["--no-plot"] if args.no_plot else []
+    pipe = Pipe(log=f"{args.name}.pipe.jsonl", stats=stats)
+    # The steps and stats records are saved even if a step fails as
+    # pipe exits via sys.exit. Exit handlers run in reverse order.
+    atexit.register(compact_stats, stats)
+    atexit.register(pipe.save)
+
+
+    # Fastq qc only reads the input fastqs therefore runs alongside umi
+    # removal and alignment.
+    command = ["fastq_qc", "--stats", stats,
+                           "--threads", 2]
+    if args.interleaved:
+        command.append("--interleaved")
+    executor = ThreadPoolExecutor(max_workers=1)
+    fastq_qc = executor.submit(pipe, command + args.input_fastqs)
 
 
     # Remove umis and do some basic fastq qc
     interleaved_fastq = f"{args.name}.interleaved.fastq"
+    # udini rewrites its stats file directly, therefore is given its own
+    # which is then merged into the stats records.
+    udini_stats = f"{args.name}.udini.stats.json"
     command = ["udini", "--output", interleaved_fastq,
-                        "--stats", stats,
+                        "--stats", udini_stats,
                         "--umi", args.umi]
+    # The lanes of each read are decompressed in parallel and concatenated
+    # into named pipes rather than decompressed by udini in a single thread.
     if args.interleaved:
         command.append("--interleaved")
-    pipe(command + args.input_fastqs)
+        with fastq_fifo(args.input_fastqs, threads) as fastq:
+            pipe(command + [fastq])
+    else:
+        with fastq_fifo(args.input_fastqs[::2], threads) as r1, fastq_fifo(args.input_fastqs[1::2], threads) as r2:
+            pipe(command + [r1, r2])
+    merge_stats(stats, udini_stats)
+
+
+    # Shares a single copy of the index between both alignments and any
+    # concurrent or subsequent jobs on this node if run by sqs_dequeue.
+    resident(bwa, args.reference)
 
 
     base_sam = f"{args.name}.base.sam"
@@ -97,6 +135,8 @@ def cfPipeline():
                               "-@", threads,
                               base_sam])
     os.unlink(base_sam)
+    fastq_qc.result()
+    executor.shutdown()
 
     if args.sam_only:
         return
@@ -107,12 +147,14 @@ def cfPipeline():
         optical_duplicate_distance = ["--optical-duplicate-distance", args.optical_duplicate_distance]
     else:
         optical_duplicate_distance = []
+    elduderino_stats = f"{args.name}.elduderino.stats.json"
     pipe(["elduderino", "--output", deduplicated_fastq,
-                        "--stats", stats,
+                        "--stats", elduderino_stats,
                         "--min-family-size", args.min_family_size,
                         "--umi", args.umi] +
                         optical_duplicate_distance +
                         [sorted_sam])
+    merge_stats(stats, elduderino_stats)
     os.unlink(sorted_sam)
 
 
@@ -138,8 +180,9 @@ def cfPipeline():
 
     pipe(["size", "--stats", stats,
                   "--rnames", args.sizes,
-                  "--output", f"{args.name}.sizes.pdf",
-                  namesorted_sam])
+                  "--output", f"{args.name}.sizes.pdf"] +
+                  no_plot +
+                  [namesorted_sam])
 
 
     ontarget_sam = f"{args.name}.ontarget.sam"
@@ -147,36 +190,21 @@ def cfPipeline():
                       "--bed", targets_bedfile,
                       "--stats", stats,
                       "--cnv", args.cnv,
-                      "--threads", threads,
-                      namesorted_sam])
+                      "--reference", args.reference,
+                      "--threads", threads] +
+                      (["--pon", args.pon] if args.pon else []) +
+                      [namesorted_sam])
     os.unlink(namesorted_sam)
     
     
-    untrimmed_sam = f"{args.name}.untrimmed.sam"
-    pipe(["samtools", "sort", "-o", untrimmed_sam,
-                              "-@", threads, 
-                              ontarget_sam])
-    os.unlink(ontarget_sam)
-    
-    
-    trimmed_sam = f"{args.name}.trimmed.sam"
-    pipe(["trim", "--output", trimmed_sam,
-                  "--reference", args.reference,
-                  untrimmed_sam])
-    os.unlink(untrimmed_sam)
-    
-    
-    namesorted_sam = f"{args.name}.namesorted.sam"
-    pipe(["samtools", "sort", "-n", # sort by name
-                              "-o", namesorted_sam,
-                              "-@", threads, 
-                              trimmed_sam])
-    os.unlink(trimmed_sam)
-
-
+    # ontarget output is grouped by name so overlapping reads can be trimmed
+    # and their mate information fixed without any intermediate sorts.
     fixed_sam = f"{args.name}.fixed.sam"
-    pipe(["samtools", "fixmate", namesorted_sam, fixed_sam])
-    os.unlink(namesorted_sam)
+    pipe(["trim_fixmate", "--output", fixed_sam,
+                          "--stats", stats,
+                          "--read-group", args.name,
+                          ontarget_sam])
+    os.unlink(ontarget_sam)
 
 
     if args.translocations:
@@ -184,19 +212,15 @@ def cfPipeline():
                             fixed_sam])
 
 
-    no_read_groups_bam = f"{args.name}.no_read_groups.bam"
-    pipe(["samtools", "sort", "-o", no_read_groups_bam,
+    # Read groups are added by trim_fixmate as required by Mutect2 and
+    # possibly other gatk tools.
+    bam = f"{args.name}.bam"
+    pipe(["samtools", "sort", "-o", bam,
                               "-@", threads,
                               fixed_sam])
     os.unlink(fixed_sam)
 
 
-    bam = f"{args.name}.bam"
-    # This step is only required to satisfy Mutect2 and possibly other gatk tools
-    pipe(["gatk", "AddOrReplaceReadGroups", f"I={no_read_groups_bam}", f"O={bam}", "LB=lb", "PL=ILLUMINA", "PU=pu", f"SM={args.name}"])
-    os.unlink(no_read_groups_bam)
-
-
     pipe(["samtools", "index", bam])
 
 
@@ -204,7 +228,9 @@ def cfPipeline():
         pipe(["covermi_stats", "--panel", args.panel,
                                "--output", f"{args.name}.covermi.pdf",
                                "--stats", stats,
-                               bam])
+                               "--threads", threads] +
+                               no_plot +
+                               [bam])
 
 
     pipe(["call_variants", "--reference", args.reference,
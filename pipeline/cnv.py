@@ -0,0 +1,268 @@
+import pdb
+import argparse
+import sys
+import os
+import hashlib
+
+import numpy as np
+
+from .stats import load_stats
+
+
+
+# Gc content is cached per reference and set of baits as it only needs to be
+# calculated once per panel.
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "pipeline", "gc")
+
+GC_BINS = 20
+SIZE_BINS = 10
+MIN_BIN_BAITS = 5
+PSEUDOCOUNT = 0.5
+
+# Scales the median absolute deviation to the standard deviation of a
+# normal distribution.
+MAD_SCALE = 1.4826
+
+
+
+def parse_bait(name):
+    """ Split a bait name, as constructed by ontarget in the form
+        chrom:start-stop-name, into chrom, start and stop. Coordinates are
+        one based and inclusive.
+    """
+    chrom, location = name.split(":", 1)
+    start, stop = location.split("-", 2)[:2]
+    return chrom, int(start), int(stop)
+
+
+
+def read_fai(reference):
+    fai = {}
+    try:
+        with open(f"{reference}.fai", "rt") as f_in:
+            for line in f_in:
+                name, length, offset, linebases, linewidth = line.split("\t")[:5]
+                fai[name] = (int(length), int(offset), int(linebases), int(linewidth))
+    except OSError:
+        sys.exit(f"cnv: {reference} must be indexed with samtools faidx")
+    return fai
+
+
+
+def bait_gc(reference, baits):
+    """ Return a numpy array of the gc fraction of each bait, which must be
+        names in the form chrom:start-stop-name, read directly from the
+        indexed reference. Baits on contigs absent from the reference are
+        nan. Results are cached in CACHE_DIR keyed by the reference and
+        baits.
+    """
+    stat = os.stat(reference)
+    digest = hashlib.sha1()
+    digest.update(f"{os.path.realpath(reference)}\t{stat.st_size}\t{stat.st_mtime_ns}\n".encode())
+    for bait in baits:
+        digest.update(f"{bait}\n".encode())
+    cache = os.path.join(CACHE_DIR, f"{digest.hexdigest()}.npy")
+    try:
+        return np.load(cache, allow_pickle=False)
+    except (OSError, ValueError):
+        pass
+
+    fai = read_fai(reference)
+    gc = np.full(len(baits), np.nan)
+    with open(reference, "rb") as f_in:
+        for i, bait in enumerate(baits):
+            chrom, start, stop = parse_bait(bait)
+            try:
+                length, offset, linebases, linewidth = fai[chrom]
+            except KeyError:
+                continue
+            start = max(start, 1) - 1
+            stop = min(stop, length)
+            if stop <= start:
+                continue
+            first = offset + (start // linebases) * linewidth + start % linebases
+            last = offset + ((stop - 1) // linebases) * linewidth + (stop - 1) % linebases
+            f_in.seek(first)
+            seq = f_in.read(last - first + 1).replace(b"\n", b"").replace(b"\r", b"").upper()
+            acgt = sum(seq.count(base) for base in b"ACGT")
+            if acgt:
+                gc[i] = (seq.count(b"G") + seq.count(b"C")) / acgt
+
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        np.save(f"{cache[:-4]}.{os.getpid()}.npy", gc, allow_pickle=False)
+        os.replace(f"{cache[:-4]}.{os.getpid()}.npy", cache)
+    except OSError:
+        pass
+    return gc
+
+
+
+def optional_bait_gc(reference, baits):
+    """ As bait_gc but if reference is not indexed with samtools faidx
+        return None, ie no gc correction, with a warning rather than
+        exiting. The pipelines always pass their reference whether or not
+        it has been indexed.
+    """
+    if not reference:
+        return None
+    if not os.path.exists(f"{reference}.fai"):
+        print(f"cnv: {reference} is not indexed with samtools faidx, copy numbers will not be corrected for gc content", file=sys.stderr)
+        return None
+    return bait_gc(reference, baits)
+
+
+
+def median_correction(log2, covariate, bins, mask):
+    """ Subtract from log2 the median of the baits in mask that share the
+        same quantile bin of covariate. Bins with too few baits and baits
+        with a missing covariate are left uncorrected.
+    """
+    valid = mask & ~np.isnan(covariate)
+    if valid.sum() < bins * MIN_BIN_BAITS:
+        return log2
+    edges = np.unique(np.quantile(covariate[valid], np.linspace(0, 1, bins + 1)[1:-1]))
+    index = np.searchsorted(edges, np.where(np.isnan(covariate), 0, covariate), side="right")
+    corrected = log2.copy()
+    for b in range(len(edges) + 1):
+        members = valid & (index == b)
+        if members.sum() >= MIN_BIN_BAITS:
+            corrected[(index == b) & ~np.isnan(covariate)] -= np.median(log2[members])
+    return corrected
+
+
+
+def normalised_log2(counts, gc=None, sizes=None, baseline=None):
+    """ Log2 ratio of the count of each bait to the median of the baseline
+        baits, corrected for gc content and mean fragment size. counts, gc
+        and sizes are numpy arrays with one entry per bait, baseline a
+        boolean mask of baits that are not expected to vary.
+    """
+    counts = np.asarray(counts, dtype=float)
+    if baseline is None:
+        baseline = np.ones(len(counts), dtype=bool)
+    baseline = baseline & (counts > 0)
+    if not baseline.any():
+        return np.full(len(counts), np.nan)
+
+    log2 = np.log2(counts + PSEUDOCOUNT)
+    log2 -= np.median(log2[baseline])
+    if gc is not None:
+        log2 = median_correction(log2, gc, GC_BINS, baseline)
+    if sizes is not None:
+        log2 = median_correction(log2, sizes, SIZE_BINS, baseline)
+    return log2
+
+
+
+def sample_arrays(stats, baits):
+    """ Extract numpy arrays of the fragment counts and mean fragment sizes
+        of baits from a stats dict written by ontarget.
+    """
+    fragments = stats.get("fragments_per_target", {})
+    sizes = stats.get("fragment_size_per_target", {})
+    counts = np.array([fragments.get(bait, 0) for bait in baits], dtype=float)
+    mean_sizes = np.array([sizes.get(bait) or np.nan for bait in baits], dtype=float)
+    return counts, mean_sizes
+
+
+
+def save_pon(path, baits, log2):
+    np.savez_compressed(path, baits=np.array(baits), log2=log2)
+
+
+
+def load_pon(path, baits):
+    """ Return the normals x baits matrix of log2 ratios from the panel of
+        normals at path, with columns reordered to match baits. Baits absent
+        from the panel are nan.
+    """
+    with np.load(path, allow_pickle=False) as pon:
+        pon_baits = pon["baits"]
+        matrix = pon["log2"]
+    columns = {bait: i for i, bait in enumerate(pon_baits.tolist())}
+    index = np.array([columns.get(bait, -1) for bait in baits])
+    aligned = matrix[:, np.maximum(index, 0)].astype(float)
+    aligned[:, index < 0] = np.nan
+    return aligned
+
+
+
+def copy_numbers(baits, bait_genes, counts, include, exclude=(), gc=None, sizes=None, pon=None):
+    """ Return a dict of copy number statistics for each gene in include.
+        copies_per_cell is the ratio of the depth of the gene's baits to
+        that of the baseline baits (those that are neither included nor
+        excluded), ie 1.0 for an unaltered gene. If a panel of normals
+        matrix is given the median normal log2 ratio of every bait is
+        subtracted and a z score, based on the median absolute deviation of
+        the normals, is also reported.
+    """
+    include = set(include)
+    exclude = set(exclude)
+    genes = [bait_genes[bait] for bait in baits]
+    baseline = np.array([not (g & include or g & exclude) for g in genes], dtype=bool)
+    log2 = normalised_log2(counts, gc=gc, sizes=sizes, baseline=baseline)
+
+    noise = None
+    if pon is not None:
+        with np.errstate(all="ignore"):
+            reference = np.nanmedian(pon, axis=0)
+            noise = MAD_SCALE * np.nanmedian(np.abs(pon - reference), axis=0)
+            log2 = log2 - np.where(np.isnan(reference), 0, reference)
+            # The normals are centred on all baits rather than the baseline.
+            log2 -= np.nanmedian(log2[baseline]) if baseline.any() else 0
+
+    cnv = {"copies_per_cell": {}}
+    if noise is not None:
+        cnv["copy_number_zscore"] = {}
+    for gene in sorted(include):
+        members = np.array([gene in g for g in genes], dtype=bool) & ~np.isnan(log2)
+        if not members.any():
+            continue
+        ratio = np.median(log2[members])
+        cnv["copies_per_cell"][gene] = float(2 ** ratio)
+        if noise is not None:
+            sd = np.nanmedian(noise[members])
+            if sd > 0:
+                cnv["copy_number_zscore"][gene] = float(ratio / (sd / np.sqrt(members.sum())))
+    return cnv
+
+
+
+def build_pon(stats_files, reference=None, output="pon.npz"):
+    """ Build a panel of normals from the stats files of normal samples
+        processed by ontarget. Every sample's gc and fragment size
+        corrected log2 ratios are stored as one row of the matrix.
+    """
+    samples = [load_stats(path) for path in stats_files]
+    baits = sorted(set().union(*(stats.get("fragments_per_target", {}) for stats in samples)))
+    if not baits:
+        sys.exit("cnv: No fragments_per_target in stats files")
+    gc = bait_gc(reference, baits) if reference else None
+
+    log2 = np.empty((len(samples), len(baits)))
+    for row, stats in enumerate(samples):
+        counts, sizes = sample_arrays(stats, baits)
+        log2[row] = normalised_log2(counts, gc=gc, sizes=sizes)
+    save_pon(output, baits, log2)
+
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("stats_files", nargs="+", help="Stats files of normal samples processed by ontarget.")
+    parser.add_argument("-r", "--reference", help="Reference genome, indexed with samtools faidx, used to gc correct " \
+                                                  "depths. Must match that used for the samples.", default=argparse.SUPPRESS)
+    parser.add_argument("-o", "--output", help="Output panel of normals file.", default=argparse.SUPPRESS)
+    args = parser.parse_args()
+    try:
+        build_pon(**vars(args))
+    except OSError as e:
+        # File input/output error. This is not an unexpected error so just
+        # print and exit rather than displaying a full stack trace.
+        sys.exit(str(e))
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+import pdb
+import argparse
+import sys
+import os
+import csv
+import glob
+import json
+from collections.abc import Mapping
+from multiprocessing import Pool
+
+import numpy as np
+
+from .stats import load_stats, RECORDS
+
+
+
+STATS = ".stats.json"
+ANNOTATION = ".annotation.tsv"
+INDEX = "cohort.index.json"
+TABLES = {STATS: "cohort.stats.npy",
+          ANNOTATION: "cohort.annotations.npy"}
+
+# Sections of a stats file with more entries than this (eg fragments_per_target,
+# fragment_sizes) are per-sample distributions rather than summary statistics
+# and are not flattened into columns.
+MAX_SECTION_SIZE = 32
+
+
+
+def find_inputs(paths):
+    """ Expand paths, which may be files, directories (searched recursively)
+        or glob patterns, into a sorted list of stats and annotation files.
+    """
+    found = set()
+    for path in paths:
+        if os.path.isdir(path):
+            candidates = glob.glob(os.path.join(path, "**", "*"), recursive=True)
+        else:
+            candidates = glob.glob(path) or [path]
+        for candidate in candidates:
+            # Stats that have not yet been compacted may only exist as
+            # records.
+            if candidate.endswith(f"{STATS}{RECORDS}"):
+                candidate = candidate[:-len(RECORDS)]
+                if os.path.isfile(f"{candidate}{RECORDS}"):
+                    found.add(os.path.abspath(candidate))
+            elif candidate.endswith(STATS) or candidate.endswith(ANNOTATION):
+                if os.path.isfile(candidate):
+                    found.add(os.path.abspath(candidate))
+    return sorted(found)
+
+
+
+def signature(path):
+    """ The modification time and size of path and, for stats, of its
+        records file as save_stats only appends to the records.
+    """
+    sig = []
+    for filepath in ([path, f"{path}{RECORDS}"] if path.endswith(STATS) else [path]):
+        try:
+            stat = os.stat(filepath)
+            sig += [stat.st_mtime_ns, stat.st_size]
+        except FileNotFoundError:
+            sig += [None, None]
+    return sig
+
+
+
+def flatten_stats(stats):
+    row = {}
+    for key, val in stats.items():
+        if isinstance(val, Mapping):
+            if len(val) > MAX_SECTION_SIZE:
+                continue
+            for subkey, subval in val.items():
+                if isinstance(subval, (int, float)) and not isinstance(subval, bool):
+                    row[f"{key}.{subkey}"] = subval
+        elif isinstance(val, (int, float)) and not isinstance(val, bool):
+            row[str(key)] = val
+    return row
+
+
+
+def load_file(path):
+    """ Parse a single stats or annotation file into a list of rows, each
+        row being a dict of column name to value. Every row is tagged with
+        the sample name and the path it was loaded from.
+    """
+    basename = os.path.basename(path)
+    sample = basename.split(".")[0]
+    if path.endswith(STATS):
+        row = flatten_stats(load_stats(path))
+        row["sample"] = sample
+        row["path"] = path
+        return [row]
+
+    caller = basename[:-len(ANNOTATION)].split(".")[-1] if basename.count(".") > 2 else ""
+    rows = []
+    with open(path, "rt") as f_in:
+        for row in csv.DictReader(f_in, delimiter="\t"):
+            row["sample"] = sample
+            row["caller"] = caller
+            row["path"] = path
+            rows.append(row)
+    return rows
+
+
+
+def as_text(column):
+    if column.dtype.kind == "f":
+        return np.where(np.isnan(column), "", column.astype(str))
+    return column
+
+
+
+def to_table(rows):
+    """ Convert a list of row dicts into a numpy record array. Columns
+        whose values are all numbers, ie flattened stats values, are stored
+        as float64 with missing values as nan. All other columns, including
+        sample, caller, path and every annotation column, are stored as
+        fixed width unicode even if the text looks numeric (eg a sample
+        named 2101 or chromosome 1).
+    """
+    if not rows:
+        return None
+
+    names = []
+    seen = set()
+    for row in rows:
+        for name in row:
+            if name not in seen:
+                seen.add(name)
+                names.append(name)
+
+    columns = []
+    dtypes = []
+    for name in names:
+        values = [row.get(name) for row in rows]
+        if all(val is None or (isinstance(val, (int, float)) and not isinstance(val, bool)) for val in values):
+            column = [np.nan if val is None else float(val) for val in values]
+            dtype = "f8"
+        else:
+            column = ["" if val is None else str(val) for val in values]
+            dtype = "U{}".format(max(len(val) for val in column) or 1)
+        columns.append(column)
+        dtypes.append((name, dtype))
+
+    return np.rec.fromarrays(columns, dtype=dtypes)
+
+
+
+def append_rows(table, rows):
+    """ Return table with rows appended. Only the new rows are converted
+        from dicts, the existing table is concatenated a column at a time.
+        Columns missing from either part are filled with nan or "" and a
+        numeric column becomes text if the other part holds text.
+    """
+    new = to_table(rows)
+    if table is None or new is None:
+        return new if table is None else table
+
+    names = list(table.dtype.names) + [name for name in new.dtype.names if name not in table.dtype.names]
+    columns = []
+    for name in names:
+        parts = [(part[name] if name in part.dtype.names else None, len(part)) for part in (table, new)]
+        if all(column is None or column.dtype.kind == "f" for column, size in parts):
+            columns.append(np.concatenate([np.full(size, np.nan) if column is None else column for column, size in parts]))
+        else:
+            columns.append(np.concatenate([np.full(size, "", dtype="U1") if column is None else as_text(column) for column, size in parts]))
+    return np.rec.fromarrays(columns, names=names)
+
+
+
+def cohort(inputs, output_dir=".", threads=1, rebuild=False):
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+    index_path = os.path.join(output_dir, INDEX)
+
+    index = {}
+    if not rebuild and os.path.exists(index_path):
+        with open(index_path, "rt") as f_in:
+            index = json.load(f_in)
+
+    paths = find_inputs(inputs)
+    current = {path: signature(path) for path in paths}
+    changed = [path for path in paths if index.get(path) != current[path]]
+    # Samples that have disappeared from the inputs are retained, the
+    # cohort only ever grows unless explicitly rebuilt.
+    stale = set(changed)
+
+    if threads > 1 and len(changed) > 1:
+        with Pool(threads) as pool:
+            loaded = pool.map(load_file, changed)
+    else:
+        loaded = [load_file(path) for path in changed]
+
+    for extension, filename in TABLES.items():
+        table_path = os.path.join(output_dir, filename)
+        table = None
+        if not rebuild and os.path.exists(table_path):
+            table = np.load(table_path, allow_pickle=False)
+
+        rows = []
+        for path, new_rows in zip(changed, loaded):
+            if path.endswith(extension):
+                rows.extend(new_rows)
+        rows.sort(key=lambda row:(row["sample"], row["path"]))
+
+        # Rows of changed files are removed and their replacements appended,
+        # therefore the tsv only needs to be rewritten if rows were removed
+        # or the columns changed.
+        names = None
+        start = 0
+        if table is not None:
+            names = table.dtype.names
+            kept = ~np.isin(table["path"], list(stale))
+            if kept.all():
+                if not rows:
+                    continue
+                start = len(table)
+            else:
+                table = table[kept]
+        table = append_rows(table, rows)
+        if table is None:
+            continue
+        if table.dtype.names != names:
+            start = 0
+        np.save(table_path, table, allow_pickle=False)
+        write_tsv(table, table_path[:-4] + ".tsv", start)
+
+    for path in changed:
+        index[path] = current[path]
+    temp_path = f"{index_path}.tmp"
+    with open(temp_path, "wt") as f_out:
+        json.dump(index, f_out, sort_keys=True, indent=4)
+    os.replace(temp_path, index_path)
+
+    print(f"cohort: {len(changed)} files ingested, {len(paths) - len(changed)} unchanged.", file=sys.stderr)
+
+
+
+def write_tsv(table, path, start=0):
+    """ Write table to path as tsv, or if start is given append only the
+        rows from start onwards to an existing tsv.
+    """
+    names = table.dtype.names
+    with open(path, "at" if start else "wt", newline="") as f_out:
+        writer = csv.writer(f_out, delimiter="\t")
+        if not start:
+            writer.writerow(names)
+        for record in table[start:]:
+            writer.writerow(["" if isinstance(val, float) and np.isnan(val) else val for val in (record[name].item() for name in names)])
+
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('inputs', nargs="+", help="Stats (.stats.json) and annotation (.annotation.tsv) files, " \
+                                                  "directories to search or glob patterns.")
+    parser.add_argument("-o", "--output", help="Directory in which the cohort tables and index are stored.", dest="output_dir", default=argparse.SUPPRESS)
+    parser.add_argument("-t", "--threads", help="Number of processes to use for loading.", type=int, default=argparse.SUPPRESS)
+    parser.add_argument("-r", "--rebuild", help="Ignore the index and rebuild the tables from scratch.", action="store_const", const=True, default=argparse.SUPPRESS)
+    args = parser.parse_args()
+    try:
+        cohort(**vars(args))
+    except OSError as e:
+        # File input/output error. This is not an unexpected error so just
+        # print and exit rather than displaying a full stack trace.
+        sys.exit(str(e))
+
+
+
+if __name__ == "__main__":
+    main()
@@ -2,16 +2,38 @@ import pdb
 import argparse
 import sys
 import os
+import subprocess
+import tempfile
+import queue
 from collections import Counter, defaultdict
-from covermi import Panel, Cov, Plot
+from multiprocessing import Process, Queue
 
 from .utils import save_stats
 
 
-def covermi_stats(bam_path, panel_path, output_path=None, stats_file="stats.json", name=""):
+DEPTHS = (30, 100, 500, 1000, 2000)
+BLOCK_SIZE = 100
+POLL_INTERVAL = 5
+
+CHROM = 0
+START = 1
+STOP = 2
+NAME = 3
+
+BASES = 0
+DEPTH = 1
+COVERED = 2
+
+
+
+def covermi_stats(bam_path, panel_path, output_path=None, stats_file="stats.json", name="", threads=1, no_plot=False):
     if not name:
         name = os.path.basename(bam_path).split(".")[0]
 
+    # covermi imports its plotting and report modules, therefore only
+    # import it when needed.
+    from covermi import Panel
+
     panel = Panel(panel_path)
     if "targets" in panel:
         roi = panel.targets
@@ -19,25 +41,176 @@ def covermi_stats(bam_path, panel_path, output_path=None, stats_file="stats.json
         roi = panel.exons
     else:
         return
+
+    if threads > 1:
+        if not os.path.exists(f"{bam_path}.bai"):
+            sys.exit(f"No index found for {bam_path} (required for multithreaded coverage)")
+        stats = parallel_coverage(bam_path, roi, threads)
+        if output_path and not no_plot:
+            # The covermi plot needs a serial pass over the whole bam,
+            # therefore the per gene coverage already calculated is plotted
+            # instead, with the same name as the equivalent plot drawn by
+            # report rather than in place of the covermi plot.
+            from .report import plot_coverage_by_gene
+
+            output_path = os.path.join(os.path.dirname(output_path), f"{name}.coverage.pdf")
+            print(f"covermi_stats: covermi plot not drawn with multiple threads, writing per gene coverage to {output_path}", file=sys.stderr)
+            plot_coverage_by_gene(stats["coverage_by_gene"], name, output_path)
+        save_stats(stats_file, stats)
+        return
+
+    from covermi import Cov
+
     cov = Cov(bam_path)
-    if output_path:
+    if output_path and not no_plot:
+        from covermi import Plot
+
         Plot(coverage=cov, panel=panel, depth=None, title=name, output=output_path)
-    
+
     stats = {"coverage": {},
              "coverage_by_gene": defaultdict(dict)}
-    for depth in (30, 100, 500, 1000, 2000):
+    for depth in DEPTHS:
         for i in cov.calculate(roi, depth):
             stats["coverage_by_gene"][f"{depth}x"][i.name] = int(i.percent_covered)
             stats["coverage_by_gene"]["mean_depth"][i.name] = int(i.depth)
-    
+
         i = cov.calculate(roi, depth, name="Total")
         stats["coverage"][f"{depth}x"] = int(i.percent_covered)
         stats["coverage"]["mean_depth"] = int(i.depth)
-    
+
     save_stats(stats_file, stats)
 
 
 
+def coverage_worker(input_queue, output_queue, bam_path):
+    try:
+        while True:
+            block = input_queue.get()
+            if block is None:
+                break
+            output_queue.put(block_coverage(bam_path, block))
+    finally:
+        output_queue.put(None)
+
+
+
+def block_coverage(bam_path, block):
+    """ Calculate the number of bases, the summed depth and the number of
+        bases covered at each of DEPTHS for every target in block. block is
+        a list of (chrom, start, stop, name) tuples from a single contig
+        sorted by start position. Only the regions of the bam covered by
+        block are read, via the bam index, by samtools depth. Positions
+        with zero depth are not reported by samtools but are still
+        accounted for as the number of bases is calculated from the
+        length of each target.
+    """
+    results = defaultdict(lambda:[0, 0, [0] * len(DEPTHS)])
+    for target in block:
+        results[target[NAME]][BASES] += target[STOP] - target[START] + 1
+
+    with tempfile.NamedTemporaryFile("wt", suffix=".bed") as f_bed:
+        for target in block:
+            f_bed.write(f"{target[CHROM]}\t{target[START] - 1}\t{target[STOP]}\n")
+        f_bed.flush()
+
+        with subprocess.Popen(["samtools", "depth", "-d", "0", "-b", f_bed.name, bam_path],
+                              stdout=subprocess.PIPE, universal_newlines=True) as process:
+            active = []
+            i = 0
+            for row in process.stdout:
+                chrom, pos, depth = row.split("\t")
+                pos = int(pos)
+                depth = int(depth)
+                while i < len(block) and block[i][START] <= pos:
+                    active.append(block[i])
+                    i += 1
+                active = [target for target in active if target[STOP] >= pos]
+                for target in active:
+                    result = results[target[NAME]]
+                    result[DEPTH] += depth
+                    covered = result[COVERED]
+                    for j, min_depth in enumerate(DEPTHS):
+                        if depth >= min_depth:
+                            covered[j] += 1
+
+        if process.returncode:
+            sys.exit(f"samtools depth failed with return code {process.returncode}")
+    return dict(results)
+
+
+
+def parallel_coverage(bam_path, roi, threads):
+    """ Split the regions of interest into blocks of up to BLOCK_SIZE
+        targets, each from a single contig, and calculate the coverage of
+        each block in a separate worker process. The per-target results
+        are then merged by gene name and into a grand total.
+    """
+    targets = defaultdict(list)
+    for entry in roi:
+        start, stop = sorted((entry.start, entry.stop))
+        targets[entry.chrom].append((entry.chrom, start, stop, entry.name))
+
+    input_queue = Queue()
+    output_queue = Queue()
+    for chrom, block in targets.items():
+        block.sort(key=lambda t:t[START])
+        for i in range(0, len(block), BLOCK_SIZE):
+            input_queue.put(block[i:i + BLOCK_SIZE])
+
+    workers = []
+    for i in range(threads):
+        workers.append(Process(target=coverage_worker, args=(input_queue, output_queue, bam_path)))
+        input_queue.put(None)
+    for worker in workers:
+        worker.start()
+
+    by_gene = defaultdict(lambda:[0, 0, [0] * len(DEPTHS)])
+    running = len(workers)
+    while running:
+        try:
+            results = output_queue.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            # A worker killed outright, eg by the oom killer, never sends
+            # its final None. Workers that exit cleanly have put everything
+            # on the queue before exiting.
+            if any(worker.exitcode for worker in workers):
+                for worker in workers:
+                    worker.terminate()
+                sys.exit("Worker process unexpectedly terminated")
+            continue
+        if results is None:
+            running -= 1
+            continue
+        for gene, (bases, depth, covered) in results.items():
+            merged = by_gene[gene]
+            merged[BASES] += bases
+            merged[DEPTH] += depth
+            merged[COVERED] = [x + y for x, y in zip(merged[COVERED], covered)]
+    for worker in workers:
+        worker.join()
+        if worker.exitcode:
+            sys.exit("Worker process unexpectedly terminated")
+
+    total = [0, 0, [0] * len(DEPTHS)]
+    for bases, depth, covered in by_gene.values():
+        total[BASES] += bases
+        total[DEPTH] += depth
+        total[COVERED] = [x + y for x, y in zip(total[COVERED], covered)]
+
+    # Mean depths are truncated to int as in the serial path, so that stats
+    # are comparable whether or not they were calculated in parallel.
+    stats = {"coverage": {"mean_depth": int(total[DEPTH] / (total[BASES] or 1))},
+             "coverage_by_gene": defaultdict(dict)}
+    for j, depth in enumerate(DEPTHS):
+        stats["coverage"][f"{depth}x"] = int(total[COVERED][j] * 100 / (total[BASES] or 1))
+        for gene, (bases, depth_sum, covered) in sorted(by_gene.items()):
+            stats["coverage_by_gene"][f"{depth}x"][gene] = int(covered[j] * 100 / (bases or 1))
+    for gene, (bases, depth_sum, covered) in sorted(by_gene.items()):
+        stats["coverage_by_gene"]["mean_depth"][gene] = int(depth_sum / (bases or 1))
+    return stats
+
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('bam_path', help="Input bam file.")
@@ -45,7 +218,11 @@ def main():
     parser.add_argument("-o", "--output", help="Output coverage plot.", dest="output_path", default=argparse.SUPPRESS)
     parser.add_argument("-s", "--stats", help="Statistics file.", dest="stats_file", default=argparse.SUPPRESS)
     parser.add_argument("-n", "--name", help="Sample name.", default=argparse.SUPPRESS)
-    
+    parser.add_argument("-t", "--threads", help="Number of worker processes to use. If greater than one then the bam index " \
+                                                "is used to calculate the coverage of each contig or block of targets in parallel and, in place " \
+                                                "of the covermi plot, a per gene bar chart is written to {name}.coverage.pdf alongside the output.", type=int, default=argparse.SUPPRESS)
+    parser.add_argument("-N", "--no-plot", help="Only calculate statistics, do not draw the coverage plot.", action="store_const", const=True, default=argparse.SUPPRESS)
+
     args = parser.parse_args()
     try:
         covermi_stats(**vars(args))
@@ -59,4 +236,3 @@ def main():
 
 if __name__ == "__main__":
     main()
-
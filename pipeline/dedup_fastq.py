@@ -0,0 +1,168 @@
+import os
+import pdb
+import sys
+import gzip
+import argparse
+from hashlib import blake2b
+from itertools import islice
+
+import numpy as np
+
+from .utils import save_stats, open_fastqs
+
+
+
+BATCH_SIZE = 100000
+INITIAL_SIZE = 2 ** 20
+MAX_LOAD = 0.5
+
+EMPTY = np.uint64(0)
+
+
+
+class HashSet(object):
+    """ Set of 64 bit hashes held in a numpy open addressing table with
+        linear probing, using 8 bytes per slot and resized to keep the
+        load below MAX_LOAD. Hashes are inserted a batch at a time with
+        all probing vectorised. Zero marks an empty slot and is therefore
+        stored as one.
+    """
+    def __init__(self, size=INITIAL_SIZE):
+        self.table = np.zeros(size, dtype=np.uint64)
+        self.mask = np.uint64(size - 1)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _insert(self, hashes):
+        # hashes must be unique and not already present. Where several
+        # hashes probe the same empty slot the first claims it and the
+        # rest move on to the next slot.
+        slots = hashes & self.mask
+        while len(hashes):
+            empty = self.table[slots] == EMPTY
+            winners = np.zeros(len(hashes), dtype=bool)
+            unique_slots, first = np.unique(slots[empty], return_index=True)
+            winners[np.flatnonzero(empty)[first]] = True
+            self.table[slots[winners]] = hashes[winners]
+            hashes = hashes[~winners]
+            slots = (slots[~winners] + np.uint64(1)) & self.mask
+
+    def _grow(self):
+        occupied = self.table[self.table != EMPTY]
+        self.table = np.zeros(len(self.table) * 2, dtype=np.uint64)
+        self.mask = np.uint64(len(self.table) - 1)
+        self._insert(occupied)
+
+    def add(self, hashes):
+        """ Add an array of uint64 hashes and return a boolean array that
+            is True for the first occurrence of each hash not previously
+            in the set.
+        """
+        hashes = np.where(hashes == EMPTY, np.uint64(1), hashes)
+        new = np.zeros(len(hashes), dtype=bool)
+        unique, first = np.unique(hashes, return_index=True)
+
+        while (self.count + len(unique)) > len(self.table) * MAX_LOAD:
+            self._grow()
+
+        # Probe for each hash until it is found or an empty slot is reached.
+        slots = unique & self.mask
+        pending = np.arange(len(unique))
+        absent = np.zeros(len(unique), dtype=bool)
+        while len(pending):
+            found = self.table[slots]
+            empty = found == EMPTY
+            absent[pending[empty]] = True
+            unresolved = ~(empty | (found == unique[pending]))
+            pending = pending[unresolved]
+            slots = (slots[unresolved] + np.uint64(1)) & self.mask
+
+        self._insert(unique[absent])
+        self.count += int(absent.sum())
+        new[first[absent]] = True
+        return new
+
+
+
+def open_fastq(path, mode="rt"):
+    return gzip.open(path, mode) if path.endswith(".gz") else open(path, mode)
+
+
+
+def read_pairs(fastqs, threads=None):
+    """ Yield each pair of fastq records, as a tuple of two lists of four
+        lines, from a list of fastqs ordered read 1 then read 2 for each
+        lane. The lanes of each read are decompressed in parallel and
+        concatenated as streams rather than on disk.
+    """
+    if len(fastqs) % 2:
+        sys.exit("dedup_fastq: fastqs must be supplied as read 1 and read 2 pairs")
+    with open_fastqs(fastqs[::2], threads=threads) as r1, open_fastqs(fastqs[1::2], threads=threads) as r2:
+        while True:
+            read1 = list(islice(r1, 4))
+            read2 = list(islice(r2, 4))
+            if not read1 or not read2:
+                if read1 or read2:
+                    sys.exit("dedup_fastq: read 1 and read 2 fastqs contain different numbers of reads")
+                break
+            if len(read1) != 4 or len(read2) != 4:
+                sys.exit("dedup_fastq: truncated fastq record")
+            yield read1, read2
+
+
+
+def pair_hash(read1, read2):
+    return int.from_bytes(blake2b(f"{read1[1]}{read2[1]}".encode(), digest_size=8).digest(), "little")
+
+
+
+def dedup_fastq(input_fastqs, output, stats_file="", threads=None):
+    """ Remove exact duplicate read pairs, ie those with identical read 1
+        and read 2 sequences, keeping the first occurrence. Only a 64 bit
+        hash of each distinct pair is held in memory, therefore the chance
+        of a distinct pair being wrongly discarded is negligible (about 1
+        in 4000 runs at 100 million pairs). Replaces fastuniq which needs
+        uncompressed input and holds every read in memory. Output is
+        gzipped if the output names end with .gz.
+    """
+    seen = HashSet()
+    pairs = 0
+    with open_fastq(output[0], "wt") as r1_out, open_fastq(output[1], "wt") as r2_out:
+        reader = read_pairs(input_fastqs, threads)
+        while True:
+            batch = list(islice(reader, BATCH_SIZE))
+            if not batch:
+                break
+            pairs += len(batch)
+            new = seen.add(np.fromiter((pair_hash(read1, read2) for read1, read2 in batch), dtype=np.uint64, count=len(batch)))
+            for i in np.flatnonzero(new):
+                read1, read2 = batch[i]
+                r1_out.writelines(read1)
+                r2_out.writelines(read2)
+
+    print(f"dedup_fastq: {pairs - len(seen)} of {pairs} pairs were duplicates", file=sys.stderr)
+    if stats_file:
+        save_stats(stats_file, {"fastq_duplicate_rate": float(pairs - len(seen)) / pairs if pairs else 0.0})
+
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_fastqs', nargs="+", help="Paths of input fastq or fastq.gz files, read 1 then read 2 of each lane.")
+    parser.add_argument("-o", "--output", nargs=2, help="Paths of output read 1 and read 2 fastqs.", required=True)
+    parser.add_argument("-s", "--stats", help="Statistics file.", dest="stats_file", default=argparse.SUPPRESS)
+    parser.add_argument("-t", "--threads", help="Number of threads to decompress with, defaults to all available threads.", type=int, default=argparse.SUPPRESS)
+    args = parser.parse_args()
+    try:
+        dedup_fastq(**vars(args))
+    except OSError as e:
+        # File input/output error. This is not an unexpected error so just
+        # print and exit rather than displaying a full stack trace.
+        sys.exit(str(e))
+
+
+
+if __name__ == "__main__":
+    main()
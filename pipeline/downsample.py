@@ -0,0 +1,144 @@
+import os
+import pdb
+import sys
+import argparse
+import subprocess
+from contextlib import contextmanager, ExitStack
+
+from .utils import hash_rank
+
+
+
+FLAG = 1
+
+READ2 = 0x80
+SECONDARY = 0X100
+SUPPPLEMENTARY = 0x800
+NOT_COUNTED = READ2 | SECONDARY | SUPPPLEMENTARY
+
+DOWNSAMPLE_TAG = "DS:f:"
+
+
+
+@contextmanager
+def sam_reader(path):
+    """ Yield the lines of a sam file, a bam file decoded by samtools or
+        stdin if path is -.
+    """
+    if path == "-":
+        yield sys.stdin
+    elif path.endswith(".bam"):
+        with subprocess.Popen(["samtools", "view", "-h", path], stdout=subprocess.PIPE, universal_newlines=True) as process:
+            yield process.stdout
+        if process.returncode:
+            sys.exit(f"samtools view failed with return code {process.returncode}")
+    else:
+        with open(path, "rt") as f_in:
+            yield f_in
+
+
+
+@contextmanager
+def sam_writer(path):
+    """ Yield a text file to which sam lines can be written, encoded as
+        bam by samtools if path ends with .bam or to stdout if path is -.
+    """
+    if path == "-":
+        yield sys.stdout
+        sys.stdout.flush()
+    elif path.endswith(".bam"):
+        with subprocess.Popen(["samtools", "view", "-b", "-o", path, "-"], stdin=subprocess.PIPE, universal_newlines=True) as process:
+            yield process.stdin
+            process.stdin.close()
+        if process.returncode:
+            sys.exit(f"samtools view failed with return code {process.returncode}")
+    else:
+        with open(path, "wt") as f_out:
+            yield f_out
+
+
+
+def downsample(input_sam, fractions, output="downsampled.{fraction}.sam", seed=0, tag=False):
+    """ Downsample a sam or bam file to each of fractions in a single pass.
+        Templates are retained according to a seeded hash of their qname
+        so that all segments of a template are kept together, the input
+        need not be sorted and the output is reproducible. A template
+        retained at a fraction is also retained at every larger fraction.
+        Output is written to a separate file per fraction, named by
+        substituting the fraction into output, or if tag then to the
+        single file output with each record tagged with DS:f: and the
+        smallest fraction at which it is retained, templates not retained
+        at any fraction being dropped. Returns the number of templates
+        retained at each fraction.
+    """
+    fractions = sorted(set(float(fraction) for fraction in fractions))
+    if not fractions or fractions[0] <= 0 or fractions[-1] > 1:
+        sys.exit("Downsampling fractions must be greater than 0 and no greater than 1")
+    # A template is retained at a fraction if its rank is less than the
+    # threshold, the comparison is exact as ranks are 64 bit integers.
+    thresholds = [int(fraction * 2 ** 64) for fraction in fractions]
+
+    counts = [0] * len(fractions)
+    with ExitStack() as stack:
+        f_in = stack.enter_context(sam_reader(input_sam))
+        if tag:
+            outputs = [stack.enter_context(sam_writer(output))]
+        else:
+            if "{fraction}" not in output:
+                sys.exit("Output must contain {fraction} unless tagging")
+            outputs = [stack.enter_context(sam_writer(output.format(fraction=fraction))) for fraction in fractions]
+
+        current_qname = None
+        level = len(fractions)
+        for row in f_in:
+            if row.startswith("@"):
+                for f_out in outputs:
+                    f_out.write(row)
+                continue
+
+            qname, flag, _ = row.split("\t", 2)
+            if qname != current_qname:
+                current_qname = qname
+                rank = hash_rank(qname, seed)
+                level = 0
+                while level < len(thresholds) and rank >= thresholds[level]:
+                    level += 1
+            if level == len(fractions):
+                continue
+
+            # Count each template once, by its primary first or only segment.
+            if not int(flag) & NOT_COUNTED:
+                for i in range(level, len(counts)):
+                    counts[i] += 1
+
+            if tag:
+                outputs[0].write(f"{row.rstrip()}\t{DOWNSAMPLE_TAG}{fractions[level]}\n")
+            else:
+                for f_out in outputs[level:]:
+                    f_out.write(row)
+
+    for fraction, count in zip(fractions, counts):
+        print(f"{fraction}\t{count}", file=sys.stderr)
+    return dict(zip(fractions, counts))
+
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_sam', help="Input sam or bam file or - for stdin, need not be sorted.")
+    parser.add_argument("-f", "--fractions", help="Comma separated list of fractions of templates to retain.", type=lambda s: s.split(","), required=True)
+    parser.add_argument("-o", "--output", help="Output sam or bam file, which must contain {fraction} unless tagging, or - for stdout.", default=argparse.SUPPRESS)
+    parser.add_argument("-s", "--seed", help="Seed for the hash by which templates are selected.", type=int, default=argparse.SUPPRESS)
+    parser.add_argument("-t", "--tag", help="Write a single output with each record tagged with the smallest fraction in which it is retained.", action="store_const", const=True, default=argparse.SUPPRESS)
+    args = parser.parse_args()
+    try:
+        downsample(**vars(args))
+    except OSError as e:
+        # File input/output error. This is not an unexpected error so just
+        # print and exit rather than displaying a full stack trace.
+        sys.exit(str(e))
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+import pdb
+import argparse
+import sys
+import os
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from .utils import save_stats, open_fastqs
+from .dedup_fastq import HashSet
+
+
+
+CHUNK_SIZE = 2 ** 24 # bytes of each fastq read per batch
+BASES = b"ACGTN"
+N = BASES.index(b"N")
+NEWLINE = ord("\n")
+PHRED_OFFSET = 33
+# Start of the Illumina TruSeq and Nextera adapters.
+ADAPTERS = (b"AGATCGGAAGAGC", b"CTGTCTCTTATACACATCT")
+# One pair in DUPLICATE_SAMPLING is tracked to estimate the duplicate rate.
+# Pairs are sampled by hash of sequence so duplicates are sampled together.
+DUPLICATE_SAMPLING = 16
+
+MULTIPLIERS = (np.uint64(0x9E3779B97F4A7C15), np.uint64(0xC2B2AE3D27D4EB4F))
+
+
+
+def find_all(block, substrings):
+    """ Yield the start of every occurrence of each of substrings within
+        block, bytes.find being far faster than a regular expression.
+    """
+    for substring in substrings:
+        i = block.find(substring)
+        while i != -1:
+            yield i
+            i = block.find(substring, i + 1)
+
+
+
+def mix(h):
+    # splitmix64 finaliser, h must be an array as numpy warns on overflow
+    # of scalars.
+    h = (h ^ (h >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return h ^ (h >> np.uint64(31))
+
+
+
+def sequence_hash(seq, multiplier):
+    """ 64 bit hash of each row of a uint8 matrix, taken eight bytes at a
+        time.
+    """
+    if seq.shape[1] % 8:
+        seq = np.pad(seq, ((0, 0), (0, 8 - seq.shape[1] % 8)), constant_values=NEWLINE)
+    words = np.ascontiguousarray(seq).view(np.uint64)
+    powers = np.cumprod(np.full(words.shape[1], multiplier, dtype=np.uint64))
+    return mix((words * powers).sum(axis=1, dtype=np.uint64))
+
+
+
+class Batch(object):
+    """ A batch of complete fastq records decoded into uint8 matrices of
+        sequence and quality, one row per read padded with newlines, along
+        with the length of each read and the position of the first adapter
+        within it, or -1.
+    """
+    def __init__(self, seq, qual, lengths, adapters):
+        self.seq = seq
+        self.qual = qual
+        self.lengths = lengths
+        self.adapters = adapters
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, index):
+        return Batch(self.seq[index], self.qual[index], self.lengths[index], self.adapters[index])
+
+    @classmethod
+    def decode(cls, buf, newlines, records):
+        """ Decode the first records records of buf, given the positions of
+            its newlines. Every line is located with a single vectorised
+            pass over the buffer.
+        """
+        lines = newlines[:records * 4].reshape(records, 4)
+        seq_starts = lines[:, 0] + 1
+        lengths = lines[:, 1] - seq_starts
+        qual_starts = lines[:, 2] + 1
+        if np.any(lines[:, 3] - qual_starts != lengths):
+            sys.exit("fastq_qc: sequence and quality lengths differ")
+
+        # Rows are gathered from a view of every window of width bytes in
+        # the buffer, far faster than indexing each byte individually.
+        width = int(lengths.max())
+        windows = sliding_window_view(np.frombuffer(buf + b"\n" * width, dtype=np.uint8), width)
+        seq = windows[seq_starts]
+        qual = windows[qual_starts]
+        if lengths.min() < width:
+            padding = np.arange(width) >= lengths[:, None]
+            seq[padding] = NEWLINE
+            qual[padding] = NEWLINE
+
+        adapters = np.full(records, -1, dtype=np.int64)
+        found = np.array(sorted(find_all(buf, ADAPTERS)), dtype=np.int64)
+        if len(found):
+            rows = np.searchsorted(seq_starts, found, side="right") - 1
+            # Matches within header or quality lines are ignored.
+            in_seq = (rows >= 0) & (found < lines[np.maximum(rows, 0), 1])
+            rows, first = np.unique(rows[in_seq], return_index=True)
+            adapters[rows] = found[in_seq][first] - seq_starts[rows]
+        return cls(seq, qual, lengths, adapters)
+
+
+
+def read_batches(streams, multiple=1, chunk_size=CHUNK_SIZE):
+    """ Yield a list of Batches, one per binary fastq stream, that contain
+        equal numbers of records, a multiple of multiple.
+    """
+    buffers = [b""] * len(streams)
+    while True:
+        chunks = [stream.read(chunk_size) for stream in streams]
+        eof = not any(chunks)
+        buffers = [buffer + chunk for buffer, chunk in zip(buffers, chunks)]
+        newlines = [np.flatnonzero(np.frombuffer(buffer, dtype=np.uint8) == NEWLINE) for buffer in buffers]
+        records = min(len(n) // 4 for n in newlines)
+        records -= records % multiple
+
+        if records:
+            batches = []
+            for i, (buffer, n) in enumerate(zip(buffers, newlines)):
+                end = n[records * 4 - 1] + 1
+                batches.append(Batch.decode(buffer[:end], n, records))
+                buffers[i] = buffer[end:]
+            yield batches
+
+        if eof:
+            if any(buffers):
+                sys.exit("fastq_qc: truncated fastq or read 1 and read 2 contain different numbers of reads")
+            return
+
+
+
+class ReadQC(object):
+    """ Accumulates the qc statistics of one read of a pair.
+    """
+    def __init__(self):
+        self.reads = 0
+        self.bases = 0
+        self.cycles = 0
+        self.quality_sum = np.zeros(0, dtype=np.int64)
+        self.composition = np.zeros((len(BASES), 0), dtype=np.int64)
+        self.gc = np.zeros(101, dtype=np.int64)
+        self.adapter_positions = np.zeros(0, dtype=np.int64)
+
+    def _extend(self, cycles):
+        if cycles > self.cycles:
+            pad = cycles - self.cycles
+            self.quality_sum = np.pad(self.quality_sum, (0, pad))
+            self.composition = np.pad(self.composition, ((0, 0), (0, pad)))
+            self.adapter_positions = np.pad(self.adapter_positions, (0, pad))
+            self.cycles = cycles
+
+    def add(self, batch):
+        width = batch.seq.shape[1]
+        self._extend(width)
+        # Number of reads that extend to each cycle, the rest are padding.
+        depth = np.bincount(batch.lengths, minlength=width + 1)[::-1].cumsum()[::-1][1:width + 1]
+        padding = len(batch) - depth
+
+        self.reads += len(batch)
+        self.bases += int(batch.lengths.sum())
+        self.quality_sum[:width] += batch.qual.sum(axis=0, dtype=np.int64) - NEWLINE * padding - PHRED_OFFSET * depth
+
+        counts = np.zeros((N, width), dtype=np.int64)
+        gc = np.zeros(len(batch), dtype=np.int64)
+        called = np.zeros(len(batch), dtype=np.int64)
+        for i, base in enumerate(BASES[:N]):
+            matches = batch.seq == base
+            counts[i] = np.count_nonzero(matches, axis=0)
+            per_read = np.count_nonzero(matches, axis=1)
+            called += per_read
+            if base in b"GC":
+                gc += per_read
+        self.composition[:N, :width] += counts
+        # Anything other than ACGT, excluding padding, is counted as N.
+        self.composition[N, :width] += depth - counts.sum(axis=0)
+        percent = np.divide(gc * 100, called, out=np.zeros(len(batch)), where=called > 0)
+        self.gc += np.bincount(np.rint(percent).astype(np.int64)[called > 0], minlength=101)
+
+        positions = batch.adapters[batch.adapters >= 0]
+        self.adapter_positions[:width] += np.bincount(positions, minlength=width)[:width]
+
+    def stats(self):
+        counts = self.composition.sum(axis=0)
+        per_cycle = np.divide(self.composition, counts, out=np.zeros(self.composition.shape), where=counts > 0)
+        adapters = int(self.adapter_positions.sum())
+        return {"reads": self.reads,
+                "bases": self.bases,
+                "mean_quality": round(float(self.quality_sum.sum() / self.bases), 3) if self.bases else 0.0,
+                "mean_quality_per_cycle": [round(float(q), 3) for q in np.divide(self.quality_sum, counts, out=np.zeros(self.cycles), where=counts > 0)],
+                "base_composition_per_cycle": {chr(base): [round(float(f), 5) for f in per_cycle[i]] for i, base in enumerate(BASES)},
+                "n_rate": float(self.composition[N].sum() / self.bases) if self.bases else 0.0,
+                "gc_distribution": {percent: int(n) for percent, n in enumerate(self.gc) if n},
+                "adapter_rate": float(adapters / self.reads) if self.reads else 0.0,
+                "adapter_position": {position: int(n) for position, n in enumerate(self.adapter_positions) if n}}
+
+
+
+def fastq_qc(input_fastqs, stats_file="stats.json", interleaved=False, threads=None):
+    """ Calculate fastq level qc statistics, per read of a pair: per cycle
+        mean quality and base composition, N rate, GC distribution and the
+        rate and position of adapter read-through, plus the duplicate rate
+        of pairs estimated from a hash based sample. Fastqs are decoded a
+        chunk at a time into numpy matrices with no per read python code.
+        Non-interleaved fastqs must be ordered read 1 then read 2 for each
+        lane. Only reads fastqs, therefore can run alongside alignment.
+    """
+    if interleaved:
+        streams = [open_fastqs(input_fastqs, "rb", threads)]
+    else:
+        if len(input_fastqs) % 2:
+            sys.exit("fastq_qc: fastqs must be supplied as read 1 and read 2 pairs")
+        streams = [open_fastqs(input_fastqs[::2], "rb", threads), open_fastqs(input_fastqs[1::2], "rb", threads)]
+
+    qc = (ReadQC(), ReadQC())
+    seen = HashSet()
+    pairs = 0
+    sampled_pairs = 0
+    try:
+        for batches in read_batches(streams, 2 if interleaved else 1):
+            if interleaved:
+                batches = [batches[0][0::2], batches[0][1::2]]
+            for read_qc, batch in zip(qc, batches):
+                read_qc.add(batch)
+
+            pairs += len(batches[0])
+            hashes = mix(sequence_hash(batches[0].seq, MULTIPLIERS[0]) ^ sequence_hash(batches[1].seq, MULTIPLIERS[1]))
+            sample = hashes[hashes % np.uint64(DUPLICATE_SAMPLING) == 0]
+            if len(sample):
+                seen.add(sample)
+                sampled_pairs += len(sample)
+    finally:
+        for stream in streams:
+            stream.close()
+
+    duplicates = sampled_pairs - len(seen)
+    save_stats(stats_file, {"fastq_qc": {"pairs": pairs,
+                                         "read1": qc[0].stats(),
+                                         "read2": qc[1].stats(),
+                                         "estimated_duplicate_rate": float(duplicates / sampled_pairs) if sampled_pairs else 0.0}})
+
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_fastqs', nargs="+", help="Paths of input fastq or fastq.gz files, read 1 then read 2 of each lane unless interleaved.")
+    parser.add_argument("-s", "--stats", help="Statistics file.", dest="stats_file", default=argparse.SUPPRESS)
+    parser.add_argument("-i", "--interleaved", help="Each input fastq contains alternating reads 1 and 2.", action="store_const", const=True, default=argparse.SUPPRESS)
+    parser.add_argument("-t", "--threads", help="Number of threads to decompress with, defaults to all available threads.", type=int, default=argparse.SUPPRESS)
+    args = parser.parse_args()
+    try:
+        fastq_qc(**vars(args))
+    except OSError as e:
+        # File input/output error. This is not an unexpected error so just
+        # print and exit rather than displaying a full stack trace.
+        sys.exit(str(e))
+
+
+
+if __name__ == "__main__":
+    main()
@@ -5,137 +5,255 @@ import pdb
 import sys
 import argparse
 import glob
-import json
 import csv
+from array import array
+from bisect import bisect_right
+from collections import defaultdict
 
+import numpy as np
 
-from pipeline import run, Pipe
+from pipeline.utils import hash_rank, string2cigar, CONSUMES_REF
 
 
-def multiplexing():
-    """Cell free pipeline.
+
+QNAME = 0
+FLAG = 1
+RNAME = 2
+POS = 3
+MAPQ = 4
+CIGAR = 5
+RNEXT = 6
+PNEXT = 7
+TLEN = 8
+SEQ = 9
+QUAL = 10
+
+UNMAPPED = 0x4
+MATE_UNMAPPED = 0x8
+RC = 0x10
+READ1 = 0x40
+READ2 = 0x80
+SECONDARY = 0X100
+SUPPPLEMENTARY = 0x800
+NON_PRIMARY = SECONDARY | SUPPPLEMENTARY
+BOTH_UNMAPPED = UNMAPPED | MATE_UNMAPPED
+READXRCXUNMAPPEDX = READ1 | READ2 | RC | UNMAPPED
+
+UMIS = ("prism", "thruplex_hv", "thruplex")
+
+COLUMNS = ["sample", "reads", "mean_depth", "mean_family_size", "singleton_rate", "triplicate_plus_rate", "quadruplicate_plus_rate"]
+
+
+
+def cigar_len(cig, ops):
+    return sum(num for num, op in cig if op in ops)
+
+
+
+class Targets(object):
+    """ Merged target regions read from a bed file that can count the
+        number of target bases within any interval.
     """
-    
-    parser = argparse.ArgumentParser()
-    parser.add_argument('input_sam', help="Paths of input sorted undeduplicated sam file.")
-    parser.add_argument("-n", "--name", help="Sample name used to name output files. Will be guessed from input sam if not provide.", default="")
-    parser.add_argument("-u", "--umi", help="UMI type (prism, thruplex_hv or thruplex) or empty strng if no umis.", default="")
-    parser.add_argument("-m", "--min-family-size", help="Minimum family size. Families smaller than this will be filtered", type=int, default=1)
-    parser.add_argument("-l", "--interval", help="Step size to increment downsampling by.", type=int, required=True)
-    parser.add_argument("-r", "--reference", help="Path to reference genome or containing directory.", required=True)
-    parser.add_argument("-p", "--panel", help="Path to covermi panel which must contain targets bedfile.", required=True)
-    parser.add_argument("-o", "--output", help="Path to write output files to.", default=".")
-    args = parser.parse_args()
-    
-    threads = run(["getconf", "_NPROCESSORS_ONLN"]).stdout.strip()
-    
-    if not args.name:
-        args.name = input_sam .split("/")[-1].split(".")[0]
-    
-    args.reference = os.path.abspath(args.reference)
-    args.input_sam = os.path.abspath(args.input_sam)
-    args.panel = os.path.abspath(args.panel)
-    os.chdir(args.output)
-    
-    args.reference = (glob.glob(f"{args.reference}/*.fna") + glob.glob(f"{args.reference}/*.fa") + glob.glob(f"{args.reference}/*.fasta") + [args.reference])[0]
-    ref_dir = os.path.dirname(args.reference)
-    if glob.glob(f"{ref_dir}/*.sa"):
-        bwa = "bwa"
-    elif glob.glob(f"{ref_dir}/*.0123"):
-        bwa = "bwa-mem2"
-    else:
-        sys.exit("Invalid bwa indexes")
-    targets_bedfile = (glob.glob(f"{args.panel}/*.bed") + [None])[0]
-    stats = f"{args.name}.stats.json"
-    pipe = Pipe()
-    output_file = f"{args.name}.multiplexing.tsv"
-    
-    
-    namesorted_sam = f"{args.name}.namesorted.sam"
-    pipe(["samtools", "sort", "-n",
-                                "-o", namesorted_sam,
-                                "-@", threads,
-                                args.input_sam])
-    
-    
-    with open(output_file, "wt") as f_out:
+    def __init__(self, bed_file):
+        regions = defaultdict(list)
+        with open(bed_file, "rt") as f_in:
+            for row in csv.reader(f_in, delimiter="\t"):
+                if not row or row[0].startswith("#") or row[0].startswith("track") or row[0].startswith("browser"):
+                    continue
+                regions[row[0]].append((int(row[1]), int(row[2])))
+
+        self.starts = {}
+        self.ends = {}
+        self.cumulative = {}
+        self.size = 0
+        for chrom, intervals in regions.items():
+            merged = []
+            for start, end in sorted(intervals):
+                if merged and start <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], end)
+                else:
+                    merged.append([start, end])
+            self.starts[chrom] = [start for start, end in merged]
+            self.ends[chrom] = [end for start, end in merged]
+            cumulative = [0]
+            for start, end in merged:
+                cumulative.append(cumulative[-1] + end - start)
+            self.cumulative[chrom] = cumulative
+            self.size += cumulative[-1]
+
+    def _covered(self, chrom, x):
+        # Number of target bases before zero based position x.
+        i = bisect_right(self.starts[chrom], x)
+        if i == 0:
+            return 0
+        return self.cumulative[chrom][i - 1] + min(x, self.ends[chrom][i - 1]) - self.starts[chrom][i - 1]
+
+    def overlap(self, chrom, start, end):
+        """ Number of target bases within the zero based half open
+            interval start to end.
+        """
+        if chrom not in self.starts or end <= start:
+            return 0
+        return self._covered(chrom, end) - self._covered(chrom, start)
+
+
+
+def span(segment):
+    start = int(segment[POS]) - 1
+    return start, start + cigar_len(string2cigar(segment[CIGAR]), CONSUMES_REF)
+
+
+
+def pair_overlap(targets, segment, mate):
+    """ Number of target bases covered by either segment of a pair.
+    """
+    mapped = [span(s) + (s[RNAME],) for s in (segment, mate) if not int(s[FLAG]) & UNMAPPED]
+    bases = sum(targets.overlap(chrom, start, end) for start, end, chrom in mapped)
+    if len(mapped) == 2 and mapped[0][2] == mapped[1][2]:
+        bases -= targets.overlap(mapped[0][2], max(mapped[0][0], mapped[1][0]), min(mapped[0][1], mapped[1][1]))
+    return bases
+
+
+
+def collect_families(input_sam, umi="", targets=None, seed=0):
+    """ Read a position sorted, undeduplicated sam file once and assign
+        every read pair a deterministic random rank and a family, ie the
+        pairs that elduderino would collapse into a single consensus read
+        (same location, orientation and, if umi, RX tag). Returns numpy
+        arrays of the rank and family of each pair and of the number of
+        target bases covered by each family.
+    """
+    if umi and umi not in UMIS:
+        sys.exit(f"'{umi}' is not a valid UMI type")
+
+    ranks = array("Q")
+    family_ids = array("q")
+    overlaps = array("q")
+    families = {}
+    unpaired = {}
+    current_rname = None
+    with open(input_sam, "rt") as f_in:
+        for row in f_in:
+            if row.startswith("@"):
+                continue
+            segment = row.rstrip("\n").split("\t")
+            flag = int(segment[FLAG])
+            if flag & NON_PRIMARY or flag & BOTH_UNMAPPED == BOTH_UNMAPPED:
+                continue
+
+            try:
+                mate = unpaired.pop(segment[QNAME])
+            except KeyError:
+                unpaired[segment[QNAME]] = segment
+                continue
+
+            # All members of a family complete on the same reference,
+            # therefore families need only be remembered until it changes.
+            if segment[RNAME] != current_rname:
+                families = {}
+                current_rname = segment[RNAME]
+
+            mate_flag = int(mate[FLAG])
+            if mate_flag & UNMAPPED:
+                segment, mate = mate, segment
+                flag, mate_flag = mate_flag, flag
+
+            mate_begin = int(mate[POS])
+            if mate_flag & RC:
+                mate_begin += cigar_len(string2cigar(mate[CIGAR]), CONSUMES_REF) - 1
+            if flag & UNMAPPED:
+                segment_begin = mate_begin
+            else:
+                segment_begin = int(segment[POS])
+                if flag & RC:
+                    segment_begin += cigar_len(string2cigar(segment[CIGAR]), CONSUMES_REF) - 1
+            key = (mate[RNAME], mate_begin, segment[RNAME], segment_begin, flag & READXRCXUNMAPPEDX)
+            if umi:
+                for tag in segment[11:]:
+                    if tag.startswith("RX:Z:"):
+                        key += (tag,)
+                        break
+                else:
+                    sys.exit("Missing RX tags")
+
+            try:
+                family = families[key]
+            except KeyError:
+                family = families[key] = len(overlaps)
+                overlaps.append(pair_overlap(targets, segment, mate) if targets is not None else 0)
+            ranks.append(hash_rank(segment[QNAME], seed))
+            family_ids.append(family)
+
+    return np.frombuffer(ranks, dtype=np.uint64), np.frombuffer(family_ids, dtype=np.int64), np.frombuffer(overlaps, dtype=np.int64)
+
+
+
+def saturation(ranks, family_ids, overlaps, levels, min_family_size=1, target_size=0):
+    """ Yield a dict of the metrics at each level, ie number of read pairs,
+        as if the input had been downsampled to that many pairs before
+        deduplication. The pairs with the lowest ranks are retained at each
+        level so that every level is a superset of the previous one and
+        all levels are calculated in a single pass through the rank order.
+    """
+    order = np.argsort(ranks, kind="stable")
+    counts = np.zeros(len(overlaps), dtype=np.int64)
+    previous = 0
+    for level in levels:
+        level = min(level, len(order))
+        counts += np.bincount(family_ids[order[previous:level]], minlength=len(overlaps))
+        previous = level
+
+        sizes = counts[counts > 0]
+        families = len(sizes)
+        reads = int(sizes.sum())
+        passed = counts >= max(min_family_size, 1)
+        yield {"reads": reads,
+               "mean_depth": float(overlaps[passed].sum() / target_size) if target_size else 0.0,
+               "mean_family_size": reads / families if families else 0.0,
+               "singleton_rate": float((sizes == 1).sum() / families) if families else 0.0,
+               "triplicate_plus_rate": float(np.maximum(sizes - 2, 0).sum() / reads) if reads else 0.0,
+               "quadruplicate_plus_rate": float(np.maximum(sizes - 3, 0).sum() / reads) if reads else 0.0}
+
+
+
+def multiplexing(input_sam, panel, interval, name="", umi="", min_family_size=1, output=".", seed=0):
+    """ Calculate the library saturation curve of an undeduplicated sample,
+        ie the family size and depth metrics that would be obtained had it
+        been sequenced to every multiple of interval read pairs, up to the
+        number of pairs available. All points of the curve are derived
+        from a single read of the input.
+    """
+    if not name:
+        name = input_sam.split("/")[-1].split(".")[0]
+    bed_file = (glob.glob(f"{panel}/*.bed") + [panel])[0]
+    targets = Targets(bed_file)
+
+    ranks, family_ids, overlaps = collect_families(input_sam, umi=umi, targets=targets, seed=seed)
+    levels = list(range(interval, len(ranks), interval)) + [len(ranks)]
+
+    with open(os.path.join(output, f"{name}.multiplexing.tsv"), "wt") as f_out:
         writer = csv.writer(f_out)
-        writer.writerow(["sample", "reads", "mean_depth", "mean_family_size", "singleton_rate", "triplicate_plus_rate", "quadruplicate_plus_rate"])
-        
-        requested_reads = 0
-        returned_reads = 0
-        while returned_reads == requested_reads:
-            requested_reads += args.interval
-            
-            
-            downsampled_sam = f"{args.name}.downsampled.sam"
-            cp = pipe(["downsample_sam", "--output", downsampled_sam,
-                                         "--number", requested_reads,
-                                         namesorted_sam], stderr=subprocess.PIPE)
-            returned_reads = int(cp.stderr.decode())
-            
-            
-            sorted_sam = f"{args.name}.sorted.downsampled.sam"
-            pipe(["samtools", "sort", "-o", sorted_sam,
-                                      "-@", threads,
-                                      downsampled_sam])
-            os.unlink(downsampled_sam)
-           
-            
-            deduplicated_fastq = f"{args.name}.deduplicated.fastq"
-            pipe(["elduderino", "--output", deduplicated_fastq,
-                                "--stats", stats,
-                                "--min-family-size", args.min_family_size,
-                                "--umi", args.umi,
-                                sorted_sam])
-            os.unlink(sorted_sam)
-            
-            
-            deduplicated_sam = f"{args.name}.deduplicated.sam"
-            with open(deduplicated_sam, "wb") as f:
-                pipe([bwa, "mem", "-t", threads, 
-                                "-p", # interleaved paired end fastq
-                                "-C", # Append fastq comment to sam
-                                "-Y", # Soft clip non-primary reads
-                                args.reference, 
-                                deduplicated_fastq], stdout=f)
-            os.unlink(deduplicated_fastq)
-
-
-            bam = f"{args.name}.bam"
-            pipe(["samtools", "sort", "-o", bam,
-                                    "-@", threads, 
-                                    deduplicated_sam])
-            os.unlink(deduplicated_sam)
-            
-            
-            pipe(["covermi_stats", "--panel", args.panel,
-                                "--stats", stats,
-                                bam])
-            os.unlink(bam)
-            
-            
-            with open(stats, "rt") as f:
-                data = json.load(f)
-            os.unlink(stats)
-            writer.writerow([args.name,
-                             returned_reads,
-                             data["coverage"]["mean_depth"],
-                             data["mean_family_size"],
-                             data["singleton_rate"],
-                             data["triplicate_plus_rate"],
-                             data["quadruplicate_plus_rate"]])
-            f_out.flush()
-            
-            
-    os.unlink(namesorted_sam)
-    print(pipe.durations, file=sys.stderr, flush=True)
+        writer.writerow(COLUMNS)
+        for metrics in saturation(ranks, family_ids, overlaps, levels, min_family_size=min_family_size, target_size=targets.size):
+            writer.writerow([name] + [metrics[column] for column in COLUMNS[1:]])
 
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_sam', help="Path of input position sorted undeduplicated sam file.")
+    parser.add_argument("-n", "--name", help="Sample name used to name output files. Will be guessed from input sam if not provided.", default=argparse.SUPPRESS)
+    parser.add_argument("-u", "--umi", help="UMI type (prism, thruplex_hv or thruplex) or empty strng if no umis.", default=argparse.SUPPRESS)
+    parser.add_argument("-m", "--min-family-size", help="Minimum family size. Families smaller than this do not contribute to depth.", type=int, default=argparse.SUPPRESS)
+    parser.add_argument("-l", "--interval", help="Step size, in read pairs, to increment downsampling by.", type=int, required=True)
+    parser.add_argument("-p", "--panel", help="Path to covermi panel which must contain targets bedfile, or the bedfile itself.", required=True)
+    parser.add_argument("-r", "--reference", help="Unused, retained for compatibility.", default=argparse.SUPPRESS)
+    parser.add_argument("-s", "--seed", help="Seed for the random order in which read pairs are sampled.", type=int, default=argparse.SUPPRESS)
+    parser.add_argument("-o", "--output", help="Path to write output files to.", default=argparse.SUPPRESS)
+    args = vars(parser.parse_args())
+    args.pop("reference", None)
     try:
-        multiplexing()
+        multiplexing(**args)
     except OSError as e:
         # File input/output error. This is not an unexpected error therfore
         # print and exit rather than displaying a full stack trace.
@@ -145,4 +263,3 @@ def main():
 
 if __name__ == "__main__":
     main()
-
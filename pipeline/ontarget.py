@@ -8,11 +8,11 @@ from itertools import chain
 from collections import Counter, defaultdict
 from multiprocessing import Process, Queue
 from collections.abc import Mapping
-from statistics import mean
 
 from covermi import bed, Gr, Entry
 
 from .utils import run, save_stats, string2cigar, CONSUMES_REF, CONSUMES_READ
+from .cnv import optional_bait_gc, copy_numbers, load_pon, sample_arrays
 
 try:
     from contextlib import nullcontext
@@ -82,6 +82,8 @@ def ontarget(input_sam,
              max_fragment_size=1000,
              retain_offtarget=False,
              cnv = "",
+             reference=None,
+             pon=None,
              threads=0):
 
     threads = 1
@@ -104,6 +106,8 @@ def ontarget(input_sam,
                "max_fragment_size": max_fragment_size,
                "retain_offtarget": retain_offtarget}
     stats = {"fragments_per_target": {bait.name: 0 for bait in targets},
+             "sized_fragments_per_target": {bait.name: 0 for bait in targets},
+             "fragment_size_sum_per_target": {bait.name: 0 for bait in targets},
              "ontarget": 0,
              "offtarget": 0}
     
@@ -172,6 +176,10 @@ def ontarget(input_sam,
     offtarget = stats.pop("offtarget")
     stats["offtarget"] = float(offtarget) / (ontarget + offtarget)
     
+    sized = stats.pop("sized_fragments_per_target")
+    size_sums = stats.pop("fragment_size_sum_per_target")
+    stats["fragment_size_per_target"] = {bait: round(size_sums[bait] / n) if n else 0 for bait, n in sized.items()}
+
     include = set()
     exclude = set()
     for target in cnv.split():
@@ -181,18 +189,12 @@ def ontarget(input_sam,
             include.add(target)
 
     if include:
-        baseline = []
-        depths = defaultdict(list)
-        for bait, depth in stats["fragments_per_target"].items():
-            genes = bait2genes[bait]
-            matches = genes & include
-            for gene in matches:
-                depths[gene].append(depth)
-            if not matches and not genes & exclude:
-                baseline.append(depth)
-        
-        baseline = mean(baseline)
-        stats["copies_per_cell"] = {t: mean(d) / baseline for t, d in depths.items()}
+        baits = list(stats["fragments_per_target"])
+        counts, sizes = sample_arrays(stats, baits)
+        stats.update(copy_numbers(baits, bait2genes, counts, include, exclude,
+                                  gc=optional_bait_gc(reference, baits),
+                                  sizes=sizes,
+                                  pon=load_pon(pon, baits) if pon else None))
 
     save_stats(stats_file, stats)
 
@@ -264,6 +266,9 @@ def _filter_read(read, stats, targets, max_fragment_size, retain_offtarget):
     
     if match:
         stats["fragments_per_target"][match] += 1
+        if size:
+            stats["sized_fragments_per_target"][match] += 1
+            stats["fragment_size_sum_per_target"][match] += size
         stats["ontarget"] += 1
     else:
         stats["offtarget"] += 1
@@ -287,6 +292,9 @@ def main():
     parser.add_argument("-t", "--threads", help="Number of threads to use.", type=int, default=argparse.SUPPRESS)
     parser.add_argument("-c", "--cnv", help="Target names over which to calculate copy numbers. " \
                                                 "names preceeded by - will be excluded from baseline.", default=argparse.SUPPRESS)
+    parser.add_argument("-R", "--reference", help="Reference genome, indexed with samtools faidx, used to correct " \
+                                                  "copy numbers for gc content.", default=argparse.SUPPRESS)
+    parser.add_argument("-P", "--pon", help="Panel of normals, built with cnv, to compare copy numbers against.", default=argparse.SUPPRESS)
     args = parser.parse_args()
     try:
         ontarget(**vars(args))
@@ -0,0 +1,129 @@
+import pdb
+import argparse
+import sys
+import os
+from itertools import chain
+from multiprocessing import Pool
+
+from .stats import load_stats
+
+
+
+# matplotlib and covermi are slow to import and are only needed if a pdf is
+# actually going to be drawn, therefore they are imported within the
+# plotting functions rather than at module level.
+
+def plot_sizes(fragment_sizes, median_fragment_size, name, output, max_fragment_size=1000):
+    from matplotlib.backends.backend_pdf import FigureCanvasPdf, PdfPages
+    from matplotlib.figure import Figure
+
+    with PdfPages(output) as pdf:
+        for contig in chain(["total"], sorted(key for key in fragment_sizes.keys() if key != "total")):
+            if not fragment_sizes[contig]:
+                continue
+
+            title = name if contig == "total" else f"{name} - {contig}"
+            sizes, counts = zip(*sorted(fragment_sizes[contig].items()))
+
+            figure = Figure(figsize=(11.69,8.27))
+            FigureCanvasPdf(figure)
+            ax = figure.gca()
+
+            ax.set_xlim(left=0, right=max_fragment_size or None)
+            ax.plot(sizes, counts, "-", color="dodgerblue", linewidth=1)
+            ax.get_yaxis().set_visible(False)
+            ax.axvline(median_fragment_size[contig], color="black", linewidth=0.5, linestyle=":")
+            ax.set_xlabel("Fragment size (bp)", fontsize=10)
+            ax.set_title(title, fontsize=12)
+
+            pdf.savefig(figure)
+
+
+
+def plot_coverage_by_gene(coverage_by_gene, name, output):
+    from matplotlib.backends.backend_pdf import FigureCanvasPdf, PdfPages
+    from matplotlib.figure import Figure
+
+    depths = sorted((key for key in coverage_by_gene if key != "mean_depth"), key=lambda x:int(x.rstrip("x")))
+    genes = sorted(coverage_by_gene.get("mean_depth", {}))
+    if not genes:
+        return
+
+    with PdfPages(output) as pdf:
+        figure = Figure(figsize=(11.69,8.27))
+        FigureCanvasPdf(figure)
+        ax = figure.gca()
+
+        width = 0.8 / (len(depths) or 1)
+        for i, depth in enumerate(depths):
+            ax.bar([x + (i * width) for x in range(len(genes))],
+                   [coverage_by_gene[depth].get(gene, 0) for gene in genes],
+                   width=width,
+                   label=depth)
+        ax.set_xticks([x + 0.4 - (width / 2) for x in range(len(genes))])
+        ax.set_xticklabels(genes, rotation=90, fontsize=6)
+        ax.set_ylim(bottom=0, top=100)
+        ax.set_ylabel("Bases covered (%)", fontsize=10)
+        ax.legend(fontsize=8)
+        ax.set_title(name, fontsize=12)
+
+        pdf.savefig(figure)
+
+
+
+def report_sample(stats_file, output_dir=".", max_fragment_size=1000):
+    """ Render all of the pdfs that can be drawn from the contents of a
+        single sample's stats file. The sample name is taken from the
+        stats file name.
+    """
+    name = os.path.basename(stats_file).split(".")[0]
+    stats = load_stats(stats_file)
+
+    outputs = []
+    if "fragment_sizes" in stats and "median_fragment_size" in stats:
+        output = os.path.join(output_dir, f"{name}.sizes.pdf")
+        plot_sizes(stats["fragment_sizes"], stats["median_fragment_size"], name, output, max_fragment_size)
+        outputs.append(output)
+
+    if "coverage_by_gene" in stats:
+        output = os.path.join(output_dir, f"{name}.coverage.pdf")
+        plot_coverage_by_gene(stats["coverage_by_gene"], name, output)
+        outputs.append(output)
+    return outputs
+
+
+
+def report(stats_files, output_dir=".", max_fragment_size=1000, threads=1):
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+
+    args = [(stats_file, output_dir, max_fragment_size) for stats_file in stats_files]
+    if threads > 1:
+        with Pool(threads) as pool:
+            outputs = pool.starmap(report_sample, args)
+    else:
+        outputs = [report_sample(*arg) for arg in args]
+
+    for output in chain(*outputs):
+        print(output, file=sys.stderr)
+
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('stats_files', nargs="+", help="Statistics files of samples to be reported.")
+    parser.add_argument("-o", "--output", help="Directory to write pdfs to.", dest="output_dir", default=argparse.SUPPRESS)
+    parser.add_argument("-m", "--max-fragment-size", help="Maximum fragment size to plot.", type=int, default=argparse.SUPPRESS)
+    parser.add_argument("-t", "--threads", help="Number of processes to use.", type=int, default=argparse.SUPPRESS)
+    args = parser.parse_args()
+    try:
+        report(**vars(args))
+    except OSError as e:
+        # File input/output error. This is not an unexpected error so just
+        # print and exit rather than displaying a full stack trace.
+        sys.exit(str(e))
+
+
+
+if __name__ == "__main__":
+    main()
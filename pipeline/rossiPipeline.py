@@ -3,10 +3,13 @@
 import os
 import pdb
 import sys
+import atexit
 import argparse
 import glob
 
-from pipeline import run, Pipe, guess_sample_name, __version__
+from pipeline import run, Pipe, guess_sample_name, compact_stats, merge_stats, __version__
+from pipeline.bwa import resident
+from pipeline.utils import available_threads
 
 
 
@@ -26,14 +29,16 @@ def rossiPipeline():
     parser.add_argument("-f", "--min-vaf", help="Minimum variant allele frequency for a variant to be called when using VarDict.", type=float, default=None)
     parser.add_argument("-a", "--min-alt-reads", help="Minimum number of alt reads for a variant to be called.", type=float, default=2)
     parser.add_argument("-c", "--cnv", help="Whitespace separated list of target names, as specified in targets bedfile, over which to calculate copy number variation.", default="")
+    parser.add_argument("-P", "--pon", help="Panel of normals, built with cnv, against which to compare copy numbers.", default="")
     parser.add_argument("-d", "--sizes", help="Whitespace separated list of reference names over which to calculate fragment size distribution.", default="")
     parser.add_argument("-b", "--translocations", help="Call translocations (supplementary reads aligned to different chromosomes).", action="store_const", const=True, default=False)
     parser.add_argument("-o", "--output", help="Path to write output files to.", default=".")
-    parser.add_argument("-t", "--threads", help="Number of threads to use, defaults to all available threads if not specified.", type=int, default=None)
+    parser.add_argument("-t", "--threads", help="Number of threads to use, defaults to $PIPELINE_THREADS if set otherwise all available threads.", type=int, default=None)
+    parser.add_argument("-N", "--no-plot", help="Only calculate statistics, do not draw pdfs. These can be drawn later from the stats file with report.", action="store_const", const=True, default=False)
     parser.add_argument("-C", "--callers", help="Variant callers to use. Valid values are varscan, vardict and mutect2. Defaults to 'varscan,vardict'.", default="varscan,vardict")
     args = parser.parse_args()
 
-    threads = args.threads or run(["getconf", "_NPROCESSORS_ONLN"]).stdout.strip()
+    threads = args.threads or available_threads()
 
     if not args.name:
         args.name = guess_sample_name(args.input_fastqs)
@@ -52,6 +57,8 @@ def rossiPipeline():
         args.panel = os.path.abspath(args.panel)
     if args.vep:
         args.vep = os.path.abspath(args.vep)
+    if args.pon:
+        args.pon = os.path.abspath(args.pon)
     os.chdir(args.output)
 
     args.reference = (glob.glob(f"{args.reference}/*.fna") + glob.glob(f"{args.reference}/*.fa") + glob.glob(f"{args.reference}/*.fasta") + [args.reference])[0]
@@ -64,49 +71,41 @@ def rossiPipeline():
         sys.exit("Invalid bwa indexes")
     targets_bedfile = (glob.glob(f"{args.panel}/*.bed") + [None])[0] if args.panel else ""
     stats = f"{args.name}.stats.json"
-    pipe = Pipe()    
+    no_plot = ["--no-plot"] if args.no_plot else []
+    pipe = Pipe(log=f"{args.name}.pipe.jsonl", stats=stats)
+    # The steps and stats records are saved even if a step fails as
+    # pipe exits via sys.exit. Exit handlers run in reverse order.
+    atexit.register(compact_stats, stats)
+    atexit.register(pipe.save)
     
     
-    # FastUniq requires ungzipped fastqs
-    ungzipped_fastqs = []
-    temp_fastqs = []
-    for fastq in args.input_fastqs:
-        if fastq.endswith(".gz"):
-            run(["gunzip", "-k", fastq])
-            fastq = fastq[:-3]
-            temp_fastqs.append(fastq)
-        ungzipped_fastqs.append(fastq)
-    
-    if len(ungzipped_fastqs) > 2:
-        with open(f"{args.name}_R1.fastq", "wb") as f_out:
-            pipe(["cat"] + ungzipped_fastqs[::2], stdout=f_out)
-        with open(f"{args.name}_R2.fastq", "wb") as f_out:
-            pipe(["cat"] + ungzipped_fastqs[1::2], stdout=f_out)
-        ungzipped_fastqs = [f"{args.name}_r1.fastq", f"{args.name}_r2.fastq"]
-        for fastq in temp_fastqs:
-            os.unlink(fastq)
-        temp_fastqs = list(ungzipped_fastqs)
-    
-    fastq_names = f"{args.name}.fastqs.txt"
-    with open(fastq_names, "wt") as f_out:
-        f_out.write("{}\n{}\n".format(*ungzipped_fastqs))
-    
+    # Exact duplicate read pairs are removed directly from the gzipped lanes.
     deduplicated_fastqs = [f"{args.name}_R1.deduplicated.fastq", f"{args.name}_R2.deduplicated.fastq"]
-    pipe(["fastuniq", "-i", fastq_names, "-o", deduplicated_fastqs[0], "-p", deduplicated_fastqs[1]])
-    os.unlink(fastq_names)
-    os.unlink(temp_fastqs)
+    pipe(["dedup_fastq", "--output"] + deduplicated_fastqs +
+                         ["--stats", stats,
+                          "--threads", threads] +
+                         args.input_fastqs)
     
     
     # Remove umis and do some basic fastq qc
     interleaved_fastq = f"{args.name}.interleaved.fastq"
+    # udini rewrites its stats file directly, therefore is given its own
+    # which is then merged into the stats records.
+    udini_stats = f"{args.name}.udini.stats.json"
     command = ["udini", "--output", interleaved_fastq,
-                        "--stats", stats,
+                        "--stats", udini_stats,
                         "--umi", args.umi]
     pipe(command + deduplicated_fastqs)
+    merge_stats(stats, udini_stats)
     for fastq in deduplicated_fastqs:
         os.unlink(fastq)
     
     
+    # Shares a single copy of the index between any concurrent or
+    # subsequent jobs on this node if run by sqs_dequeue.
+    resident(bwa, args.reference)
+    
+    
     base_sam = f"{args.name}.base.sam"
     with open(base_sam, "wb") as f_out:
         pipe([bwa, "mem", "-t", threads, 
@@ -128,8 +127,9 @@ def rossiPipeline():
 
     pipe(["size", "--stats", stats,
                   "--rnames", args.sizes,
-                  "--output", f"{args.name}.sizes.pdf",
-                  namesorted_sam])
+                  "--output", f"{args.name}.sizes.pdf"] +
+                  no_plot +
+                  [namesorted_sam])
 
 
     ontarget_sam = f"{args.name}.ontarget.sam"
@@ -137,23 +137,19 @@ def rossiPipeline():
                       "--bed", targets_bedfile,
                       "--stats", stats,
                       "--cnv", args.cnv,
-                      "--threads", threads,
-                      namesorted_sam])
+                      "--reference", args.reference,
+                      "--threads", threads] +
+                      (["--pon", args.pon] if args.pon else []) +
+                      [namesorted_sam])
     os.unlink(namesorted_sam)
 
 
-    # This is likely not necessary
-    namesorted_sam = f"{args.name}.namesorted.sam"
-    pipe(["samtools", "sort", "-n", # sort by name
-                              "-o", namesorted_sam,
-                              "-@", threads,
-                              ontarget_sam])
-    os.unlink(ontarget_sam)
-
-
     fixed_sam = f"{args.name}.fixed.sam"
-    pipe(["samtools", "fixmate", namesorted_sam, fixed_sam])
-    os.unlink(namesorted_sam)
+    pipe(["trim_fixmate", "--output", fixed_sam,
+                          "--no-trim",
+                          "--read-group", args.name,
+                          ontarget_sam])
+    os.unlink(ontarget_sam)
 
 
     if args.translocations:
@@ -161,19 +157,15 @@ def rossiPipeline():
                             fixed_sam])
 
 
-    no_read_groups_bam = f"{args.name}.no_read_groups.bam"
-    pipe(["samtools", "sort", "-o", no_read_groups_bam,
+    # Read groups are added by trim_fixmate as required by Mutect2 and
+    # possibly other gatk tools.
+    bam = f"{args.name}.bam"
+    pipe(["samtools", "sort", "-o", bam,
                               "-@", threads,
                               fixed_sam])
     os.unlink(fixed_sam)
 
 
-    bam = f"{args.name}.bam"
-    # This step is only required to satisfy Mutect2 and possibly other gatk tools
-    pipe(["gatk", "AddOrReplaceReadGroups", f"I={no_read_groups_bam}", f"O={bam}", "LB=lb", "PL=ILLUMINA", "PU=pu", f"SM={args.name}"])
-    os.unlink(no_read_groups_bam)
-
-
     pipe(["samtools", "index", bam])
 
 
@@ -181,7 +173,9 @@ def rossiPipeline():
         pipe(["covermi_stats", "--panel", args.panel,
                                "--output", f"{args.name}.covermi.pdf",
                                "--stats", stats,
-                               bam])
+                               "--threads", threads] +
+                               no_plot +
+                               [bam])
 
 
     pipe(["call_variants", "--reference", args.reference,
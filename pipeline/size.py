@@ -5,11 +5,6 @@ import os
 from collections import Counter, defaultdict
 from itertools import chain
 
-from matplotlib.backends.backend_pdf import FigureCanvasPdf, PdfPages
-from matplotlib.figure import Figure
-from matplotlib.patches import Rectangle
-from matplotlib.backends.backend_pdf import PdfPages
-
 from .utils import run, save_stats, string2cigar, CONSUMES_REF, CONSUMES_READ
 
 
@@ -52,7 +47,8 @@ def do_sizing(input_sam,
               max_fragment_size=1000,
               rnames="",
               name="",
-              output=""):
+              output="",
+              no_plot=False):
 
     contigs = set(rnames.split())
     stats = {"total": Counter()}
@@ -77,39 +73,27 @@ def do_sizing(input_sam,
         size_read(read, stats, contigs, max_fragment_size)
 
 
-    if not name:
-        name = os.path.basename(input_sam).split(".")[0]
-    if not output:
-        output = f"{name}.sizes.pdf"
-    
     median_fragment_size = {}
-    with PdfPages(output) as pdf:
-        for contig in chain(["total"], sorted(key for key in stats.keys() if key != "total")):
-            if not stats[contig]:
-                continue
-            
-            title = name if contig == "total" else f"{name} - {contig}"
-            
-            sizes, counts = zip(*sorted(stats[contig].items()))
-            median_count = sum(counts) // 2
-            for median, count in zip(sizes, counts):
-                median_count -= count
-                if median_count <= 0:
-                    break
-            median_fragment_size[contig] = median
+    for contig in chain(["total"], sorted(key for key in stats.keys() if key != "total")):
+        if not stats[contig]:
+            continue
         
-            figure = Figure(figsize=(11.69,8.27))
-            FigureCanvasPdf(figure)
-            ax = figure.gca()
-            
-            ax.set_xlim(left=0, right=max_fragment_size or None)
-            ax.plot(sizes, counts, "-", color="dodgerblue", linewidth=1)
-            ax.get_yaxis().set_visible(False)
-            ax.axvline(median, color="black", linewidth=0.5, linestyle=":")
-            ax.set_xlabel("Fragment size (bp)", fontsize=10)
-            ax.set_title(title, fontsize=12)
-            
-            pdf.savefig(figure)
+        sizes, counts = zip(*sorted(stats[contig].items()))
+        median_count = sum(counts) // 2
+        for median, count in zip(sizes, counts):
+            median_count -= count
+            if median_count <= 0:
+                break
+        median_fragment_size[contig] = median
+
+    if not no_plot:
+        from .report import plot_sizes
+        
+        if not name:
+            name = os.path.basename(input_sam).split(".")[0]
+        if not output:
+            output = f"{name}.sizes.pdf"
+        plot_sizes(stats, median_fragment_size, name, output, max_fragment_size)
 
     save_stats(stats_file, {"fragment_sizes": stats,
                             "median_fragment_size": median_fragment_size})
@@ -167,6 +151,7 @@ def main():
     parser.add_argument("-r", "--rnames", help="Reference sequence names over which to calculate fragment size distributions.", default=argparse.SUPPRESS)
     parser.add_argument("-o", "--output", help="Output pdf.", dest="output", default=argparse.SUPPRESS)
     parser.add_argument("-n", "--name", help="Sample name.", default=argparse.SUPPRESS)
+    parser.add_argument("-N", "--no-plot", help="Only calculate statistics, do not draw the pdf.", action="store_const", const=True, default=argparse.SUPPRESS)
     args = parser.parse_args()
     try:
         do_sizing(**vars(args))
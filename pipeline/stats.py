@@ -0,0 +1,162 @@
+import os
+import sys
+import json
+import fcntl
+import argparse
+import datetime
+from contextlib import contextmanager
+from collections.abc import Mapping
+
+
+
+__all__ = ["save_stats", "load_stats", "compact_stats", "merge_stats", "rekey"]
+
+
+RECORDS = ".records"
+
+
+
+def rekey(mapping):
+    """ Recursively convert all numeric text keys to integer keys. This will
+        enable correct ordering when re-written to file.
+    """
+    new = {}
+    for k, v in mapping.items():
+        try:
+            k = int(k)
+        except ValueError:
+            pass
+        if isinstance(v, Mapping):
+            v = rekey(v)
+        new[k] = v
+    return new
+
+
+
+@contextmanager
+def locked(path):
+    """ Hold an exclusive lock over all stats files in the directory
+        containing path. The directory itself is locked rather than a
+        separate lock file so that nothing is left behind to be picked up
+        and uploaded along with the real output files.
+    """
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+
+def save_stats(path, update):
+    """ Append update as a single json record to the records file that
+        sits alongside the stats file at path. Neither the stats file nor
+        any previous records are read therefore the cost is independent of
+        the size of the existing stats and concurrent writers cannot lose
+        each other's updates. compact_stats must be called to merge the
+        records into the final stats file.
+    """
+    record = {"tool": os.path.basename(sys.argv[0]),
+              "time": datetime.datetime.now().isoformat(),
+              "stats": update}
+    data = (json.dumps(record) + "\n").encode()
+    with locked(path):
+        fd = os.open(f"{path}{RECORDS}", os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+
+def _load_stats(path):
+    try:
+        with open(path, "rt") as f_in:
+            stats = rekey(json.load(f_in))
+    except FileNotFoundError:
+        stats = {}
+
+    try:
+        with open(f"{path}{RECORDS}", "rt") as f_in:
+            for line in f_in:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Only possible for a record that was being written when
+                    # its writer was killed.
+                    print(f"Skipping incomplete record in {path}{RECORDS}", file=sys.stderr)
+                    continue
+                stats.update(rekey(record["stats"]))
+    except FileNotFoundError:
+        pass
+    return stats
+
+
+
+def load_stats(path):
+    """ Return the stats at path including any records that have not yet
+        been compacted into the stats file. Nothing is written.
+    """
+    with locked(path):
+        return _load_stats(path)
+
+
+
+def compact_stats(path):
+    """ Merge all outstanding records into the stats file. The new stats
+        file is written to a temporary file and atomically renamed over the
+        old one so a reader will never see a partially written file. The
+        merged stats are returned.
+    """
+    with locked(path):
+        stats = _load_stats(path)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wt") as f_out:
+            json.dump(stats, f_out, sort_keys=True, indent=4)
+            f_out.flush()
+            os.fsync(f_out.fileno())
+        os.replace(temp_path, path)
+        try:
+            os.unlink(f"{path}{RECORDS}")
+        except FileNotFoundError:
+            pass
+    return stats
+
+
+
+def merge_stats(path, source):
+    """ Save the contents of the stats file source as a single record of
+        the stats file at path and then delete source. For tools such as
+        udini and elduderino that read, update and rewrite their stats
+        file directly rather than calling save_stats, these must be given
+        their own stats file as their rewrite would otherwise race with
+        the records of any concurrent writers.
+    """
+    try:
+        with open(source, "rt") as f_in:
+            update = json.load(f_in)
+    except FileNotFoundError:
+        return
+    save_stats(path, update)
+    os.unlink(source)
+
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('stats_files', nargs="+", help="Statistics files to be compacted.")
+    args = parser.parse_args()
+    try:
+        for stats_file in args.stats_files:
+            compact_stats(stats_file)
+    except OSError as e:
+        # File input/output error. This is not an unexpected error so just
+        # print and exit rather than displaying a full stack trace.
+        sys.exit(str(e))
+
+
+
+if __name__ == "__main__":
+    main()
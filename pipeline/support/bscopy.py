@@ -4,7 +4,8 @@ import argparse
 import sys
 import re
 
-from pipeline import s3_put, s3_list
+from pipeline import s3_list
+from pipeline.transfer import upload_files
 
 
 
@@ -28,14 +29,17 @@ def bscopy(bsruns, project, include=None, exclude=None, dry_run=False, rename_ru
             prefix = f"projects/{project}/samples/{awsrun}/{sample}"
             
             uploaded = s3_list("omdc-data", prefix)
+            transfers = []
             for fastq in glob.glob(f"{stem}/{sample}/Files/*fastq.gz"):
                 key = "{}/{}".format(prefix.rstrip("/"), os.path.basename(fastq))
                 if key in uploaded:
                     print(f"Already uploaded {fastq}")
                 elif not dry_run:
-                    s3_put("omdc-data", fastq, prefix=prefix)
+                    print("Uploading {} to S3.".format(os.path.basename(fastq)))
+                    transfers.append((fastq, "omdc-data", key))
                 else:
                     print(f"{fastq} -> {prefix}")
+            upload_files(transfers)
 
 
 
@@ -0,0 +1,153 @@
+import os
+import sys
+import json
+import fcntl
+import shutil
+import hashlib
+import subprocess
+from contextlib import contextmanager
+
+
+
+GB = 1024 * 1024 * 1024
+CACHE_SIZE = 200 * GB
+
+COMPLETE = "complete.json"
+
+
+
+@contextmanager
+def flocked(path, operation=fcntl.LOCK_EX):
+    with open(path, "a") as f:
+        fcntl.flock(f, operation)
+        yield f
+
+
+
+def disk_usage(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for fn in files:
+            try:
+                total += os.lstat(os.path.join(root, fn)).st_size
+            except OSError:
+                pass
+    return total
+
+
+
+class BundleCache(object):
+    """ Persistent cache of downloaded and unpacked s3 objects, typically
+        reference genomes, bwa indexes and vep caches, shared by all jobs
+        on an instance. Each object is stored in its own entry directory
+        named after a hash of its url and its s3 ETag so that a modified
+        object is downloaded afresh. Jobs are given a symlink to the
+        unpacked bundle.
+
+        Concurrent jobs are coordinated through flocks. An exclusive lock
+        on an entry is held while it is being downloaded, so a second job
+        needing the same bundle waits and then reuses it. A shared lock is
+        held on every entry in use until the cache object is closed, and
+        entries are only evicted, least recently used first, if an
+        exclusive lock can be obtained without waiting.
+    """
+    def __init__(self, cache_dir, max_size=CACHE_SIZE):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        self.in_use = {}
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def close(self):
+        for f in self.in_use.values():
+            f.close()
+        self.in_use = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def _entries(self):
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if os.path.isdir(path) and os.path.exists(os.path.join(path, COMPLETE)):
+                yield name
+
+    def fetch(self, s3, url, fn, cmd):
+        """ Return the path within the cache of fn, downloading and
+            unpacking url with the shell command cmd, run from within
+            the entry directory, if it is not already present.
+        """
+        bucket, key = url[5:].split("/", 1)
+        etag = s3.head_object(Bucket=bucket, Key=key)["ETag"].strip('"')
+        url_hash = hashlib.sha1(url.encode()).hexdigest()[:16]
+        name = f"{url_hash}-{etag}"
+        entry = os.path.join(self.cache_dir, name)
+        complete = os.path.join(entry, COMPLETE)
+
+        if name in self.in_use:
+            return os.path.join(entry, fn)
+
+        f = open(f"{entry}.lock", "a")
+        self.in_use[name] = f
+        fcntl.flock(f, fcntl.LOCK_EX)
+        if not os.path.exists(complete):
+            temp_entry = f"{entry}.tmp"
+            shutil.rmtree(temp_entry, ignore_errors=True)
+            os.makedirs(temp_entry)
+            print(f"Downloading {fn} into cache", file=sys.stderr)
+            retcode = subprocess.run(cmd, shell=True, cwd=temp_entry).returncode
+            if retcode or not os.path.exists(os.path.join(temp_entry, fn)):
+                shutil.rmtree(temp_entry, ignore_errors=True)
+                sys.exit(f"Unable to download {url}")
+            with open(os.path.join(temp_entry, COMPLETE), "wt") as f_out:
+                json.dump({"url": url, "etag": etag, "size": disk_usage(temp_entry)}, f_out)
+            # Remains of an interrupted eviction.
+            shutil.rmtree(entry, ignore_errors=True)
+            os.rename(temp_entry, entry)
+        else:
+            print(f"Using cached {fn}", file=sys.stderr)
+        # Downgrade to a shared lock, held until the job is finished, to
+        # protect the entry from eviction.
+        fcntl.flock(f, fcntl.LOCK_SH)
+        os.utime(complete)
+
+        self.evict(keep=name, url_hash=url_hash)
+        return os.path.join(entry, fn)
+
+    def evict(self, keep, url_hash):
+        with flocked(os.path.join(self.cache_dir, "evict.lock")):
+            entries = []
+            total = 0
+            for name in self._entries():
+                complete = os.path.join(self.cache_dir, name, COMPLETE)
+                try:
+                    with open(complete, "rt") as f_in:
+                        size = json.load(f_in)["size"]
+                    last_used = os.stat(complete).st_mtime
+                except (OSError, ValueError, KeyError):
+                    continue
+                total += size
+                # Superseded versions of the same object are evicted first.
+                stale = name.startswith(f"{url_hash}-") and name != keep
+                entries.append((not stale, last_used, size, name))
+
+            for fresh, last_used, size, name in sorted(entries):
+                if fresh and total <= self.max_size:
+                    break
+                if name == keep:
+                    continue
+                entry = os.path.join(self.cache_dir, name)
+                with open(f"{entry}.lock", "a") as f:
+                    try:
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        # In use by another job.
+                        continue
+                    print(f"Evicting {name} from cache", file=sys.stderr)
+                    os.unlink(os.path.join(entry, COMPLETE))
+                    shutil.rmtree(entry, ignore_errors=True)
+                    # The lock file is left in place as another job may
+                    # already be waiting on it.
+                total -= size
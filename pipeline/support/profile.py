@@ -2,81 +2,245 @@
 
 import os
 import sys
+import stat
 import subprocess
 import csv
 import time
+from collections import defaultdict
 
 
 
-class Cpu(object):
-    def __init__(self):
-        table = top_table()
-        user_i = table[0].index(" USER")
-        self.pre_existing_pids = set(row[:user_i].strip() for row in table[1:])
-        
-    
-    def usage(self):
-        names = set()
-        cpu_total = 0
-        
-        table = top_table()
-        pid_stop = table[0].index(" USER")
-        cpu_start = table[0].index(" S ", pid_stop) + 3
-        cpu_stop = table[0].index("%CPU", cpu_start) + 4
-        command_start = table[0].index("COMMAND", cpu_stop)
-        for row in table[1:]:
-            if row[:pid_stop].strip() not in self.pre_existing_pids:
-                name = row[command_start:]
-                if name != "top":
-                    cpu = float(row[cpu_start:cpu_stop])
-                    if cpu > 0:
-                        names.add(name)
-                        cpu_total += cpu
-        return [round(cpu_total), ",".join(sorted(names))]
-
-
-
-def run(cmd):
-    return subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, universal_newlines=True)
-
-
-
-def storage():
-    table = run("df").stdout.splitlines()
-    used_i = table[0].index("1K-blocks") + 10
-    avail_i = table[0].index(" Available", used_i)
-    used = 0
-    for row in table[1:]:
-        used += int(row[used_i:avail_i])
-    return round(used / 1024)
+INTERVAL = 1.0
+MB = 1024 * 1024
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+
+def read_proc(pid, name):
+    try:
+        with open(f"/proc/{pid}/{name}", "rb") as f:
+            return f.read().decode(errors="replace")
+    except OSError:
+        # Process has exited or, for io, belongs to another user.
+        return ""
+
+
+
+def process_table():
+    """ Return {pid: (ppid, cpu_ticks)} for every process on the system,
+        read from /proc/<pid>/stat.
+    """
+    table = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            stat = read_proc(entry, "stat")
+            if stat:
+                # The command name is in brackets and may contain spaces.
+                fields = stat[stat.rindex(")") + 2:].split()
+                table[int(entry)] = (int(fields[1]), int(fields[11]) + int(fields[12]))
+    return table
+
+
+
+def rss(pid):
+    for line in read_proc(pid, "status").splitlines():
+        if line.startswith("VmRSS:"):
+            return int(line.split()[1]) * 1024
+    return 0
+
+
+
+def io(pid):
+    read_bytes = write_bytes = 0
+    for line in read_proc(pid, "io").splitlines():
+        if line.startswith("read_bytes:"):
+            read_bytes = int(line.split()[1])
+        elif line.startswith("write_bytes:"):
+            write_bytes = int(line.split()[1])
+    return read_bytes, write_bytes
+
+
+
+def task_io(pid):
+    """ Return {tid: (read_bytes, write_bytes)} for every thread of pid.
+        Unlike /proc/<pid>/io these exclude the io of exited threads and
+        reaped children, which would otherwise be counted twice as exited
+        processes are retained separately.
+    """
+    try:
+        tids = os.listdir(f"/proc/{pid}/task")
+    except OSError:
+        return {}
+    return {int(tid): io(f"{pid}/task/{tid}") for tid in tids}
+
+
+
+def open_for_writing(pid):
+    """ Return {(device, inode): bytes} of disk used by each regular file
+        that pid has open for writing.
+    """
+    files = {}
+    try:
+        fds = os.listdir(f"/proc/{pid}/fd")
+    except OSError:
+        return files
+    for fd in fds:
+        flags = 0
+        for line in read_proc(pid, f"fdinfo/{fd}").splitlines():
+            if line.startswith("flags:"):
+                flags = int(line.split()[1], 8)
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            try:
+                st = os.stat(f"/proc/{pid}/fd/{fd}")
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode):
+                files[(st.st_dev, st.st_ino)] = st.st_blocks * 512
+    return files
+
+
+
+def step_name(pid):
+    """ Name of a pipeline step as recorded by Pipe, ie the basename of the
+        executable, or of the script if run by an interpreter.
+    """
+    cmdline = [arg for arg in read_proc(pid, "cmdline").split("\0") if arg]
+    if not cmdline:
+        return "unknown"
+    name = os.path.basename(cmdline[0])
+    if name.startswith("python") and len(cmdline) > 1 and not cmdline[1].startswith("-"):
+        name = os.path.basename(cmdline[1])
+    return name
 
 
 
 def memory():
-    return round(int(run("free").stdout.splitlines()[1].split()[2]) / 1024)
+    meminfo = {}
+    with open("/proc/meminfo", "rt") as f:
+        lines = f.read().splitlines()
+    for line in lines:
+        key, val = line.split(":", 1)
+        meminfo[key] = int(val.split()[0]) * 1024
+    return meminfo["MemTotal"] - meminfo.get("MemAvailable", meminfo["MemFree"])
+
+
+
+def storage(paths):
+    used = 0
+    devices = set()
+    for path in paths:
+        stat = os.statvfs(path)
+        device = os.stat(path).st_dev
+        if device not in devices:
+            devices.add(device)
+            used += (stat.f_blocks - stat.f_bfree) * stat.f_frsize
+    return used
+
+
+
+class Profiler(object):
+    """ Samples the cpu, memory and io of the process tree rooted at pid
+        directly from /proc. Every descendant is attributed to the step
+        (ie the Pipe command) that is its ancestor among the children of
+        the root process. io is read per thread and the counters of
+        threads that have exited are retained so that the io of each step
+        is cumulative. The disk usage of a step is the size of the files
+        it has open for writing.
+    """
+    def __init__(self, pid):
+        self.pid = pid
+        self.last_time = time.monotonic()
+        self.last_ticks = {}
+        self.last_io = {}
+        self.steps = {}
+        self.finished_io = defaultdict(lambda:[0, 0])
 
+    def sample(self):
+        now = time.monotonic()
+        elapsed = max(now - self.last_time, 1e-6)
+        self.last_time = now
+        table = process_table()
 
+        children = defaultdict(list)
+        for pid, (ppid, ticks) in table.items():
+            children[ppid].append(pid)
 
-def top_table():
-    return run(f"top -bn1 -w 512 -u `whoami`").stdout.splitlines()[6:]
+        # Map every descendant of the root to its step.
+        owners = {self.pid: self.pid}
+        stack = [self.pid]
+        while stack:
+            parent = stack.pop()
+            for pid in children[parent]:
+                owners[pid] = pid if parent == self.pid else owners[parent]
+                stack.append(pid)
+
+        usage = defaultdict(lambda:{"processes": 0, "cpu": 0.0, "rss": 0, "read": 0, "write": 0, "disk": 0})
+        ticks = {}
+        current_io = {}
+        written = defaultdict(dict)
+        for pid, step in owners.items():
+            if pid not in table:
+                continue
+            if step not in self.steps:
+                self.steps[step] = "root" if step == self.pid else step_name(step)
+            ticks[pid] = table[pid][1]
+            row = usage[step]
+            row["processes"] += 1
+            row["cpu"] += 100 * (ticks[pid] - self.last_ticks.get(pid, ticks[pid])) / CLOCK_TICKS / elapsed
+            row["rss"] += rss(pid)
+            for tid, (read_bytes, write_bytes) in task_io(pid).items():
+                current_io[(pid, tid)] = (step, (read_bytes, write_bytes))
+                row["read"] += read_bytes
+                row["write"] += write_bytes
+            # Files open in several processes of a step are counted once.
+            written[step].update(open_for_writing(pid))
+
+        for step, files in written.items():
+            usage[step]["disk"] = sum(files.values())
+
+        for task, (step, (read_bytes, write_bytes)) in self.last_io.items():
+            if task not in current_io:
+                self.finished_io[step][0] += read_bytes
+                self.finished_io[step][1] += write_bytes
+        for step, (read_bytes, write_bytes) in self.finished_io.items():
+            if step in usage:
+                usage[step]["read"] += read_bytes
+                usage[step]["write"] += write_bytes
+
+        self.last_ticks = ticks
+        self.last_io = current_io
+        return {step: dict(row, name=self.steps[step]) for step, row in usage.items()}
 
 
 
 def main():
     """ Wrapper around a pipeline (or any other script) to profile
-        the running code and record memory, cpu and storage usage
-        every 5 seconds and store the output in a tsv file. If an 
-        --output (-o) argument is present then the tsv file is stored
-        in that directory, otherwise the current working directory is
-        used. The tsv file is named after the --name (-n) argument if
-        present or the first positional argument if not preceeded by
-        any keyword arguments.
+        the running code and record memory, cpu, io and storage usage
+        every second and store the output in a tsv file. Measurements
+        are read directly from /proc. If an --output (-o) argument is
+        present then the tsv file is stored in that directory, otherwise
+        the current working directory is used. The tsv file is named
+        after the --name (-n) argument if present or the first positional
+        argument if not preceeded by any keyword arguments. A second tsv
+        file records the usage of each step (child process) of the
+        pipeline, including the disk used by the files it is writing.
+        The sampling interval in seconds can be changed with
+        --profile-interval.
     """
     args = sys.argv[1:]
+    interval = INTERVAL
+    if "--profile-interval" in args:
+        i = args.index("--profile-interval")
+        try:
+            interval = float(args[i + 1])
+        except (IndexError, ValueError):
+            sys.exit("profile: --profile-interval requires a number of seconds")
+        del args[i:i + 2]
+
     if len(args) == 0:
         sys.exit("profile: No command line arguments")
     command = args[0]
-    
+
     try:
         i = args.index("-o")
     except ValueError:
@@ -88,7 +252,7 @@ def main():
         output_dir = args[i + 1]
     else:
         output_dir = "."
-        
+
     try:
         i = args.index("-n")
     except ValueError:
@@ -102,25 +266,39 @@ def main():
         name = args[1].split("/")[-1].split(".")[0]
     else:
         name = "script"
-    
-    with open(os.path.join(output_dir, f"{name}.{command}.profile.tsv"), "wt", newline="") as f:
+
+    storage_paths = [".", output_dir] if os.path.exists(output_dir) else ["."]
+    with open(os.path.join(output_dir, f"{name}.{command}.profile.tsv"), "wt", newline="") as f, \
+         open(os.path.join(output_dir, f"{name}.{command}.steps.tsv"), "wt", newline="") as f_steps:
         out_tsv = csv.writer(f, delimiter="\t")
-        out_tsv.writerow(["time(s)", "storage(MB)", "memory(MB)", "cpu(%)", "processes"])
+        out_tsv.writerow(["time(s)", "storage(MB)", "memory(MB)", "cpu(%)", "rss(MB)", "read(MB)", "write(MB)", "processes"])
+        steps_tsv = csv.writer(f_steps, delimiter="\t")
+        steps_tsv.writerow(["time(s)", "pid", "step", "processes", "cpu(%)", "rss(MB)", "read(MB)", "write(MB)", "disk(MB)"])
 
-        cpu = Cpu()
-        base_storage = storage()
+        base_storage = storage(storage_paths)
         base_memory = memory()
-        base_time = int(time.time())
+        base_time = time.monotonic()
         retcode = None
         process = subprocess.Popen(args)
+        profiler = Profiler(process.pid)
         while retcode is None:
-            out_tsv.writerow([int(time.time()) - base_time, storage() - base_storage, memory() - base_memory] + cpu.usage())
-            time.sleep(5)
+            elapsed = round(time.monotonic() - base_time, 2)
+            usage = profiler.sample()
+            total = defaultdict(float)
+            for pid, row in sorted(usage.items()):
+                for key in ("cpu", "rss", "read", "write"):
+                    total[key] += row[key]
+                steps_tsv.writerow([elapsed, pid, row["name"], row["processes"], round(row["cpu"]),
+                                    round(row["rss"] / MB), round(row["read"] / MB), round(row["write"] / MB), round(row["disk"] / MB)])
+            names = ",".join(sorted(set(row["name"] for row in usage.values() if row["name"] != "root")))
+            out_tsv.writerow([elapsed, round((storage(storage_paths) - base_storage) / MB), round((memory() - base_memory) / MB),
+                              round(total["cpu"]), round(total["rss"] / MB), round(total["read"] / MB), round(total["write"] / MB), names])
+            time.sleep(interval)
             retcode = process.poll()
-    
+
     sys.exit(retcode)
-        
-        
+
+
 
 if __name__ == "__main__":
     main()
@@ -5,8 +5,10 @@ import subprocess
 import sys
 import tempfile
 import shlex
+import signal
 
-import boto3
+from pipeline.transfer import client, upload_files
+from pipeline.support.bundle_cache import BundleCache, GB, CACHE_SIZE
 
 
 
@@ -22,8 +24,23 @@ def parse_url(url):
 
 
 
-def download_and_unpack(client, path, destination="."):
+def pop_option(args, option):
+    """ Remove option and its value from args, returning the value or None.
+    """
+    if option not in args:
+        return None
+    i = args.index(option)
+    if i + 1 >= len(args):
+        sys.exit(f"s3_wrap: {option} requires a value")
+    value = args[i + 1]
+    del args[i:i + 2]
+    return value
+
+
+
+def download_and_unpack(client, path, destination=".", cache=None):
     if path[:5].lower() == ("s3://"):
+        url = path
         fn = path.split("/")[-1]
         if fn.endswith(".tar.gz"):
             fn = fn[:-7]
@@ -41,7 +58,13 @@ def download_and_unpack(client, path, destination="."):
             cmd = f"aws s3 cp '{path}' '{fn}'"
         
         path = fn if destination == "." else os.path.join(destination, fn)
-        if not os.path.exists(path):
+        if cache is not None:
+            # Always relink as the cached copy may have been superseded.
+            if os.path.islink(path):
+                os.unlink(path)
+            if not os.path.exists(path):
+                os.symlink(cache.fetch(client, url, fn, cmd), path)
+        elif not os.path.exists(path):
             print(f"Downloading {fn}", file=sys.stderr)
             subprocess.run(cmd, shell=True, cwd=destination)
         
@@ -49,13 +72,36 @@ def download_and_unpack(client, path, destination="."):
 
 
 
-def upload(client, fn, url):
+def run_forwarding_signals(args, **kwargs):
+    """ Run args in a new process group and forward SIGTERM and SIGINT to
+        every process in the group, so that the whole pipeline and not just
+        the immediate child is stopped, but s3_wrap survives to upload any
+        partial output.
+    """
+    process = subprocess.Popen(args, start_new_session=True, **kwargs)
+    def forward(signum, frame):
+        try:
+            os.killpg(process.pid, signum)
+        except ProcessLookupError:
+            pass
+    previous = {signum: signal.signal(signum, forward) for signum in (signal.SIGTERM, signal.SIGINT)}
+    try:
+        return process.wait()
+    finally:
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+
+
+
+def upload(fns, url):
     bucket, key = parse_url(url)
     if not key.endswith("/"):
         key = f"{key}/"
-    key = "{}{}".format(key, os.path.basename(fn))
-    print(f"Uploading {key}.", file=sys.stderr)
-    client.upload_file(fn, bucket, key)
+    transfers = []
+    for fn in fns:
+        transfers.append((fn, bucket, "{}{}".format(key, os.path.basename(fn))))
+        print(f"Uploading {transfers[-1][2]}.", file=sys.stderr)
+    upload_files(transfers)
 
 
 
@@ -76,6 +122,12 @@ def main():
         performed after script completion is the removal of the temp
         output directory and all contained files if they have been
         uploaded to s3.
+        If s3_wrap receives SIGTERM, eg on spot instance interruption,
+        then it is passed on to the script and any output produced so far
+        is still uploaded.
+        If --cache-dir is given then downloaded files are stored in, and
+        symlinked from, a persistent cache shared with other jobs on the
+        same instance, limited to --cache-size gigabytes.
     """
     args = sys.argv[1:]
     if len(args) == 0:
@@ -91,6 +143,9 @@ def main():
         args.remove("--no-profile")
         profile = []
     
+    cache_dir = pop_option(args, "--cache-dir")
+    cache_size = pop_option(args, "--cache-size")
+    cache_size = int(float(cache_size) * GB) if cache_size is not None else CACHE_SIZE
     
     s3_destination = None
     try:
@@ -124,31 +179,34 @@ def main():
     else:
         name = "script"
     
-    s3 = boto3.client("s3")
+    s3 = client("s3")
+    cache = BundleCache(cache_dir, cache_size) if cache_dir is not None else None
     for i, arg in enumerate(list(args)):
         if arg.lower().startswith("s3://"):
-            args[i] = download_and_unpack(s3, arg)
+            args[i] = download_and_unpack(s3, arg, cache=cache)
     
     if no_log:
-        retcode = subprocess.run(profile + args).returncode
+        retcode = run_forwarding_signals(profile + args)
     else:
         with open(os.path.join(output_dir, f"{name}.{command}.log.txt"), "wb") as log:
             log.write(" ".join(shlex.quote(arg) for arg in args).encode())
             log.write("\n".encode())
             log.flush()
-            retcode = subprocess.run(profile + args, stderr=subprocess.STDOUT, stdout=log).returncode
+            retcode = run_forwarding_signals(profile + args, stderr=subprocess.STDOUT, stdout=log)
             if retcode != 0:
                 msg = f"PROCESS EXITED WITH RETURN CODE {retcode}\n"
                 log.write(msg.encode())
     
     if s3_destination is not None:
-        for fn in os.listdir(output_dir):
-            fn = os.path.join(output_dir, fn)
-            if os.path.isfile(fn):
-                upload(s3, fn, s3_destination)
-                os.unlink(fn)
+        fns = [os.path.join(output_dir, fn) for fn in os.listdir(output_dir)]
+        fns = [fn for fn in fns if os.path.isfile(fn)]
+        upload(fns, s3_destination)
+        for fn in fns:
+            os.unlink(fn)
         os.rmdir(output_dir)
     
+    if cache is not None:
+        cache.close()
     sys.exit(retcode)
 
 
@@ -4,61 +4,223 @@ import os
 import subprocess
 import json
 import shlex
+import shutil
 import sys
+import tempfile
+import time
+import signal
+import threading
+import argparse
 
-import boto3
+import requests
 
-from pipeline import mount_instance_storage, am_i_an_ec2_instance, boto3_client
+from pipeline import mount_instance_storage, am_i_an_ec2_instance, boto3_client, run
+from pipeline.aws import spot_interuption
+from pipeline import bwa
+from pipeline.utils import THREADS
 
 
 
-def main():
+GB = 1024 * 1024 * 1024
+
+CPUS_PER_JOB = 8
+MEMORY_PER_JOB = 16
+VISIBILITY_TIMEOUT = 600
+POLL_INTERVAL = 5
+
+# Spot instances receive two minutes warning of interruption, leave enough
+# time for partial outputs to be uploaded.
+SPOT_POLL_INTERVAL = 5
+INTERRUPTION_GRACE = 90
+
+
+
+class Job(object):
+    def __init__(self, message, command, cache, env=None):
+        self.message = message
+        self.receipt_handle = message["ReceiptHandle"]
+        self.directory = tempfile.mkdtemp(prefix="job", dir=".")
+        self.process = subprocess.Popen(["s3_wrap"] + command + cache, cwd=self.directory, env=env)
+        self.heartbeat = time.monotonic()
+
+
+
+class SpotMonitor(threading.Thread):
+    """ Background thread that polls the instance metadata for a pending
+        spot interruption and sets the interrupted event if there is one.
+    """
+    def __init__(self, interval=SPOT_POLL_INTERVAL):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.interrupted = threading.Event()
+        self.action = {}
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.action = spot_interuption()
+            except (requests.exceptions.RequestException, ValueError):
+                # ValueError if the response is not valid json.
+                self.action = {}
+            if self.action:
+                self.interrupted.set()
+                return
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+
+
+
+def requeue(sqs, queue_url, running, grace=INTERRUPTION_GRACE):
+    """ Stop all running jobs, allowing them up to grace seconds to upload
+        their partial outputs. The messages of jobs that completed
+        successfully are deleted and those of jobs that failed or are still
+        running are made immediately visible to other workers.
+    """
+    for job in running:
+        job.process.send_signal(signal.SIGTERM)
+    deadline = time.monotonic() + grace
+    for job in running:
+        try:
+            job.process.wait(timeout=max(0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            pass
+        try:
+            if job.process.returncode == 0:
+                sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=job.receipt_handle)
+            else:
+                sqs.change_message_visibility(QueueUrl=queue_url,
+                                              ReceiptHandle=job.receipt_handle,
+                                              VisibilityTimeout=0)
+        except sqs.exceptions.QueueDoesNotExist:
+            pass
+
+
+
+def cpu_count():
+    return int(run(["getconf", "_NPROCESSORS_ONLN"]).stdout.strip())
+
+
+
+def default_jobs(cpus_per_job, memory_per_job):
+    """ Number of jobs that can run concurrently without oversubscribing
+        either the cpus or the memory of this machine.
     """
+    cpus = cpu_count()
+    memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / GB
+    return max(1, min(cpus // cpus_per_job, int(memory // memory_per_job)))
+
+
+
+def sqs_dequeue(queue, jobs=None, cpus_per_job=CPUS_PER_JOB, memory_per_job=MEMORY_PER_JOB, visibility_timeout=VISIBILITY_TIMEOUT):
+    """ Run the commands contained in the messages of an sqs queue, each
+        within s3_wrap and in its own subdirectory of the working
+        directory, until the queue is empty. Up to jobs commands are run
+        concurrently. The visibility of the message of every running job
+        is repeatedly extended so that it is not redelivered to another
+        worker however long the job takes, but will be if this worker
+        dies. Messages are deleted once their job completes.
+        On an ec2 instance the metadata is polled for spot interruption
+        in which case running jobs are stopped and their messages returned
+        to the queue. Jobs may leave their bwa index resident in shared
+        memory for use by later jobs, it is released once the queue has
+        drained. The cpus are shared between the concurrent jobs via
+        PIPELINE_THREADS in the environment of each job which the
+        pipelines use as their default number of threads.
     """
     print("Starting sqs_dequeue...", file=sys.stderr)
-    
-    args = sys.argv[1:]
-    if len(args) == 0:
-        sys.exit("sqs_dequeue: No queue specified")
     sqs = boto3_client("sqs")
-    queue_url = sqs.get_queue_url(QueueName=args[0])["QueueUrl"]
-    
+    queue_url = sqs.get_queue_url(QueueName=queue)["QueueUrl"]
+
+    cache = []
+    monitor = SpotMonitor()
     if am_i_an_ec2_instance():
         os.chdir(mount_instance_storage())
-    
+        cache = ["--cache-dir", os.path.abspath("bundle_cache")]
+        monitor.start()
+
+    if jobs is None:
+        jobs = default_jobs(cpus_per_job, memory_per_job)
+    threads = max(1, cpu_count() // jobs)
+    print(f"Running up to {jobs} concurrent jobs of {threads} threads.", file=sys.stderr)
+    heartbeat_interval = visibility_timeout / 3
+    os.environ[bwa.SHM] = "1"
+    env = dict(os.environ, **{THREADS: str(threads)})
+
+    running = []
     while True:
-        if any(os.path.isfile(fn) for fn in os.listdir()):
-            sys.exit("sqs_dequeue: Working directory not empty")
-        
-        response = sqs.receive_message(QueueUrl=queue_url, WaitTimeSeconds=20)
+        if monitor.interrupted.is_set():
+            print(f"sqs_dequeue: Spot interruption {monitor.action}, requeueing {len(running)} jobs", file=sys.stderr)
+            requeue(sqs, queue_url, running)
+            bwa.release()
+            sys.exit(1)
+
+        for job in list(running):
+            if job.process.poll() is not None:
+                running.remove(job)
+                shutil.rmtree(job.directory, ignore_errors=True)
+                try:
+                    sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=job.receipt_handle)
+                except sqs.exceptions.QueueDoesNotExist:
+                    # Happens if the queue is purged while a job is in progress.
+                    pass
+
+        now = time.monotonic()
+        for job in running:
+            if now - job.heartbeat > heartbeat_interval:
+                try:
+                    sqs.change_message_visibility(QueueUrl=queue_url,
+                                                  ReceiptHandle=job.receipt_handle,
+                                                  VisibilityTimeout=visibility_timeout)
+                except sqs.exceptions.QueueDoesNotExist:
+                    pass
+                job.heartbeat = now
+
+        if len(running) >= jobs:
+            time.sleep(POLL_INTERVAL)
+            continue
+
+        # Only long poll if there is nothing else to do. The queue keeps
+        # being polled while jobs are running as more messages may arrive,
+        # it is only drained once a poll is empty with nothing running.
+        response = sqs.receive_message(QueueUrl=queue_url,
+                                       VisibilityTimeout=visibility_timeout,
+                                       WaitTimeSeconds=POLL_INTERVAL if running else 20)
         if "Messages" not in response:
-            break
-        
+            if not running:
+                break
+            continue
+
         message = response["Messages"][0]
         command = json.loads(message["Body"])
         if not isinstance(command, list):
-            print('sqs_dequeue: Malformed message "{command}"', file=sys.stderr)
+            print(f'sqs_dequeue: Malformed message "{command}"', file=sys.stderr)
             continue
-        
+
         print(" ".join(shlex.quote(token) for token in command), file=sys.stderr)
-        subprocess.run(["s3_wrap"] + command)
-        
-        for fn in os.listdir():
-            if os.path.isfile(fn):
-                 os.unlink(fn)
-        
-        try:
-            response = sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=message["ReceiptHandle"])
-        except sqs.exceptions.QueueDoesNotExist:
-            # Happens if the queue is purged while a job is in progress.
-            pass
-    
+        running.append(Job(message, command, cache, env))
+
+    monitor.stop()
+    bwa.release()
     print("Complete.", file=sys.stderr)
 
 
 
-if __name__ == "__main__":
-    main()
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("queue", help="Name of the sqs queue.")
+    parser.add_argument("-j", "--jobs", help="Number of jobs to run concurrently, by default derived from " \
+                                             "the cpus and memory available.", type=int, default=argparse.SUPPRESS)
+    parser.add_argument("-c", "--cpus-per-job", help=f"Cpus required by each job (default {CPUS_PER_JOB}).", type=int, default=argparse.SUPPRESS)
+    parser.add_argument("-m", "--memory-per-job", help=f"Memory in GB required by each job (default {MEMORY_PER_JOB}).", type=float, default=argparse.SUPPRESS)
+    parser.add_argument("-v", "--visibility-timeout", help=f"Message visibility timeout in seconds, extended while the " \
+                                                           f"job is running (default {VISIBILITY_TIMEOUT}).", type=int, default=argparse.SUPPRESS)
+    args = parser.parse_args()
+    sqs_dequeue(**vars(args))
 
 
 
+if __name__ == "__main__":
+    main()
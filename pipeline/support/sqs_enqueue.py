@@ -1,11 +1,26 @@
 from collections import defaultdict
+import os
 import json
 import sys
 import pdb
 import shlex
+import time
+import hashlib
 
 from pipeline.aws import s3_list, s3_exists
-import boto3
+from pipeline.transfer import client
+
+
+
+LIST_THREADS = 16
+BATCH_SIZE = 10
+MAX_ATTEMPTS = 3
+
+# Listings are cached locally for dry runs, so that a command can be
+# repeatedly checked without relisting the whole project.
+MANIFEST_DIR = os.path.join(os.path.expanduser("~"), ".cache", "sqs_enqueue")
+MANIFEST_MAX_AGE = 3600
+
 
 
 def pop(arguments, *args, nargs=2, required=False):
@@ -36,6 +51,50 @@ def parse_url(url):
 
 
 
+def list_keys(url, extension, use_manifest=False):
+    """ Return a sorted list of the keys below url with extension. The
+        listing is always written to the manifest cache but only read from
+        it if use_manifest and it is less than MANIFEST_MAX_AGE old.
+    """
+    bucket, stem = parse_url(url)
+    digest = hashlib.sha1(f"{url}\t{extension}".encode()).hexdigest()
+    manifest = os.path.join(MANIFEST_DIR, f"{digest}.json")
+    if use_manifest:
+        try:
+            if time.time() - os.stat(manifest).st_mtime < MANIFEST_MAX_AGE:
+                with open(manifest, "rt") as f_in:
+                    return json.load(f_in)
+        except (OSError, ValueError):
+            pass
+    
+    keys = sorted(s3_list(bucket, stem, extension=extension, threads=LIST_THREADS))
+    try:
+        os.makedirs(MANIFEST_DIR, exist_ok=True)
+        with open(f"{manifest}.{os.getpid()}.tmp", "wt") as f_out:
+            json.dump(keys, f_out)
+        os.replace(f"{manifest}.{os.getpid()}.tmp", manifest)
+    except OSError:
+        pass
+    return keys
+
+
+
+def send_messages(sqs, queue_url, messages):
+    """ Send messages in batches of BATCH_SIZE, retrying any that fail.
+    """
+    for i in range(0, len(messages), BATCH_SIZE):
+        entries = [{"Id": str(n), "MessageBody": message} for n, message in enumerate(messages[i:i + BATCH_SIZE])]
+        for attempt in range(MAX_ATTEMPTS):
+            response = sqs.send_message_batch(QueueUrl=queue_url, Entries=entries)
+            failed = set(failure["Id"] for failure in response.get("Failed", ()))
+            entries = [entry for entry in entries if entry["Id"] in failed]
+            if not entries:
+                break
+        else:
+            sys.exit(f"sqs_enqueue: unable to send {len(entries)} messages")
+
+
+
 def main():
     if len(sys.argv) < 3:
         sys.exit("sqs_enqueue: too few arguments")
@@ -45,6 +104,7 @@ def main():
     
     # remove options meant for sqs_enqueue rather tha target prorgam
     dry_run = pop(args, "--dry-run", nargs=1)
+    refresh = pop(args, "--refresh", nargs=1)
     single_sample =  pop(args, "--single-sample", nargs=1)
     no_name =  pop(args, "--no-name", nargs=1)
     
@@ -74,39 +134,38 @@ def main():
         output_url = f"{output_url}/"
         
     
-    sqs = boto3.client("sqs")
+    sqs = client("sqs")
     try:
         queue_url = sqs.get_queue_url(QueueName=queue_name)["QueueUrl"]
     except sqs.exceptions.QueueDoesNotExist:
         sys.exit(f'sqs_enqueue: "{queue_name}" is not a valid sqs queue')
     
+    use_manifest = dry_run and not refresh
     bams = set()
-    bucket, stem = parse_url(output_url)
-    for key in s3_list(bucket, stem, extension=output_extension):
+    for key in list_keys(output_url, output_extension, use_manifest):
         identifier = "/".join(key.split("/")[-3:-1])
         bams.add(identifier)
     
     fastqs = defaultdict(list)
     bucket, stem = parse_url(input_url)
-    for key in s3_list(bucket, stem, extension=input_extension):
+    for key in list_keys(input_url, input_extension, use_manifest):
         identifier = "/".join(key.split("/")[-3:-1])
         if identifier not in bams:
             fastqs[identifier] += [f"s3://{bucket}/{key}"]
     
-    n = 0
+    messages = []
     for identifier, samples in sorted(fastqs.items()):
         cmd = [command] + sorted(samples) + args + ["--output", f"{output_url}{identifier}"]
         if not no_name:
             cmd.extend(["--name", identifier.split("/")[-1]])
         print(" ".join(shlex.quote(token) for token in cmd), file=sys.stderr)
-        message = json.dumps(cmd)
-        n += 1
-        if not dry_run:
-            sqs.send_message(QueueUrl=queue_url, MessageBody=message)
+        messages.append(json.dumps(cmd))
         if single_sample:
             break
-
-    print("sqs_enqueue: {} messages {}.".format(n, "processed" if dry_run else "queued"), file=sys.stderr)
+    
+    if not dry_run:
+        send_messages(sqs, queue_url, messages)
+    print("sqs_enqueue: {} messages {}.".format(len(messages), "processed" if dry_run else "queued"), file=sys.stderr)
 
 
 
@@ -0,0 +1,21 @@
+from pipeline.benchmarks import Simulation, write_bed, write_vcf
+from pipeline.benchmarks.runner import run_benchmarks
+
+
+
+def test_simulation_is_deterministic(tmp_path):
+    for run in ("a", "b"):
+        simulation = Simulation(fragments=200, seed=7)
+        simulation.write_sam(str(tmp_path / f"{run}.sam"), sort="position")
+        write_bed(str(tmp_path / f"{run}.bed"), simulation, seed=7)
+        write_vcf(str(tmp_path / f"{run}.vcf"), simulation, caller="mutect2", variants=100, seed=7)
+    for extension in ("sam", "bed", "vcf"):
+        assert (tmp_path / f"a.{extension}").read_bytes() == (tmp_path / f"b.{extension}").read_bytes()
+
+
+
+def test_run_benchmarks():
+    results = run_benchmarks(["filter_vcf"], fragments=100, variants=500, repeats=1)
+    assert results["filter_vcf"]["records"] == 500
+    assert results["filter_vcf"]["records_per_second"] > 0
+    assert results["filter_vcf"]["peak_memory_mb"] > 0
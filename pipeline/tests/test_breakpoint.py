@@ -0,0 +1,48 @@
+import csv
+
+from pipeline.breakpoint import breakpoint
+
+
+
+HEADER = "@HD\tVN:1.6\tSO:queryname\n@SQ\tSN:chr1\tLN:100000\n@SQ\tSN:chr2\tLN:100000\n"
+
+
+
+def segment(qname, flag, rname, pos, cigar, rnext, pnext):
+    return "\t".join([qname, str(flag), rname, str(pos), "60", cigar, rnext, str(pnext), "0", "A" * 100, "F" * 100]) + "\n"
+
+
+
+def read_tsv(path):
+    with open(path, "rt") as f_in:
+        return list(csv.reader(f_in, delimiter="\t"))
+
+
+
+def test_breakpoint_clusters_split_reads_and_discordant_pairs(tmp_path):
+    sam = tmp_path / "sample.sam"
+    rows = [HEADER]
+    # Split reads clipped within a few bases of each other at chr1:1070.
+    for i, offset in enumerate((0, 2, 0)):
+        pos = 1000 + offset
+        rows += [segment(f"split{i}", 0x63, "chr1", pos, "70M30S", "=", pos + 200),
+                 segment(f"split{i}", 0x93, "chr1", pos + 200, "100M", "=", pos),
+                 segment(f"split{i}", 0x863, "chr2", 50001, "70S30M", "chr1", pos + 200)]
+    # Discordant pairs upstream of the same breakpoint.
+    for i in range(2):
+        rows += [segment(f"disc{i}", 0x61, "chr1", 900 + i * 10, "100M", "chr2", 50100),
+                 segment(f"disc{i}", 0x91, "chr2", 50100, "100M", "chr1", 900 + i * 10)]
+    sam.write_text("".join(rows))
+
+    output = str(tmp_path / "translocations.tsv")
+    breakpoint(str(sam), output=output)
+    rows = read_tsv(output)
+    assert rows[0] == ["Location", "Partner", "Split_reads", "Discordant_pairs"]
+    assert rows[1] == ["chr1:1070", "chr2:50001", "3", "2"]
+    assert rows[2][0] == "chr2:50001"
+    assert rows[2][2:] == ["3", "2"]
+    assert len(rows) == 3
+
+    # With compaction after every piece of evidence nothing survives.
+    breakpoint(str(sam), output=output, compact_interval=1)
+    assert len(read_tsv(output)) == 1
@@ -0,0 +1,77 @@
+import os
+
+import pytest
+
+moto = pytest.importorskip("moto")
+
+from pipeline import transfer
+from pipeline.support.bundle_cache import BundleCache
+from pipeline.support.s3_wrap import download_and_unpack
+
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with moto.mock_aws():
+        transfer.reset()
+        s3 = transfer.client("s3")
+        s3.create_bucket(Bucket="refs")
+        yield s3
+    transfer.reset()
+
+
+
+def make_bundle(fn, size):
+    return f"mkdir {fn} && head -c {size} /dev/zero > {fn}/data"
+
+
+
+def test_bundles_are_cached_by_etag(s3, tmp_path):
+    s3.put_object(Bucket="refs", Key="genome", Body=b"version1")
+    cache_dir = str(tmp_path / "cache")
+    with BundleCache(cache_dir) as cache:
+        path = cache.fetch(s3, "s3://refs/genome", "genome", make_bundle("genome", 100))
+        assert os.path.exists(os.path.join(path, "data"))
+        # A second fetch must not rerun the download.
+        assert cache.fetch(s3, "s3://refs/genome", "genome", "false") == path
+
+    s3.put_object(Bucket="refs", Key="genome", Body=b"version2")
+    with BundleCache(cache_dir) as cache:
+        new_path = cache.fetch(s3, "s3://refs/genome", "genome", make_bundle("genome", 100))
+    assert new_path != path
+    # The superseded version is evicted.
+    assert not os.path.exists(path)
+
+
+
+def test_least_recently_used_are_evicted(s3, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    for name in ("a", "b", "c"):
+        s3.put_object(Bucket="refs", Key=name, Body=name.encode())
+    with BundleCache(cache_dir, max_size=2500) as cache:
+        a = cache.fetch(s3, "s3://refs/a", "a", make_bundle("a", 1000))
+        b = cache.fetch(s3, "s3://refs/b", "b", make_bundle("b", 1000))
+    with BundleCache(cache_dir, max_size=2500) as cache:
+        cache.fetch(s3, "s3://refs/a", "a", "false")
+        c = cache.fetch(s3, "s3://refs/c", "c", make_bundle("c", 1000))
+        assert os.path.exists(a) and not os.path.exists(b) and os.path.exists(c)
+
+        # Entries in use by another job are never evicted.
+        with BundleCache(cache_dir, max_size=0) as other:
+            other.fetch(s3, "s3://refs/b", "b", make_bundle("b", 1000))
+        assert os.path.exists(a) and os.path.exists(c)
+
+
+
+def test_download_and_unpack_symlinks_into_job(s3, tmp_path):
+    s3.put_object(Bucket="refs", Key="genome", Body=b"version1")
+    job = tmp_path / "job"
+    job.mkdir()
+    with BundleCache(str(tmp_path / "cache")) as cache:
+        cache.fetch(s3, "s3://refs/genome", "genome", make_bundle("genome", 10))
+        path = download_and_unpack(s3, "s3://refs/genome", destination=str(job), cache=cache)
+    assert os.path.islink(path)
+    assert os.path.exists(os.path.join(path, "data"))
@@ -0,0 +1,105 @@
+import os
+import stat
+
+import pytest
+
+from pipeline import bwa
+
+
+
+# Stands in for bwa shm, keeping the names of resident indices in a file and
+# logging every invocation.
+FAKE_BWA = """#!/bin/sh
+echo "$@" >> {log}
+case "$2" in
+    -l) [ -s {shm} ] || exit 1; cat {shm};;
+    -d) [ -s {shm} ] && [ ! -e {full} ] || exit 1; rm {shm};;
+    *) [ -e {full} ] && {{ echo "shm too small" >&2; exit 1; }}
+       printf "%s\\t1000\\n" "$(basename $2)" >> {shm};;
+esac
+"""
+
+
+
+@pytest.fixture
+def fake_bwa(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    log = tmp_path / "bwa.log"
+    script = bin_dir / "bwa"
+    script.write_text(FAKE_BWA.format(log=log, shm=tmp_path / "shm", full=tmp_path / "full"))
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+    monkeypatch.setattr(bwa, "LOCK", str(tmp_path / "bwa.lock"))
+    monkeypatch.setattr(bwa, "STATE", str(tmp_path / "bwa.json"))
+    monkeypatch.setenv(bwa.SHM, "1")
+
+    def calls():
+        return log.read_text().splitlines() if log.exists() else []
+    return calls
+
+
+
+def reference(path):
+    path.parent.mkdir(exist_ok=True)
+    path.write_text(">chr1\nACGT\n")
+    (path.parent / f"{path.name}.bwt").write_text("index")
+    return str(path)
+
+
+
+def test_index_staged_once_and_released(tmp_path, fake_bwa):
+    ref = reference(tmp_path / "ref" / "genome.fa")
+    assert bwa.resident("bwa", ref)
+    assert bwa.resident("bwa", ref)
+    assert bwa.resident_indices() == {"genome.fa"}
+    assert fake_bwa().count(f"shm {ref}") == 1
+
+    bwa.release()
+    assert bwa.resident_indices() == set()
+    assert "shm -d" in fake_bwa()
+
+
+
+def test_index_with_same_name_is_replaced(tmp_path, fake_bwa):
+    first = reference(tmp_path / "first" / "genome.fa")
+    second = reference(tmp_path / "second" / "genome.fa")
+    bwa.resident("bwa", first)
+    bwa.resident("bwa", second)
+    assert fake_bwa() == ["shm -l", f"shm {first}", "shm -l", "shm -d", f"shm {second}"]
+
+
+
+def test_not_staged_unless_permitted(tmp_path, fake_bwa, monkeypatch):
+    ref = reference(tmp_path / "ref" / "genome.fa")
+    assert not bwa.resident("bwa-mem2", ref)
+    monkeypatch.delenv(bwa.SHM)
+    assert not bwa.resident("bwa", ref)
+    assert fake_bwa() == []
+
+
+
+def test_failure_to_stage_falls_back_to_disk(tmp_path, fake_bwa, capsys):
+    ref = reference(tmp_path / "ref" / "genome.fa")
+    (tmp_path / "full").touch()
+    assert not bwa.resident("bwa", ref)
+    assert "loaded from disk" in capsys.readouterr().err
+    assert bwa.resident_indices() == set()
+    assert bwa.read_state() == {}
+
+    # Staged once shared memory is available.
+    (tmp_path / "full").unlink()
+    assert bwa.resident("bwa", ref)
+    assert bwa.resident_indices() == {"genome.fa"}
+
+
+
+def test_failure_to_replace_leaves_state_unchanged(tmp_path, fake_bwa):
+    first = reference(tmp_path / "first" / "genome.fa")
+    second = reference(tmp_path / "second" / "genome.fa")
+    assert bwa.resident("bwa", first)
+    state = bwa.read_state()
+    (tmp_path / "full").touch()
+    assert not bwa.resident("bwa", second)
+    assert bwa.read_state() == state
+    assert fake_bwa()[-1] == "shm -d"
@@ -0,0 +1,10 @@
+from pipeline.call_variants import split_threads
+
+
+
+def test_split_threads():
+    assert split_threads(["varscan", "vardict"], 10) == {"varscan": 2, "vardict": 8}
+    assert split_threads(["varscan", "vardict", "mutect2"], 64) == {"varscan": 8, "vardict": 32, "mutect2": 24}
+    assert split_threads(["vardict"], 7) == {"vardict": 7}
+    # Every caller runs even if there are fewer threads than callers.
+    assert split_threads(["varscan", "vardict", "mutect2"], 2) == {"varscan": 1, "vardict": 1, "mutect2": 1}
@@ -0,0 +1,86 @@
+import os
+
+import numpy as np
+import pytest
+
+from pipeline import cnv
+from pipeline.cnv import bait_gc, optional_bait_gc, build_pon, copy_numbers, load_pon, normalised_log2
+from pipeline.stats import save_stats
+
+
+
+def write_reference(path, seqs, linebases=60):
+    with open(path, "wt") as f_out, open(f"{path}.fai", "wt") as f_fai:
+        offset = 0
+        for name, seq in seqs.items():
+            header = f">{name}\n"
+            offset += len(header)
+            lines = [seq[i:i + linebases] + "\n" for i in range(0, len(seq), linebases)]
+            f_out.write(header + "".join(lines))
+            f_fai.write(f"{name}\t{len(seq)}\t{offset}\t{linebases}\t{linebases + 1}\n")
+            offset += sum(len(line) for line in lines)
+
+
+
+def test_bait_gc(tmp_path, monkeypatch):
+    monkeypatch.setattr(cnv, "CACHE_DIR", str(tmp_path / "cache"))
+    reference = str(tmp_path / "ref.fa")
+    write_reference(reference, {"chr1": "A" * 100 + "GC" * 50 + "AT" * 50, "chr2": "G" * 200})
+    baits = ["chr1:1-100-GENE1", "chr1:101-200-GENE2", "chr1:151-250-GENE3", "chr2:50-149-GENE4", "chr3:1-10-GENE5"]
+    expected = [0.0, 1.0, 0.5, 1.0]
+    assert bait_gc(reference, baits)[:4].tolist() == expected
+    assert np.isnan(bait_gc(reference, baits)[4])
+    # Second call is served from the cache.
+    assert len(list((tmp_path / "cache").iterdir())) == 1
+    assert bait_gc(reference, baits)[:4].tolist() == expected
+
+
+
+def test_optional_bait_gc_without_index(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(cnv, "CACHE_DIR", str(tmp_path / "cache"))
+    reference = str(tmp_path / "ref.fa")
+    write_reference(reference, {"chr1": "GC" * 50})
+    assert optional_bait_gc(reference, ["chr1:1-100-GENE1"]).tolist() == [1.0]
+    assert optional_bait_gc(None, ["chr1:1-100-GENE1"]) is None
+    os.unlink(f"{reference}.fai")
+    assert optional_bait_gc(reference, ["chr1:11-100-GENE1"]) is None
+    assert "not indexed" in capsys.readouterr().err
+
+
+
+def test_gc_correction_removes_bias():
+    rng = np.random.default_rng(1)
+    gc = rng.uniform(0.3, 0.7, 2000)
+    counts = rng.poisson(1000 * 2 ** (4 * (gc - 0.5)))
+    uncorrected = normalised_log2(counts)
+    corrected = normalised_log2(counts, gc=gc)
+    assert abs(np.corrcoef(gc, uncorrected)[0, 1]) > 0.9
+    assert abs(np.corrcoef(gc, corrected)[0, 1]) < 0.1
+
+
+
+def test_copy_numbers_with_panel_of_normals(tmp_path):
+    rng = np.random.default_rng(2)
+    baits = [f"chr1:{i * 1000 + 1}-{i * 1000 + 120}-GENE{i % 50}" for i in range(500)]
+    bait_genes = {bait: {bait.split("-")[-1]} for bait in baits}
+    # Every bait has its own capture efficiency which the normals share.
+    efficiency = rng.uniform(0.5, 2, len(baits))
+
+    normals = []
+    for n in range(20):
+        path = str(tmp_path / f"normal{n}.stats.json")
+        save_stats(path, {"fragments_per_target": dict(zip(baits, rng.poisson(500 * efficiency).tolist()))})
+        normals.append(path)
+    build_pon(normals, output=str(tmp_path / "pon.npz"))
+    pon = load_pon(str(tmp_path / "pon.npz"), baits[::-1] + ["chr2:1-100-GENE99"])
+    assert pon.shape == (20, 501)
+    assert np.isnan(pon[:, -1]).all()
+
+    amplified = np.array(["GENE7" in bait_genes[bait] for bait in baits])
+    counts = rng.poisson(500 * efficiency * np.where(amplified, 3, 1))
+    result = copy_numbers(baits, bait_genes, counts, include=["GENE7", "GENE8"],
+                          pon=load_pon(str(tmp_path / "pon.npz"), baits))
+    assert result["copies_per_cell"]["GENE7"] == pytest.approx(3, rel=0.1)
+    assert result["copies_per_cell"]["GENE8"] == pytest.approx(1, rel=0.1)
+    assert result["copy_number_zscore"]["GENE7"] > 10
+    assert abs(result["copy_number_zscore"]["GENE8"]) < 5
@@ -0,0 +1,78 @@
+import csv
+
+import numpy as np
+
+from pipeline.cohort import cohort
+from pipeline.stats import save_stats, compact_stats
+
+
+
+def read_tsv(path):
+    with open(path, "rt") as f_in:
+        return list(csv.DictReader(f_in, delimiter="\t"))
+
+
+
+def test_cohort_ingests_only_updated_samples(tmp_path, capsys):
+    samples = tmp_path / "samples"
+    samples.mkdir()
+    output = str(tmp_path / "cohort")
+    for i, name in enumerate(("a", "b", "c")):
+        save_stats(str(samples / f"{name}.stats.json"), {"coverage": {"mean_depth": i}})
+    compact_stats(str(samples / "a.stats.json"))
+    with open(samples / "a.vardict.annotation.tsv", "wt") as f_out:
+        f_out.write("gene\tvaf\nKRAS\t0.1\nTP53\t0.2\n")
+
+    cohort([str(samples)], output_dir=output)
+    assert "4 files ingested" in capsys.readouterr().err
+    table = np.load(f"{output}/cohort.stats.npy")
+    assert sorted(table["sample"]) == ["a", "b", "c"]
+    assert len(np.load(f"{output}/cohort.annotations.npy")) == 2
+
+    # An update that only appends a record to an uncompacted stats file.
+    save_stats(str(samples / "b.stats.json"), {"coverage": {"mean_depth": 10}, "fastq_qc": {"pairs": 5}})
+    cohort([str(samples)], output_dir=output)
+    assert "1 files ingested, 3 unchanged" in capsys.readouterr().err
+    table = np.load(f"{output}/cohort.stats.npy")
+    depths = dict(zip(table["sample"], table["coverage.mean_depth"]))
+    assert depths == {"a": 0, "b": 10, "c": 2}
+    assert np.isnan(table["fastq_qc.pairs"][table["sample"] == "a"]).all()
+    rows = read_tsv(f"{output}/cohort.stats.tsv")
+    assert len(rows) == 3
+    assert {row["sample"]: row["fastq_qc.pairs"] for row in rows} == {"a": "", "b": "5.0", "c": ""}
+
+    # A new sample with the same columns is appended to the tsv.
+    save_stats(str(samples / "d.stats.json"), {"coverage": {"mean_depth": 3}, "fastq_qc": {"pairs": 7}})
+    cohort([str(samples)], output_dir=output)
+    assert "1 files ingested, 4 unchanged" in capsys.readouterr().err
+    rows = read_tsv(f"{output}/cohort.stats.tsv")
+    assert [row["sample"] for row in rows][-1] == "d"
+    assert len(rows) == len(np.load(f"{output}/cohort.stats.npy")) == 4
+
+
+
+def test_cohort_keeps_identifiers_as_text(tmp_path):
+    samples = tmp_path / "samples"
+    samples.mkdir()
+    output = str(tmp_path / "cohort")
+    save_stats(str(samples / "2101.stats.json"), {"coverage": {"mean_depth": 5}})
+    with open(samples / "2101.vardict.annotation.tsv", "wt") as f_out:
+        f_out.write("CHROM\tPOS\tgene\n1\t100\tKRAS\n")
+
+    cohort([str(samples)], output_dir=output)
+    stats = np.load(f"{output}/cohort.stats.npy")
+    assert stats["sample"].tolist() == ["2101"]
+    assert stats["coverage.mean_depth"].tolist() == [5.0]
+    annotations = np.load(f"{output}/cohort.annotations.npy")
+    assert annotations["CHROM"].tolist() == ["1"]
+    assert annotations["POS"].tolist() == ["100"]
+
+    # Still correct once a later sample makes the column non-numeric.
+    with open(samples / "S7.vardict.annotation.tsv", "wt") as f_out:
+        f_out.write("CHROM\tPOS\tgene\nX\t200\tAR\n")
+    cohort([str(samples)], output_dir=output)
+    annotations = np.load(f"{output}/cohort.annotations.npy")
+    assert annotations["CHROM"].tolist() == ["1", "X"]
+    rows = read_tsv(f"{output}/cohort.annotations.tsv")
+    assert [(row["sample"], row["CHROM"]) for row in rows] == [("2101", "1"), ("S7", "X")]
+    assert read_tsv(f"{output}/cohort.stats.tsv")[0]["sample"] == "2101"
@@ -0,0 +1,51 @@
+import os
+import signal
+from types import SimpleNamespace
+
+import pytest
+
+from pipeline import covermi_stats
+from pipeline.covermi_stats import parallel_coverage, NAME, START, STOP
+
+
+
+def fake_block_coverage(bam_path, block):
+    # Every base of each target covered at a depth of 150.
+    results = {}
+    for target in block:
+        bases = target[STOP] - target[START] + 1
+        result = results.setdefault(target[NAME], [0, 0, [0] * len(covermi_stats.DEPTHS)])
+        result[0] += bases
+        result[1] += bases * 150
+        result[2] = [x + (bases if depth <= 150 else 0) for x, depth in zip(result[2], covermi_stats.DEPTHS)]
+    return results
+
+
+
+def killed_block_coverage(bam_path, block):
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+
+def regions():
+    return [SimpleNamespace(chrom="chr1", start=1, stop=100, name="KRAS"),
+            SimpleNamespace(chrom="chr2", start=300, stop=201, name="TP53"),
+            SimpleNamespace(chrom="chr2", start=1001, stop=1100, name="TP53")]
+
+
+
+def test_parallel_coverage(monkeypatch):
+    monkeypatch.setattr(covermi_stats, "block_coverage", fake_block_coverage)
+    stats = parallel_coverage("sample.bam", regions(), 2)
+    assert stats["coverage"]["mean_depth"] == 150
+    assert isinstance(stats["coverage"]["mean_depth"], int)
+    assert stats["coverage"]["100x"] == 100 and stats["coverage"]["500x"] == 0
+    assert stats["coverage_by_gene"]["mean_depth"] == {"KRAS": 150, "TP53": 150}
+
+
+
+def test_parallel_coverage_exits_if_a_worker_is_killed(monkeypatch):
+    monkeypatch.setattr(covermi_stats, "block_coverage", killed_block_coverage)
+    monkeypatch.setattr(covermi_stats, "POLL_INTERVAL", 0.1)
+    with pytest.raises(SystemExit, match="unexpectedly terminated"):
+        parallel_coverage("sample.bam", regions(), 2)
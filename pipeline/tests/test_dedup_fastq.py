@@ -0,0 +1,52 @@
+import gzip
+
+import numpy as np
+
+from pipeline.dedup_fastq import dedup_fastq, HashSet
+from pipeline.stats import load_stats
+
+
+
+def write_fastq(path, sequences, read):
+    with gzip.open(path, "wt") if str(path).endswith(".gz") else open(path, "wt") as f_out:
+        for i, seq in enumerate(sequences):
+            f_out.write(f"@{path.name}_{i} {read}:N:0:1\n{seq}\n+\n{'F' * len(seq)}\n")
+
+
+
+def read_sequences(path):
+    with open(path, "rt") as f_in:
+        return f_in.read().splitlines()[1::4]
+
+
+
+def test_hashset_finds_duplicates_within_and_between_batches():
+    seen = HashSet(size=16)
+    rng = np.random.default_rng(1)
+    hashes = rng.integers(0, 2 ** 63, size=5000, dtype=np.uint64)
+    new = seen.add(np.concatenate([hashes[:3000], hashes[:100]]))
+    assert new.sum() == 3000 and new[:3000].all()
+    new = seen.add(np.concatenate([hashes[2000:], np.zeros(2, dtype=np.uint64)]))
+    assert new.sum() == 2001
+    assert new[1000:2000].all() and new[-2] and not new[-1]
+    assert len(seen) == 5001
+    assert len(seen.table) >= 2 * len(seen)
+
+
+
+def test_dedup_fastq_removes_exact_duplicate_pairs_across_lanes(tmp_path):
+    lane1 = (tmp_path / "s_L001_R1.fastq.gz", tmp_path / "s_L001_R2.fastq.gz")
+    lane2 = (tmp_path / "s_L002_R1.fastq", tmp_path / "s_L002_R2.fastq")
+    write_fastq(lane1[0], ["AAAA", "CCCC", "AAAA", "GGGG"], 1)
+    write_fastq(lane1[1], ["TTTT", "TTTT", "TTTT", "TTTT"], 2)
+    # Read 1 duplicates but read 2 differs, then an exact duplicate of
+    # a pair from the first lane.
+    write_fastq(lane2[0], ["AAAA", "CCCC"], 1)
+    write_fastq(lane2[1], ["TTTA", "TTTT"], 2)
+
+    output = [str(tmp_path / "R1.fastq"), str(tmp_path / "R2.fastq")]
+    stats = str(tmp_path / "stats.json")
+    dedup_fastq([str(path) for path in lane1 + lane2], output, stats_file=stats)
+    assert read_sequences(output[0]) == ["AAAA", "CCCC", "GGGG", "AAAA"]
+    assert read_sequences(output[1]) == ["TTTT", "TTTT", "TTTT", "TTTA"]
+    assert load_stats(stats)["fastq_duplicate_rate"] == 2 / 6
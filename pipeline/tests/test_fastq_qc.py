@@ -0,0 +1,60 @@
+import gzip
+
+import pytest
+
+from pipeline.fastq_qc import fastq_qc
+from pipeline.stats import load_stats
+
+
+
+def write_fastq(path, reads):
+    with gzip.open(path, "wt") as f_out:
+        for i, (seq, qual) in enumerate(reads):
+            f_out.write(f"@read{i}\n{seq}\n+\n{qual}\n")
+
+
+
+def test_fastq_qc(tmp_path):
+    adapter = "AGATCGGAAGAGC"
+    r1 = [("GGGGCCCCAT", "IIIIIIIIII"), ("AAAAAAAAAN", "IIIII#####"), ("GGGGCCCCAT", "IIIIIIIIII"), ("ACGT" + adapter[:6], "IIIIIIIIII")]
+    r2 = [("TTTTTTTTTT", "IIIIIIIIII"), ("TTTTTTTTTT", "IIIIIIIIII"), ("TTTTTTTTTT", "IIIIIIIIII"), ("CC" + adapter + "AAAAA", "I" * 20)]
+    fastqs = [tmp_path / "R1.fastq.gz", tmp_path / "R2.fastq.gz"]
+    write_fastq(fastqs[0], r1)
+    write_fastq(fastqs[1], r2)
+    stats = str(tmp_path / "stats.json")
+
+    fastq_qc([str(path) for path in fastqs], stats_file=stats)
+    qc = load_stats(stats)["fastq_qc"]
+    assert qc["pairs"] == 4
+
+    read1 = qc["read1"]
+    assert read1["reads"] == 4 and read1["bases"] == 40
+    assert read1["mean_quality_per_cycle"][0] == 40
+    assert read1["mean_quality_per_cycle"][9] == pytest.approx(30.5)
+    assert read1["n_rate"] == 1 / 40
+    assert read1["base_composition_per_cycle"]["G"][0] == 0.5
+    assert read1["gc_distribution"] == {80: 2, 0: 1, 50: 1}
+    assert read1["adapter_rate"] == 0
+
+    read2 = qc["read2"]
+    assert read2["bases"] == 50
+    assert len(read2["mean_quality_per_cycle"]) == 20
+    assert read2["adapter_rate"] == 0.25
+    assert read2["adapter_position"] == {2: 1}
+
+
+
+def test_fastq_qc_interleaved_matches_paired(tmp_path):
+    reads = [("ACGTACGTAC", "IIIIIIIIII"), ("GGGGGTTTTT", "IIIII#####")] * 50
+    interleaved = tmp_path / "interleaved.fastq.gz"
+    write_fastq(interleaved, reads)
+    fastqs = [tmp_path / "R1.fastq.gz", tmp_path / "R2.fastq.gz"]
+    write_fastq(fastqs[0], reads[::2])
+    write_fastq(fastqs[1], reads[1::2])
+
+    fastq_qc([str(interleaved)], stats_file=str(tmp_path / "interleaved.json"), interleaved=True)
+    fastq_qc([str(path) for path in fastqs], stats_file=str(tmp_path / "paired.json"))
+    interleaved_qc = load_stats(str(tmp_path / "interleaved.json"))["fastq_qc"]
+    paired_qc = load_stats(str(tmp_path / "paired.json"))["fastq_qc"]
+    assert interleaved_qc == paired_qc
+    assert interleaved_qc["pairs"] == 50
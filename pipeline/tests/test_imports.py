@@ -0,0 +1,32 @@
+import subprocess
+import sys
+
+import pytest
+
+import pipeline
+
+
+
+HEAVY = ("boto3", "botocore", "requests", "scipy", "matplotlib", "covermi")
+
+
+
+def loaded_modules(module):
+    code = f"import sys, {module}; print(' '.join(sys.modules))"
+    return set(subprocess.run([sys.executable, "-c", code], stdout=subprocess.PIPE, check=True, text=True).stdout.split())
+
+
+
+def test_console_scripts_do_not_import_heavy_dependencies():
+    for module in ("pipeline", "pipeline.filter_vcf", "pipeline.call_variants", "pipeline.annotate_panel", "pipeline.covermi_stats"):
+        assert not loaded_modules(module) & set(HEAVY), module
+
+
+
+def test_lazy_attributes():
+    from pipeline import s3_list
+    from pipeline.aws import s3_list as aws_s3_list
+    assert s3_list is aws_s3_list
+    assert "boto3_client" in dir(pipeline)
+    with pytest.raises(AttributeError):
+        pipeline.not_an_attribute
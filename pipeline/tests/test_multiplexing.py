@@ -0,0 +1,97 @@
+import csv
+
+from pipeline.multiplexing import multiplexing, collect_families, saturation, Targets
+from pipeline.utils import hash_rank
+
+
+
+HEADER = "@HD\tVN:1.6\tSO:coordinate\n@SQ\tSN:chr1\tLN:100000\n"
+
+
+
+def segment(qname, flag, pos, pnext, umi):
+    return "\t".join([qname, str(flag), "chr1", str(pos), "60", "100M", "=", str(pnext), "0", "A" * 100, "F" * 100, f"RX:Z:{umi}"]) + "\n"
+
+
+
+def write_sam(path, families):
+    """ families is a list of (position, umi, size) tuples.
+    """
+    rows = []
+    for pos, umi, size in families:
+        for i in range(size):
+            qname = f"{pos}_{umi}_{i}"
+            rows += [(pos, segment(qname, 0x63, pos, pos + 150, umi)),
+                     (pos + 150, segment(qname, 0x93, pos + 150, pos, umi))]
+    path.write_text(HEADER + "".join(row for pos, row in sorted(rows)))
+
+
+
+def test_hash_rank_is_deterministic_and_seeded():
+    assert hash_rank("read1") == hash_rank("read1")
+    assert hash_rank("read1") != hash_rank("read2")
+    assert hash_rank("read1", seed=1) != hash_rank("read1")
+    assert 0 <= hash_rank("read1") < 2 ** 64
+
+
+
+def test_targets_overlap_merges_intervals(tmp_path):
+    bed = tmp_path / "targets.bed"
+    bed.write_text("chr1\t100\t200\tA\nchr1\t150\t300\tB\nchr1\t400\t500\tC\n")
+    targets = Targets(str(bed))
+    assert targets.size == 300
+    assert targets.overlap("chr1", 0, 1000) == 300
+    assert targets.overlap("chr1", 250, 450) == 100
+    assert targets.overlap("chr1", 300, 400) == 0
+    assert targets.overlap("chr2", 0, 1000) == 0
+
+
+
+def test_families_group_by_location_and_umi(tmp_path):
+    sam = tmp_path / "sample.sam"
+    write_sam(sam, [(1000, "AAA", 3), (1000, "CCC", 1), (5000, "AAA", 2)])
+    bed = tmp_path / "targets.bed"
+    bed.write_text("chr1\t999\t1249\n")
+
+    ranks, family_ids, overlaps = collect_families(str(sam), umi="prism", targets=Targets(str(bed)))
+    assert len(ranks) == 6
+    assert sorted(list(family_ids).count(f) for f in set(family_ids)) == [1, 2, 3]
+    assert sorted(overlaps) == [0, 200, 200]
+
+    ranks, family_ids, overlaps = collect_families(str(sam))
+    assert len(set(family_ids)) == 2
+
+
+
+def test_saturation_levels_are_nested(tmp_path):
+    sam = tmp_path / "sample.sam"
+    write_sam(sam, [(1000 + i * 1000, "AAA", 1 + i % 5) for i in range(40)])
+    ranks, family_ids, overlaps = collect_families(str(sam))
+
+    metrics = list(saturation(ranks, family_ids, overlaps, [10, 20, 40, 80, 1000]))
+    assert [m["reads"] for m in metrics] == [10, 20, 40, 80, 120]
+    family_sizes = [m["mean_family_size"] for m in metrics]
+    assert family_sizes == sorted(family_sizes)
+    assert metrics[-1]["mean_family_size"] == 3
+    assert metrics[-1]["singleton_rate"] == 0.2
+    assert metrics[-1]["triplicate_plus_rate"] == 48 / 120
+    assert metrics[-1]["quadruplicate_plus_rate"] == 24 / 120
+
+
+
+def test_multiplexing_writes_curve(tmp_path):
+    sam = tmp_path / "sample.sam"
+    write_sam(sam, [(1000 + i * 1000, "AAA", 2) for i in range(10)])
+    panel = tmp_path / "panel"
+    panel.mkdir()
+    (panel / "targets.bed").write_text("chr1\t0\t20000\n")
+
+    multiplexing(str(sam), str(panel), 8, name="sample", umi="prism", min_family_size=2, output=str(tmp_path))
+    with open(tmp_path / "sample.multiplexing.tsv", "rt") as f_in:
+        rows = list(csv.reader(f_in))
+    assert rows[0] == ["sample", "reads", "mean_depth", "mean_family_size", "singleton_rate", "triplicate_plus_rate", "quadruplicate_plus_rate"]
+    assert [row[1] for row in rows[1:]] == ["8", "16", "20"]
+    assert float(rows[-1][2]) == 10 * 200 / 20000
+    assert float(rows[-1][3]) == 2
+    depths = [float(row[2]) for row in rows[1:]]
+    assert depths == sorted(depths)
@@ -0,0 +1,95 @@
+import os
+import gzip
+import struct
+import subprocess
+import zlib
+
+import pytest
+
+from pipeline import utils
+from pipeline.utils import open_fastqs, fastq_fifo, is_bgzf, available_threads, THREADS
+
+
+
+def bgzf_block(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    header = b"\x1f\x8b\x08\x04" + b"\x00" * 4 + b"\x00\xff" + struct.pack("<H", 6) + b"BC" + struct.pack("<HH", 2, len(deflated) + 25)
+    return header + deflated + struct.pack("<II", zlib.crc32(data), len(data))
+
+
+
+def write_bgzf(path, data, block_size=1000):
+    with open(path, "wb") as f_out:
+        for i in range(0, len(data), block_size):
+            f_out.write(bgzf_block(data[i:i + block_size]))
+        f_out.write(bgzf_block(b""))
+
+
+
+def fastq(start, stop):
+    return "".join(f"@read{i}\n{'ACGT' * 10}\n+\n{'F' * 40}\n" for i in range(start, stop)).encode()
+
+
+
+def test_open_fastqs_concatenates_lanes_of_any_compression(tmp_path):
+    lanes = [tmp_path / "L001.fastq.gz", tmp_path / "L002.fastq.gz", tmp_path / "L003.fastq", tmp_path / "L004.fastq.gz"]
+    data = [fastq(0, 1000), fastq(1000, 2000), fastq(2000, 2100), fastq(2100, 2200)]
+    write_bgzf(lanes[0], data[0])
+    lanes[1].write_bytes(gzip.compress(data[1]))
+    lanes[2].write_bytes(data[2])
+    # Multi member gzip, eg lanes concatenated with cat.
+    lanes[3].write_bytes(gzip.compress(data[3][:1000]) + gzip.compress(data[3][1000:]))
+
+    assert is_bgzf(lanes[0]) and not is_bgzf(lanes[1])
+    with open_fastqs([str(lane) for lane in lanes], "rb", threads=4) as f_in:
+        assert f_in.read() == b"".join(data)
+    with open_fastqs([str(lane) for lane in lanes], threads=2) as f_in:
+        lines = f_in.readlines()
+    assert len(lines) == 2200 * 4
+    assert lines[-4] == "@read2199\n"
+
+
+
+def test_fastq_fifo(tmp_path):
+    lanes = [tmp_path / "L001.fastq.gz", tmp_path / "L002.fastq.gz"]
+    write_bgzf(lanes[0], fastq(0, 500))
+    lanes[1].write_bytes(gzip.compress(fastq(500, 600)))
+    with fastq_fifo([str(lane) for lane in lanes]) as fifo:
+        output = subprocess.run(["cat", fifo], stdout=subprocess.PIPE, check=True).stdout
+    assert output == fastq(0, 600)
+
+    # The pipe is cleaned up even if it is never read.
+    with fastq_fifo([str(lane) for lane in lanes]) as fifo:
+        pass
+
+
+
+def test_truncated_gzip_is_an_error(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "EXTERNAL_GUNZIP", ())
+    lane = tmp_path / "L001.fastq.gz"
+    lane.write_bytes(gzip.compress(fastq(0, 100))[:-100])
+    with pytest.raises(OSError, match="truncated"):
+        with open_fastqs([str(lane)], "rb") as f_in:
+            f_in.read()
+
+
+
+def test_fastq_fifo_raises_if_a_lane_is_corrupt(tmp_path):
+    lanes = [tmp_path / "L001.fastq.gz", tmp_path / "L002.fastq.gz"]
+    write_bgzf(lanes[0], fastq(0, 500))
+    corrupt = bytearray(gzip.compress(fastq(500, 600)))
+    corrupt[100:200] = b"\xff" * 100
+    lanes[1].write_bytes(bytes(corrupt))
+    with pytest.raises(OSError):
+        with fastq_fifo([str(lane) for lane in lanes]) as fifo:
+            # The reader sees a truncated stream and succeeds.
+            subprocess.run(["cat", fifo], stdout=subprocess.PIPE, check=True)
+
+
+
+def test_available_threads(monkeypatch):
+    monkeypatch.delenv(THREADS, raising=False)
+    assert available_threads() == os.cpu_count()
+    monkeypatch.setenv(THREADS, "3")
+    assert available_threads() == 3
@@ -0,0 +1,41 @@
+import json
+import subprocess
+
+import pytest
+
+from pipeline.utils import Pipe, pipe
+from pipeline.stats import load_stats
+
+
+
+def test_pipe_records_each_invocation(tmp_path):
+    log = str(tmp_path / "sample.pipe.jsonl")
+    stats = str(tmp_path / "sample.stats.json")
+    source = tmp_path / "input.txt"
+    source.write_text("x" * 1000)
+    destination = str(tmp_path / "output.txt")
+
+    run = Pipe(log=log, stats=stats)
+    run(["cp", str(source), destination])
+    run(["cp", str(source), destination])
+    with pytest.raises(SystemExit):
+        run(["false"])
+
+    with open(log, "rt") as f_in:
+        steps = [json.loads(line) for line in f_in]
+    assert [step["command"] for step in steps] == ["cp", "cp", "false"]
+    assert steps[0]["inputs"] == {str(source): 1000}
+    assert steps[0]["outputs"] == {destination: 1000}
+    assert steps[2]["exit_status"] == 1
+    assert all(step["max_rss"] > 0 and step["wall"] >= 0 for step in steps)
+    assert "pipeline_steps" not in load_stats(stats)
+    run.save()
+    assert load_stats(stats)["pipeline_steps"] == steps
+    assert "cp" in run.durations
+
+
+
+def test_pipe_captures_output():
+    completedprocess = pipe(["sh", "-c", "echo out; echo err >&2"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert completedprocess.stdout == b"out\n"
+    assert completedprocess.stderr == b"err\n"
@@ -0,0 +1,27 @@
+import sys
+import time
+import subprocess
+
+from pipeline.support.profile import Profiler
+
+
+
+MB = 1024 * 1024
+
+CHILD = "import os, time; f = open('out.bin', 'wb'); f.write(b'x' * 8 * 2 ** 20); f.flush(); os.fsync(f.fileno()); time.sleep(1)"
+
+
+
+def test_profiler_does_not_count_reaped_children_twice(tmp_path):
+    parent = f"import subprocess, sys, time; subprocess.run([sys.executable, '-c', {CHILD!r}]); time.sleep(1)"
+    process = subprocess.Popen([sys.executable, "-c", parent], cwd=tmp_path)
+    profiler = Profiler(process.pid)
+    samples = []
+    while process.poll() is None:
+        samples.append(profiler.sample())
+        time.sleep(0.2)
+
+    child = [row for usage in samples for row in usage.values() if row["name"] != "root"]
+    assert child and max(row["disk"] for row in child) >= 8 * MB
+    # The parent only reaps the child, it does not inherit its io.
+    assert all(usage[process.pid]["write"] < MB for usage in samples if process.pid in usage)
@@ -0,0 +1,162 @@
+import os
+import sys
+import json
+import time
+import signal
+import subprocess
+import threading
+from types import SimpleNamespace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import pipeline
+from pipeline import aws
+from pipeline.support.sqs_dequeue import SpotMonitor, requeue
+
+
+
+class MetadataHandler(BaseHTTPRequestHandler):
+    """ Minimal stand-in for the ec2 instance metadata service.
+    """
+    action = {}
+
+    def do_PUT(self):
+        self.reply(200, "token" if self.path == "/latest/api/token" else "")
+
+    def do_GET(self):
+        if self.headers.get("X-aws-ec2-metadata-token") != "token":
+            self.reply(401, "")
+        elif self.path == "/latest/meta-data/spot/instance-action" and self.action:
+            self.reply(200, self.action if isinstance(self.action, str) else json.dumps(self.action))
+        else:
+            self.reply(404, "")
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+
+@pytest.fixture
+def metadata(monkeypatch):
+    MetadataHandler.action = {}
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MetadataHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(aws, "METADATA_URL", f"http://127.0.0.1:{server.server_port}/latest")
+    yield MetadataHandler
+    server.shutdown()
+    server.server_close()
+
+
+
+def test_spot_interuption(metadata):
+    assert aws.spot_interuption() == {}
+    metadata.action = {"action": "terminate", "time": "2017-09-18T08:22:00Z"}
+    assert aws.spot_interuption() == metadata.action
+
+
+
+def test_spot_monitor(metadata):
+    monitor = SpotMonitor(interval=0.1)
+    monitor.start()
+    assert not monitor.interrupted.wait(0.5)
+    # A malformed response does not kill the monitor.
+    metadata.action = "<html>"
+    assert not monitor.interrupted.wait(0.5)
+    assert monitor.is_alive()
+    metadata.action = {"action": "stop", "time": "2017-09-18T08:22:00Z"}
+    assert monitor.interrupted.wait(5)
+    assert monitor.action["action"] == "stop"
+
+
+
+class FakeSqs(object):
+    exceptions = SimpleNamespace(QueueDoesNotExist=type("QueueDoesNotExist", (Exception,), {}))
+
+    def __init__(self):
+        self.deleted = []
+        self.requeued = []
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        self.deleted.append(ReceiptHandle)
+
+    def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout):
+        assert VisibilityTimeout == 0
+        self.requeued.append(ReceiptHandle)
+
+
+
+def test_requeue_deletes_only_successful_jobs():
+    commands = {"succeeded": ["true"],
+                "failed": ["false"],
+                "stopped": ["sleep", "30"],
+                "ignores_sigterm": ["sh", "-c", "trap '' TERM; sleep 30"]}
+    running = [SimpleNamespace(receipt_handle=handle, process=subprocess.Popen(command)) for handle, command in commands.items()]
+    running[0].process.wait()
+    running[1].process.wait()
+    time.sleep(0.2)
+
+    sqs = FakeSqs()
+    requeue(sqs, "url", running, grace=0.5)
+    assert sqs.deleted == ["succeeded"]
+    assert sqs.requeued == ["failed", "stopped", "ignores_sigterm"]
+    for job in running:
+        job.process.kill()
+        job.process.wait()
+
+
+
+# Runs run_forwarding_signals in its own python process, so that the test
+# session itself is never sent a signal. The shell writes the pid of its
+# background sleep after a delay, by which time the handler is installed.
+FORWARDER = """
+from pipeline.support.s3_wrap import run_forwarding_signals
+retcode = run_forwarding_signals(["sh", "-c", "sleep 30 & sleep 0.5; echo $! > {pidfile}; wait"])
+print(retcode)
+"""
+
+
+
+def alive(pid):
+    try:
+        with open(f"/proc/{pid}/stat", "rt") as f_in:
+            return f_in.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except OSError:
+        return False
+
+
+
+def test_sigterm_is_forwarded_to_process_group(tmp_path):
+    pidfile = tmp_path / "sleep.pid"
+    process = subprocess.Popen([sys.executable, "-c", FORWARDER.format(pidfile=pidfile)],
+                               stdout=subprocess.PIPE, text=True,
+                               env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(pipeline.__file__))))
+    try:
+        deadline = time.monotonic() + 10
+        while not pidfile.exists() or not pidfile.read_text().strip():
+            assert time.monotonic() < deadline and process.poll() is None
+            time.sleep(0.05)
+        grandchild = int(pidfile.read_text())
+        assert alive(grandchild)
+
+        process.send_signal(signal.SIGTERM)
+        stdout, _ = process.communicate(timeout=10)
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+    # The forwarder survives to report the failure of the process group.
+    assert process.returncode == 0
+    assert int(stdout) != 0
+    deadline = time.monotonic() + 5
+    while alive(grandchild) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not alive(grandchild)
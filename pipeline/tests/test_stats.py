@@ -0,0 +1,43 @@
+import os
+import json
+from multiprocessing import Pool
+
+from pipeline.stats import save_stats, load_stats, compact_stats, merge_stats
+
+
+
+def write_record(args):
+    path, i = args
+    save_stats(path, {f"tool{i}": {str(size): size for size in range(100)}})
+
+
+
+def test_concurrent_writers_are_not_lost(tmp_path):
+    path = str(tmp_path / "sample.stats.json")
+    with open(path, "wt") as f_out:
+        json.dump({"udini": 1}, f_out)
+
+    with Pool(8) as pool:
+        pool.map(write_record, [(path, i) for i in range(64)])
+
+    assert len(load_stats(path)) == 65
+    stats = compact_stats(path)
+    assert len(stats) == 65
+    assert stats["tool7"][42] == 42
+    assert os.listdir(tmp_path) == ["sample.stats.json"]
+    with open(path, "rt") as f_in:
+        assert len(json.load(f_in)) == 65
+
+
+
+def test_merge_stats(tmp_path):
+    path = str(tmp_path / "sample.stats.json")
+    source = tmp_path / "sample.udini.stats.json"
+    save_stats(path, {"fastq_qc": {"pairs": 4}})
+    with open(source, "wt") as f_out:
+        json.dump({"udini": {"1": 10}}, f_out)
+
+    merge_stats(path, str(source))
+    merge_stats(path, str(source))
+    assert not source.exists()
+    assert compact_stats(path) == {"fastq_qc": {"pairs": 4}, "udini": {1: 10}}
@@ -0,0 +1,112 @@
+import os
+
+import pytest
+
+moto = pytest.importorskip("moto")
+
+from pipeline import transfer, aws
+from pipeline.aws import s3_list, s3_exists
+
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with moto.mock_aws():
+        transfer.reset()
+        transfer.client("s3").create_bucket(Bucket="test-bucket")
+        yield "test-bucket"
+    transfer.reset()
+
+
+
+def test_client_is_cached(bucket):
+    assert transfer.client("s3") is transfer.client("s3")
+    assert transfer.client("s3") is not transfer.client("sqs")
+
+
+
+def test_parallel_upload_and_download(bucket, tmp_path, monkeypatch):
+    # Force multipart transfers without needing large files.
+    monkeypatch.setattr(transfer.TRANSFER_CONFIG, "multipart_threshold", 5 * transfer.MB)
+    monkeypatch.setattr(transfer.TRANSFER_CONFIG, "multipart_chunksize", 5 * transfer.MB)
+
+    sizes = [0, 1000, 11 * transfer.MB]
+    uploads = []
+    for i, size in enumerate(sizes):
+        fn = str(tmp_path / f"file{i}.bin")
+        with open(fn, "wb") as f_out:
+            f_out.write(os.urandom(size))
+        uploads.append((fn, bucket, f"prefix/file{i}.bin"))
+    transfer.upload_files(uploads)
+
+    assert len(s3_list(bucket, "prefix/")) == len(sizes)
+    assert s3_exists(bucket, "prefix/file2")
+
+    downloads = [(bucket, key, f"{fn}.downloaded") for fn, bucket, key in uploads]
+    transfer.download_files(downloads)
+    for (fn, _, _), (_, _, downloaded) in zip(uploads, downloads):
+        with open(fn, "rb") as f1, open(downloaded, "rb") as f2:
+            assert f1.read() == f2.read()
+
+
+
+def test_failed_transfer_raises(bucket, tmp_path):
+    fn = str(tmp_path / "file.bin")
+    with open(fn, "wb") as f_out:
+        f_out.write(b"data")
+    with pytest.raises(Exception):
+        transfer.upload_files([(fn, bucket, "ok.bin"), (fn, "no-such-bucket", "missing.bin")])
+
+
+
+def test_s3_open_streams_in_parts(bucket, monkeypatch):
+    monkeypatch.setattr(aws, "PART_SIZE", 5 * transfer.MB)
+    monkeypatch.setattr(aws, "READAHEAD", 1 * transfer.MB)
+    data = os.urandom(12 * transfer.MB)
+    with aws.s3_open(bucket, "big.bin", "wb") as f_out:
+        for i in range(0, len(data), 100000):
+            f_out.write(data[i:i + 100000])
+    response = transfer.client("s3").head_object(Bucket=bucket, Key="big.bin")
+    assert response["ContentLength"] == len(data)
+    assert response["ETag"].endswith('-3"')
+
+    with aws.s3_open(bucket, "big.bin", "rb") as f_in:
+        assert f_in.read(1000) == data[:1000]
+        f_in.seek(7 * transfer.MB)
+        assert f_in.read(2 * transfer.MB) == data[7 * transfer.MB:9 * transfer.MB]
+        f_in.seek(-10, os.SEEK_END)
+        assert f_in.read() == data[-10:]
+
+
+
+def test_s3_open_gzip_text(bucket):
+    lines = [f"line {i}\n" for i in range(10000)]
+    with aws.s3_open(bucket, "reads.fastq.gz", "wt") as f_out:
+        f_out.writelines(lines)
+    body = transfer.client("s3").get_object(Bucket=bucket, Key="reads.fastq.gz")["Body"].read()
+    assert body[:2] == b"\x1f\x8b"
+    with aws.s3_open(bucket, "reads.fastq.gz", "rt") as f_in:
+        assert list(f_in) == lines
+
+
+
+def test_s3_open_aborts_on_error(bucket):
+    with pytest.raises(RuntimeError):
+        with aws.s3_open(bucket, "partial.txt", "wt") as f_out:
+            f_out.write("incomplete")
+            raise RuntimeError
+    assert not s3_exists(bucket, "partial.txt")
+
+
+
+def test_partitioned_listing(bucket):
+    s3 = transfer.client("s3")
+    keys = ["samples/top.fastq.gz"] + [f"samples/run{i}/sample{j}/reads.fastq.gz" for i in range(5) for j in range(3)]
+    for key in keys + ["samples/run0/sample0/reads.bam"]:
+        s3.put_object(Bucket=bucket, Key=key, Body=b"")
+    listing = s3_list(bucket, "samples/", extension=".fastq.gz", threads=4)
+    assert sorted(listing) == sorted(keys)
+    assert listing == s3_list(bucket, "samples/", extension=".fastq.gz")
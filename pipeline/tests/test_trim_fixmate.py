@@ -0,0 +1,75 @@
+from pipeline.trim_fixmate import trim_fixmate
+from pipeline.stats import load_stats
+
+
+
+HEADER = "@HD\tVN:1.6\tSO:queryname\n@SQ\tSN:chr1\tLN:100000\n@SQ\tSN:chr2\tLN:100000\n"
+
+SEQ = "ACGTTGCAAC" * 5
+
+
+
+def segment(qname, flag, rname, pos, cigar, rnext, pnext, tlen, seq=SEQ, tags=("RX:Z:AAA-CCC",)):
+    return "\t".join([qname, str(flag), rname, str(pos), "60", cigar, rnext, str(pnext), str(tlen), seq, "F" * len(seq)] + list(tags)) + "\n"
+
+
+
+def run(tmp_path, rows, **kwargs):
+    sam = tmp_path / "input.sam"
+    sam.write_text(HEADER + "".join(rows))
+    output = tmp_path / "output.sam"
+    stats = str(tmp_path / "stats.json")
+    trim_fixmate(str(sam), output_file=str(output), stats_file=stats, **kwargs)
+    lines = output.read_text().splitlines()
+    assert "\n".join(lines[:3]) + "\n" == HEADER
+    return [line.split("\t") for line in lines[3:]], stats
+
+
+
+def test_readthrough_is_trimmed_and_mates_fixed(tmp_path):
+    # A 40bp fragment at chr1:100-139 sequenced with 50bp reads so each
+    # read runs 10 bases past the start of its mate. ref[i] is at 90 + i.
+    ref = "GATTACAGGCCTGAACTTGGTCAGTACCGATGGAACTTCAGGATCCATAGGCTAACGTCA"
+    read2 = ref[:50]
+    rows = [segment("frag", 0x63, "chr1", 100, "50M", "=", 90, 50, seq=ref[10:60]),
+            segment("frag", 0x93, "chr1", 90, "50M", "=", 100, -50, seq=read2[:30] + "N" + read2[31:])]
+    segments, stats = run(tmp_path, rows)
+    read1, read2 = segments
+    assert read1[3:9] == ["100", "60", "40M", "=", "100", "40"]
+    assert read2[3:9] == ["100", "60", "40M", "=", "100", "-40"]
+    assert len(read1[9]) == len(read1[10]) == len(read2[9]) == 40
+    assert read1[11:] == ["RX:Z:AAA-CCC", "MC:Z:40M"]
+    assert read1[9] == read2[9] == ref[10:30] + "N" + ref[31:50]
+    assert load_stats(stats)["sequencing_error_rate"] == 1 / 40
+
+
+
+def test_mate_information_is_recomputed(tmp_path):
+    rows = [segment("pair", 0x63, "chr1", 1000, "50M", "=", 1, 0, tags=("MC:Z:10M", "RX:Z:AAA-CCC")),
+            segment("pair", 0x93, "chr1", 1200, "50M", "=", 1, 0),
+            segment("pair", 0x843, "chr2", 5000, "30S20M", "=", 1, 0),
+            segment("unmapped", 0x49, "chr1", 2000, "50M", "*", 0, 0),
+            segment("unmapped", 0x85, "*", 0, "*", "*", 0, 0)]
+    segments, stats = run(tmp_path, rows, trim=False)
+    pair1, pair2, supplementary, mapped, unmapped = segments
+    assert pair1[1:9] == ["99", "chr1", "1000", "60", "50M", "=", "1200", "250"]
+    assert pair1[11:] == ["RX:Z:AAA-CCC", "MC:Z:50M"]
+    assert pair2[1:9] == ["147", "chr1", "1200", "60", "50M", "=", "1000", "-250"]
+    assert supplementary[1:9] == [str(0x841 | 0x20), "chr2", "5000", "60", "30S20M", "chr1", "1200", "0"]
+    assert mapped[1:9] == [str(0x49), "chr1", "2000", "60", "50M", "=", "2000", "0"]
+    assert mapped[11:] == ["RX:Z:AAA-CCC"]
+    assert unmapped[1:9] == [str(0x85), "chr1", "2000", "60", "*", "=", "2000", "0"]
+    assert unmapped[11:] == ["RX:Z:AAA-CCC", "MC:Z:50M"]
+
+
+
+def test_read_group_is_replaced(tmp_path):
+    sam = tmp_path / "input.sam"
+    sam.write_text(HEADER + "@RG\tID:old\tSM:old\n@PG\tID:bwa\tPN:bwa\n" +
+                   segment("pair", 0x63, "chr1", 1000, "50M", "=", 1200, 250, tags=("RG:Z:old", "RX:Z:AAA-CCC")) +
+                   segment("pair", 0x93, "chr1", 1200, "50M", "=", 1000, -250))
+    output = tmp_path / "output.sam"
+    trim_fixmate(str(sam), output_file=str(output), stats_file=str(tmp_path / "stats.json"), read_group="sample")
+    lines = output.read_text().splitlines()
+    assert lines[3:5] == ["@PG\tID:bwa\tPN:bwa", "@RG\tID:1\tLB:lb\tPL:ILLUMINA\tPU:pu\tSM:sample"]
+    assert [line.split("\t")[11:] for line in lines[5:]] == [["RX:Z:AAA-CCC", "MC:Z:50M", "RG:Z:1"]] * 2
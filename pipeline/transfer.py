@@ -0,0 +1,115 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+
+
+__all__ = ["client",
+           "upload_file",
+           "download_file",
+           "upload_files",
+           "download_files",
+           "TRANSFER_CONFIG"]
+
+
+MB = 1024 * 1024
+
+# Objects larger than the threshold are transferred as multipart uploads or
+# ranged gets of MULTIPART_CHUNKSIZE, MAX_CONCURRENCY parts at a time per
+# object. The connection pool must be large enough to support several
+# objects being transferred at once, each with MAX_CONCURRENCY parts.
+MULTIPART_THRESHOLD = 64 * MB
+MULTIPART_CHUNKSIZE = 64 * MB
+MAX_CONCURRENCY = 10
+MAX_POOL_CONNECTIONS = 64
+FILE_THREADS = 4
+
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=MULTIPART_THRESHOLD,
+                                 multipart_chunksize=MULTIPART_CHUNKSIZE,
+                                 max_concurrency=MAX_CONCURRENCY,
+                                 use_threads=True)
+
+_lock = threading.Lock()
+_pid = None
+_session = None
+_clients = {}
+
+
+
+def reset():
+    """ Discard the cached session and clients. Only needed if the
+        credentials or endpoint have changed, eg between tests.
+    """
+    global _pid, _session
+    with _lock:
+        _pid = None
+        _session = None
+        _clients.clear()
+
+
+
+def client(service="s3", region_name=None):
+    """ Return a client for service that is shared by all callers within
+        this process. boto3 clients, unlike sessions, are thread safe and
+        reusing one avoids the cost of repeatedly loading the service model
+        and establishing new connections. Sessions and clients are not safe
+        to share across a fork therefore the cache is discarded in a child
+        process.
+    """
+    global _pid, _session
+    with _lock:
+        if _pid != os.getpid():
+            _pid = os.getpid()
+            _session = boto3.session.Session()
+            _clients.clear()
+
+        key = (service, region_name)
+        if key not in _clients:
+            config = Config(max_pool_connections=MAX_POOL_CONNECTIONS,
+                            retries={"max_attempts": 10, "mode": "adaptive"})
+            _clients[key] = _session.client(service, region_name=region_name, config=config)
+        return _clients[key]
+
+
+
+def upload_file(filename, bucket, key):
+    client("s3").upload_file(filename, bucket, key, Config=TRANSFER_CONFIG)
+
+
+
+def download_file(bucket, key, filename):
+    client("s3").download_file(bucket, key, filename, Config=TRANSFER_CONFIG)
+
+
+
+def _transfer_all(func, transfers, threads):
+    if not transfers:
+        return
+    with ThreadPoolExecutor(max_workers=min(threads, len(transfers))) as executor:
+        futures = [executor.submit(func, *transfer) for transfer in transfers]
+        # Wait for everything to finish before raising the first error so
+        # that no transfers are left running in the background.
+        errors = [future.exception() for future in futures]
+    for error in errors:
+        if error is not None:
+            raise error
+
+
+
+def upload_files(transfers, threads=FILE_THREADS):
+    """ Upload many files in parallel. transfers is a sequence of
+        (filename, bucket, key) tuples.
+    """
+    _transfer_all(upload_file, list(transfers), threads)
+
+
+
+def download_files(transfers, threads=FILE_THREADS):
+    """ Download many files in parallel. transfers is a sequence of
+        (bucket, key, filename) tuples.
+    """
+    _transfer_all(download_file, list(transfers), threads)
@@ -0,0 +1,349 @@
+import pdb
+import argparse
+import sys
+import os
+from itertools import chain
+
+from .utils import save_stats, string2cigar, cigar2string, CONSUMES_REF, CONSUMES_READ
+
+
+
+QNAME = 0
+FLAG = 1
+RNAME = 2
+POS = 3
+MAPQ = 4
+CIGAR = 5
+RNEXT = 6
+PNEXT = 7
+TLEN = 8
+SEQ = 9
+QUAL = 10
+TAGS = 11
+
+PAIRED = 0x1
+PROPER_PAIR = 0x2
+UNMAPPED = 0x4
+MATE_UNMAPPED = 0x8
+RC = 0x10
+MATE_RC = 0x20
+READ1 = 0x40
+READ2 = 0x80
+SECONDARY = 0X100
+FILTERED = 0x200
+SUPPPLEMENTARY = 0x800
+SEC_OR_SUP = SECONDARY | SUPPPLEMENTARY
+READX = READ1 | READ2
+
+L = 0
+R = 1
+
+RCOMPLEMENT = str.maketrans("ATGC", "TACG")
+
+# Read group fields as previously added by gatk AddOrReplaceReadGroups.
+READ_GROUP_ID = "1"
+READ_GROUP = "@RG\tID:{id}\tLB:lb\tPL:ILLUMINA\tPU:pu\tSM:{sample}\n"
+
+
+
+def cigar_len(cig, ops):
+    return sum(num for num, op in cig if op in ops)
+
+
+
+def ltrim(seg, bases):
+    pos = int(seg[POS])
+    cigar = []
+    for num, op in string2cigar(seg[CIGAR]):
+        if bases:
+            if op in CONSUMES_READ:
+                if num < bases:
+                    bases -= num
+                    if op in CONSUMES_REF:
+                        pos += num
+                else:
+                    if op in CONSUMES_REF:
+                        pos += bases
+                    num -= bases
+                    bases = 0
+
+            elif op in CONSUMES_REF:
+                pos += num
+
+        if num and not bases:
+            cigar.append((num, op))
+    seg[CIGAR] = cigar2string(cigar)
+    seg[POS] = str(pos)
+
+
+
+def rtrim(seg, bases):
+    cigar = string2cigar(seg[CIGAR])
+    while bases and cigar:
+        num, op = cigar.pop()
+        if op in CONSUMES_READ:
+            if num <= bases:
+                bases -= num
+            else:
+                cigar.append((num - bases, op))
+                bases = 0
+    seg[CIGAR] = cigar2string(cigar)
+
+
+
+def trim_overlap(segments, primary):
+    """ Trim the overhanging ends of a pair of primary segments that read
+        through each other and reconcile the bases where they overlap. A
+        mismatched base is replaced by the higher quality call if it is
+        clearly better, otherwise both are set to N. Non-primary segments
+        are trimmed to match their primary segment. Flags must already be
+        integers. Returns the number of overlapping bases and mismatches.
+    """
+    # Unmapped, mappend to a different reference or pointing in the same direction
+    # therefore cannot be a concordant pair
+    if primary[L][FLAG] & UNMAPPED or primary[R][FLAG] & UNMAPPED or primary[L][RNAME] != primary[R][RNAME] or primary[L][FLAG] & RC == primary[R][FLAG] & RC:
+        return 0, 0
+
+    # Ensure the left segment has the lowest ref pos
+    lref = int(primary[L][POS])
+    rref = int(primary[R][POS])
+    if rref < lref:
+        primary = primary[::-1]
+        lref, rref = rref, lref
+
+    lref -= 1
+    lread = -1
+    for num, op in string2cigar(primary[L][CIGAR]):
+        if op in CONSUMES_REF:
+            if lref + num > rref:
+                num = rref - lref
+            lref += num
+        if op in CONSUMES_READ:
+            lread += num
+
+        if lref == rref:
+            for num, op in string2cigar(primary[R][CIGAR]):
+                if op in CONSUMES_REF:
+                    break
+                if op in CONSUMES_READ:
+                    lread -= num
+            break
+
+    # Segments don't touch therefore return
+    else:
+        return 0, 0
+
+    # Now ensure the left segment is correctly orientated
+    if primary[L][FLAG] & RC:
+        primary = primary[::-1]
+        lread = -lread
+
+    # lread is now the position of the base in the left read that
+    # overlaps the first base in the right read. If lread is less
+    # than zero then there is readthrough into the opposite umi
+
+    lseq = list(primary[L][SEQ])
+    lqual = list(primary[L][QUAL])
+    rseq = list(primary[R][SEQ])
+    rqual = list(primary[R][QUAL])
+
+    # Overhang at beginning of right read
+    roverhang = max(-lread, 0)
+    if roverhang:
+        rseq = rseq[roverhang:]
+        rqual = rqual[roverhang:]
+
+    # Overhang at end of left read
+    loverhang = max(len(primary[L][SEQ]) - lread - len(primary[R][SEQ]), 0)
+    if loverhang:
+        lseq = lseq[:-loverhang]
+        lqual = lqual[:-loverhang]
+
+    mismatches = 0
+    offset = max(lread, 0)
+    overlap = len(lseq) - offset
+    for i in range(0, overlap):
+        if lseq[i+offset] != rseq[i]:
+            mismatches += 1
+            if ord(lqual[i+offset]) > ord(rqual[i]) + 10:
+                rseq[i] = lseq[i+offset]
+                rqual[i] = lqual[i+offset]
+            elif ord(rqual[i]) > ord(lqual[i+offset]) + 10:
+                lseq[i+offset] = rseq[i]
+                lqual[i+offset] = rqual[i]
+            else:
+                rseq[i] = "N"
+                rqual[i] = "!"
+                lseq[i+offset] = "N"
+                lqual[i+offset] = "!"
+
+    seq = (["".join(lseq)], ["".join(rseq)])
+    qual = (["".join(lqual)], ["".join(rqual)])
+    lbases = ((0, loverhang), (roverhang, 0))
+    rbases = ((loverhang, 0), (0, roverhang))
+
+    for segment in segments:
+        # r1r2 = L if corresponds to left primary segment and R if corresponds to right primary segment
+        r1r2 = segment[FLAG] & READX == primary[R][FLAG] & READX
+        # rc = 0 if orientated the same way as the corresponding primary segment and 1 if reversed
+        rc = segment[FLAG] & RC != primary[r1r2][FLAG] & RC
+
+        bases = lbases[r1r2][rc]
+        if bases:
+            ltrim(segment, bases)
+
+        else:
+            bases = rbases[r1r2][rc]
+            if bases:
+                rtrim(segment, bases)
+
+        if len(seq[r1r2]) == 1:
+            seq[r1r2].append(seq[r1r2][0][::-1].translate(RCOMPLEMENT))
+            qual[r1r2].append(qual[r1r2][0][::-1])
+        segment[SEQ] = seq[r1r2][rc]
+        segment[QUAL] = qual[r1r2][rc]
+
+    return overlap, mismatches
+
+
+
+def template_length(segment, mate):
+    """ Observed template length of a pair of segments mapped to the same
+        reference, positive for the leftmost segment.
+    """
+    start = int(segment[POS])
+    end = start + cigar_len(string2cigar(segment[CIGAR]), CONSUMES_REF) - 1
+    mate_start = int(mate[POS])
+    mate_end = mate_start + cigar_len(string2cigar(mate[CIGAR]), CONSUMES_REF) - 1
+    tlen = max(end, mate_end) - min(start, mate_start) + 1
+    if (start, segment[FLAG] & RC, mate[FLAG] & READ1) < (mate_start, mate[FLAG] & RC, segment[FLAG] & READ1):
+        return tlen
+    return -tlen
+
+
+
+def fix_mates(segments, primary):
+    """ Recompute the mate fields (RNEXT, PNEXT, TLEN, the mate unmapped,
+        mate reverse and proper pair flags and the MC tag) of every segment
+        from the current positions of the primary segments, in the same way
+        as samtools fixmate. An unmapped primary segment is placed at the
+        position of its mapped mate. Non-primary segments take their mate
+        fields from the primary segment of the other read and a TLEN of 0.
+        Flags must already be integers.
+    """
+    for segment, mate in ((primary[L], primary[R]), (primary[R], primary[L])):
+        if segment[FLAG] & UNMAPPED and not mate[FLAG] & UNMAPPED:
+            segment[RNAME] = mate[RNAME]
+            segment[POS] = mate[POS]
+
+    mates = {primary[L][FLAG] & READX: primary[R], primary[R][FLAG] & READX: primary[L]}
+    for segment in segments:
+        try:
+            mate = mates[segment[FLAG] & READX]
+        except KeyError:
+            continue
+        flag = segment[FLAG] & ~(MATE_UNMAPPED | MATE_RC)
+        if mate[FLAG] & UNMAPPED:
+            flag |= MATE_UNMAPPED
+        if mate[FLAG] & RC:
+            flag |= MATE_RC
+        both_mapped = not (flag & UNMAPPED or flag & MATE_UNMAPPED)
+        if not both_mapped or segment[RNAME] != mate[RNAME]:
+            flag &= ~PROPER_PAIR
+        segment[FLAG] = flag
+
+        segment[RNEXT] = "=" if mate[RNAME] == segment[RNAME] else mate[RNAME]
+        segment[PNEXT] = mate[POS]
+        if both_mapped and segment[RNAME] == mate[RNAME] and not flag & SEC_OR_SUP:
+            segment[TLEN] = str(template_length(segment, mate))
+        else:
+            segment[TLEN] = "0"
+
+        tags = [tag for tag in segment[TAGS:] if not tag.startswith("MC:Z:")]
+        if not mate[FLAG] & UNMAPPED:
+            tags.append(f"MC:Z:{mate[CIGAR]}")
+        segment[TAGS:] = tags
+
+
+
+def trim_fixmate(input_sam, output_file="output.fixed.sam", stats_file="stats.json", trim=True, read_group=""):
+    """ Trim overlapping read pairs and fix their mate information in a
+        single pass over a sam file in which all the segments of each
+        fragment are adjacent, eg as output by ontarget, replacing a
+        coordinate sort, trim, name sort and samtools fixmate. The output
+        remains grouped by name. If read_group, the sample name, is given
+        then any existing read groups are replaced by a single @RG header
+        line and every record is tagged with it, as required by gatk.
+    """
+    stats = {"overlap": 0,
+             "mismatches": 0}
+    rg_tag = f"RG:Z:{READ_GROUP_ID}"
+
+    with open(input_sam, "rt") as f_in, open(output_file, "wt") as f_out:
+        current_qname = ""
+        read = []
+        header = True
+        for row in chain(f_in, [""]):
+            if row.startswith("@"):
+                if not (read_group and row.startswith("@RG\t")):
+                    f_out.write(row)
+                continue
+            if header:
+                if read_group:
+                    f_out.write(READ_GROUP.format(id=READ_GROUP_ID, sample=read_group))
+                header = False
+
+            segment = row.rstrip("\n").split("\t")
+            qname = segment[QNAME]
+            if qname != current_qname:
+                if read:
+                    primary = []
+                    for seg in read:
+                        seg[FLAG] = int(seg[FLAG])
+                        if not seg[FLAG] & SEC_OR_SUP:
+                            primary.append(seg)
+                    if len(primary) != 2:
+                        sys.exit(f"trim_fixmate: {current_qname} does not have two primary segments, " \
+                                 "sam file must be sorted by name")
+
+                    if trim:
+                        overlap, mismatches = trim_overlap(read, primary)
+                        stats["overlap"] += overlap
+                        stats["mismatches"] += mismatches
+                    fix_mates(read, primary)
+
+                    for seg in read:
+                        seg[FLAG] = str(seg[FLAG])
+                        if read_group:
+                            seg[TAGS:] = [tag for tag in seg[TAGS:] if not tag.startswith("RG:Z:")] + [rg_tag]
+                        f_out.write("\t".join(seg))
+                        f_out.write("\n")
+
+                current_qname = qname
+                read = []
+            read.append(segment)
+
+    if trim:
+        save_stats(stats_file, {"sequencing_error_rate": float(stats["mismatches"]) / stats["overlap"] if stats["overlap"] else 0.0})
+
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_sam', help="Input sam file, all segments of a fragment must be adjacent.")
+    parser.add_argument("-o", "--output", help="Output sam file.", dest="output_file", default=argparse.SUPPRESS)
+    parser.add_argument("-s", "--stats", help="Statistics file.", dest="stats_file", default=argparse.SUPPRESS)
+    parser.add_argument("-r", "--read-group", help="Sample name with which to add a read group to every record.", default=argparse.SUPPRESS)
+    parser.add_argument("-n", "--no-trim", help="Only fix mate information, do not trim overlapping reads.", dest="trim", action="store_const", const=False, default=argparse.SUPPRESS)
+    args = parser.parse_args()
+    try:
+        trim_fixmate(**vars(args))
+    except OSError as e:
+        # File input/output error. This is not an unexpected error so just
+        # print and exit rather than displaying a full stack trace.
+        sys.exit(str(e))
+
+
+
+if __name__ == "__main__":
+    main()
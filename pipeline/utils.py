@@ -6,18 +6,31 @@ import json
 import pdb
 import datetime
 import shlex
+import threading
+import io
+import zlib
+import queue
+import shutil
+import struct
+from contextlib import contextmanager
 from collections import defaultdict, Counter
-from collections.abc import Mapping
+from hashlib import blake2b
 from itertools import chain
 
+from .stats import save_stats, rekey
 
 
-__all__ = ["run", "pipe", "Pipe", "save_stats", "string2cigar", "cigar2string", "guess_sample_name", "nullcontext", "CONSUMES_REF", "CONSUMES_READ"]
+
+__all__ = ["run", "pipe", "Pipe", "save_stats", "string2cigar", "cigar2string", "guess_sample_name", "nullcontext", "hash_rank", "available_threads", "open_fastqs", "fastq_fifo", "CONSUMES_REF", "CONSUMES_READ"]
 
 
 CONSUMES_REF = "MDN=X"
 CONSUMES_READ = "MIS=X"
 
+# Set in the environment of each job by sqs_dequeue to the number of threads
+# it may use, so that concurrent jobs do not each use every cpu.
+THREADS = "PIPELINE_THREADS"
+
 
 
 class nullcontext(object):
@@ -84,33 +97,260 @@ def cigar2string(cig):
 
 
 
-def rekey(mapping):
-    """ Recursively convert all numeric text keys to integer keys. This will
-        enable correct ordering when re-written to file.
+def hash_rank(name, seed=0):
+    """ Deterministic pseudorandom rank in the range 0 to 2**64 - 1 of name,
+        eg a read name so that both segments of a pair share a rank. The
+        same name and seed always give the same rank, regardless of input
+        order, so subsamples of increasing size are nested.
+    """
+    return int.from_bytes(blake2b(name.encode(), digest_size=8, key=str(seed).encode()).digest(), "little")
+
+
+
+GZIP_MAGIC = b"\x1f\x8b"
+BGZF_BATCH = 64 # blocks, up to 4MB uncompressed, decompressed per task
+CHUNK_SIZE = 2 ** 20
+EXTERNAL_GUNZIP = ("igzip", "pigz")
+
+
+
+def is_bgzf(path):
+    """ True if path is block gzipped, ie has the BC extra subfield.
+    """
+    with open(path, "rb") as f_in:
+        header = f_in.read(18)
+    return len(header) == 18 and header[:2] == GZIP_MAGIC and bool(header[3] & 0x4) and header[12:14] == b"BC"
+
+
+
+def _bgzf_batches(f_in):
+    """ Yield lists of the compressed blocks of a bgzf file.
     """
-    new = {}
-    for k, v in mapping.items():
+    batch = []
+    while True:
+        header = f_in.read(12)
+        if not header:
+            break
+        if len(header) < 12 or header[:2] != GZIP_MAGIC:
+            raise OSError(f"Malformed bgzf block in {f_in.name}")
+        xlen = struct.unpack("<H", header[10:12])[0]
+        extra = f_in.read(xlen)
+        bsize = None
+        i = 0
+        while i + 4 <= len(extra):
+            slen = struct.unpack("<H", extra[i + 2:i + 4])[0]
+            if extra[i:i + 2] == b"BC":
+                bsize = struct.unpack("<H", extra[i + 4:i + 6])[0]
+            i += 4 + slen
+        if bsize is None:
+            raise OSError(f"Malformed bgzf block in {f_in.name}")
+        batch.append(header + extra + f_in.read(bsize + 1 - 12 - xlen))
+        if len(batch) == BGZF_BATCH:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+
+def _inflate_blocks(blocks):
+    return b"".join(zlib.decompress(block, 31) for block in blocks)
+
+
+
+def _inflate_bgzf(path, threads):
+    # zlib releases the gil therefore blocks are inflated in threads, in
+    # order and with a bounded number in flight.
+    from concurrent.futures import ThreadPoolExecutor
+    from collections import deque
+
+    with open(path, "rb") as f_in, ThreadPoolExecutor(threads) as executor:
+        futures = deque()
+        for batch in _bgzf_batches(f_in):
+            futures.append(executor.submit(_inflate_blocks, batch))
+            if len(futures) > threads * 2:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
+
+def _inflate_gzip(path, threads):
+    # An ordinary gzip stream can only be inflated serially, an external
+    # tool is used if available as it is faster and checks the crc in a
+    # separate thread, otherwise zlib, allowing for multiple members.
+    for tool in EXTERNAL_GUNZIP:
+        if shutil.which(tool):
+            args = [tool, "-d", "-c", path] + (["-p", str(threads)] if tool == "pigz" else [])
+            with subprocess.Popen(args, stdout=subprocess.PIPE) as process:
+                for chunk in iter(lambda: process.stdout.read(CHUNK_SIZE), b""):
+                    yield chunk
+            if process.returncode:
+                raise OSError(f"{tool} failed to decompress {path}")
+            return
+
+    with open(path, "rb") as f_in:
+        decompressor = zlib.decompressobj(31)
+        fed = False
+        for chunk in iter(lambda: f_in.read(CHUNK_SIZE), b""):
+            while chunk:
+                yield decompressor.decompress(chunk)
+                fed = True
+                if not decompressor.eof:
+                    break
+                chunk = decompressor.unused_data
+                decompressor = zlib.decompressobj(31)
+                fed = False
+        yield decompressor.flush()
+        if fed and not decompressor.eof:
+            raise OSError(f"{path} is truncated")
+
+
+
+def _decompressed(paths, threads):
+    for path in paths:
+        with open(path, "rb") as f_in:
+            gzipped = f_in.read(2) == GZIP_MAGIC
+        if not gzipped:
+            with open(path, "rb") as f_in:
+                yield from iter(lambda: f_in.read(CHUNK_SIZE), b"")
+        else:
+            try:
+                if is_bgzf(path):
+                    yield from _inflate_bgzf(path, threads)
+                else:
+                    yield from _inflate_gzip(path, threads)
+            except zlib.error as e:
+                raise OSError(f"{path} is corrupt: {e}")
+
+
+
+class _ChunkReader(io.RawIOBase):
+    """ Raw binary stream of the chunks produced by a generator that is
+        run in a background thread, so that decompression overlaps with
+        whatever the reader does with the data.
+    """
+    def __init__(self, chunks, maxsize=16):
+        self._queue = queue.Queue(maxsize)
+        self._buffer = memoryview(b"")
+        self._done = False
+        self._closing = threading.Event()
+        self._thread = threading.Thread(target=self._produce, args=(chunks,), daemon=True)
+        self._thread.start()
+
+    def _produce(self, chunks):
         try:
-            k = int(k)
-        except ValueError:
-            pass
-        if isinstance(v, Mapping):
-            v = rekey(v)
-        new[k] = v
-    return new
+            for chunk in chunks:
+                if chunk:
+                    while not self._closing.is_set():
+                        try:
+                            self._queue.put(chunk, timeout=0.1)
+                            break
+                        except queue.Full:
+                            pass
+                if self._closing.is_set():
+                    return
+            self._queue.put(None)
+        except BaseException as e:
+            self._queue.put(e)
+        finally:
+            chunks.close()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer and not self._done:
+            item = self._queue.get()
+            if item is None:
+                self._done = True
+            elif isinstance(item, BaseException):
+                self._done = True
+                raise item
+            else:
+                self._buffer = memoryview(item)
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def close(self):
+        self._closing.set()
+        super().close()
+
+
+
+def available_threads():
+    """ Number of threads to use if not specified, THREADS from the
+        environment if set otherwise all cpus.
+    """
+    try:
+        return max(1, int(os.environ[THREADS]))
+    except (KeyError, ValueError):
+        return os.cpu_count() or 1
+
 
 
+def open_fastqs(paths, mode="rt", threads=None):
+    """ Open one or more, optionally gzipped, files as a single stream of
+        their concatenated contents, eg the lanes of read 1 of a sample,
+        without decompressing them to disk. Bgzf files are decompressed
+        in parallel across threads, other gzip files with igzip or pigz if
+        installed. Decompression runs in a background thread. mode is rt
+        or rb.
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    threads = threads or available_threads()
+    stream = io.BufferedReader(_ChunkReader(_decompressed(list(paths), int(threads))), CHUNK_SIZE)
+    return stream if mode == "rb" else io.TextIOWrapper(stream)
+
+
+
+@contextmanager
+def fastq_fifo(paths, threads=None):
+    """ Yield the path of a named pipe from which the concatenated,
+        decompressed contents of paths can be read once, by a subprocess
+        that cannot itself read gzipped or multiple lanes. The pipe is
+        fed from a background thread and removed on exit. If the inputs
+        cannot be read the reader will see a truncated stream, therefore
+        the error is raised on exit.
+    """
+    import tempfile
+
+    directory = tempfile.mkdtemp(prefix="pipeline_fifo_")
+    fifo = os.path.join(directory, "reads.fastq")
+    os.mkfifo(fifo)
 
-def save_stats(path, update):
+    errors = []
+
+    def feed():
+        try:
+            with open_fastqs(paths, "rb", threads) as f_in, open(fifo, "wb") as f_out:
+                shutil.copyfileobj(f_in, f_out, CHUNK_SIZE)
+        except BrokenPipeError:
+            # The reader exited without consuming everything.
+            pass
+        except BaseException as e:
+            errors.append(e)
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
     try:
-        with open(path, "rt") as f_in:
-            stats = rekey(json.load(f_in))
-        stats.update(update)
-    except OSError:
-        stats = update
-    
-    with open(path, "wt") as f_out:
-        json.dump(stats, f_out, sort_keys=True, indent=4)
+        yield fifo
+    finally:
+        for attempt in range(100):
+            if not feeder.is_alive():
+                break
+            # Release the feeder if blocked opening or writing to the pipe.
+            try:
+                os.close(os.open(fifo, os.O_RDONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+            feeder.join(0.1)
+        shutil.rmtree(directory, ignore_errors=True)
+        if errors:
+            raise errors[0]
 
 
 
@@ -130,16 +370,60 @@ class Pipe(object):
         time taken to run each command. This is stored by command, ie if
         a single command is run several times the time will be recorded as
         the total time of all of the invocations.
+        In addition the wall time, user and system cpu time, peak memory,
+        sizes of input and output files and exit status of every
+        invocation are recorded. Each is appended as a json line to log,
+        if provided, as it completes. The full list is saved once under the
+        "pipeline_steps" key of the stats file, if provided, by save as
+        saving it after every step would write a quadratic amount of
+        records.
     """
-    def __init__(self):
+    def __init__(self, log=None, stats=None):
         self._durations = Counter()
+        self._lock = threading.Lock()
+        self.log = log
+        self.stats = stats
+        self.steps = []
         
-    def __call__(self, *args, **kwargs):
+    def __call__(self, args, exit_on_failure=True, **kwargs):
+        args = [str(arg) for arg in args]
+        inputs = file_sizes(args)
         start = datetime.datetime.now()
-        ret = pipe(*args, **kwargs)
+        completedprocess, rusage = _pipe(args, **kwargs)
         stop = datetime.datetime.now()
-        self._durations[args[0][0]] += (stop - start).total_seconds()
-        return ret
+        
+        outputs = file_sizes(args + [getattr(kwargs.get("stdout"), "name", "")])
+        outputs = {path: size for path, size in outputs.items() if inputs.get(path) != size}
+        inputs = {path: size for path, size in inputs.items() if path not in outputs}
+        step = {"command": args[0],
+                "args": args,
+                "start": start.isoformat(),
+                "wall": round((stop - start).total_seconds(), 3),
+                "user": round(rusage.ru_utime, 3),
+                "sys": round(rusage.ru_stime, 3),
+                # ru_maxrss is in kilobytes on linux
+                "max_rss": rusage.ru_maxrss * 1024,
+                "inputs": inputs,
+                "outputs": outputs,
+                "exit_status": completedprocess.returncode}
+        
+        with self._lock:
+            self._durations[args[0]] += step["wall"]
+            self.steps.append(step)
+            if self.log:
+                with open(self.log, "at") as f_out:
+                    f_out.write(json.dumps(step) + "\n")
+        
+        if exit_on_failure and completedprocess.returncode:
+            sys.exit(completedprocess.returncode)
+        return completedprocess
+    
+    def save(self):
+        """ Save all steps run so far to the stats file.
+        """
+        with self._lock:
+            if self.stats and self.steps:
+                save_stats(self.stats, {"pipeline_steps": self.steps})
     
     @property
     def durations(self):
@@ -149,21 +433,55 @@ class Pipe(object):
 
 
 
+def file_sizes(paths):
+    sizes = {}
+    for path in paths:
+        try:
+            if os.path.isfile(path):
+                sizes[path] = os.path.getsize(path)
+        except (OSError, ValueError):
+            pass
+    return sizes
+
+
+
 def pipe(args, exit_on_failure=True, **kwargs):
     """ Runs a main pipeline command. Output is bytes rather than string and
         is expected to be captured via stdout redirection or ignored if not
         needed. The command is echoed to stderr before the command is run.
     """
-    args = [str(arg) for arg in args]
-    print(" ".join(shlex.quote(arg) for arg in args), file=sys.stderr, flush=True)
-    completedprocess = subprocess.run(args, **kwargs)
-    sys.stderr.flush()
+    completedprocess, rusage = _pipe(args, **kwargs)
     if exit_on_failure and completedprocess.returncode:
         sys.exit(completedprocess.returncode)
     return completedprocess
 
 
 
+def _pipe(args, **kwargs):
+    """ Run args and return the CompletedProcess along with the resource
+        usage of the process and all of its waited for descendants. The
+        process is reaped directly with os.wait4 so any output captured
+        with subprocess.PIPE is read in separate threads rather than with
+        communicate.
+    """
+    args = [str(arg) for arg in args]
+    print(" ".join(shlex.quote(arg) for arg in args), file=sys.stderr, flush=True)
+    output = {}
+    with subprocess.Popen(args, **kwargs) as process:
+        readers = []
+        for name, stream in (("stdout", process.stdout), ("stderr", process.stderr)):
+            if stream is not None:
+                readers.append(threading.Thread(target=lambda name, stream: output.update({name: stream.read()}), args=(name, stream)))
+                readers[-1].start()
+        for reader in readers:
+            reader.join()
+        pid, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+    sys.stderr.flush()
+    return subprocess.CompletedProcess(args, process.returncode, output.get("stdout"), output.get("stderr")), rusage
+
+
+
 def run(args, exit_on_failure=True):
     """ Run a unix command as a subprocess. Stdout and stderr are captured as
         a string for review if needed. Not to be used for main pipeline
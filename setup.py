@@ -11,8 +11,9 @@ package =  {"name": "pipeline",
             "author": "Ed Wilson",
             "author_email": "edwardadrianwilson@yahoo.co.uk",
             "license": "MIT",
-            "packages": ["pipeline"],
-            "install_requires": ["covermi", "requests", "boto3"],
+            "packages": ["pipeline", "pipeline.support", "pipeline.benchmarks"],
+            "package_data": {"pipeline.benchmarks": ["baseline.json"]},
+            "install_requires": ["covermi", "requests", "boto3", "numpy"],
             "include_package_data": True,
             "zip_safe": True,
             "entry_points": { "console_scripts": ["cfPipeline=pipeline.cfPipeline:main",
@@ -22,6 +23,9 @@ package =  {"name": "pipeline",
                                                   "postprocess_mutect2_vcf=pipeline.postprocess_mutect2_vcf:main",
                                                   "postprocess_varscan_vcf=pipeline.postprocess_varscan_vcf:main",
                                                   "multiplexing=pipeline.multiplexing:main",
+                                                  "downsample=pipeline.downsample:main",
+                                                  "dedup_fastq=pipeline.dedup_fastq:main",
+                                                  "fastq_qc=pipeline.fastq_qc:main",
                                                   "mount_instance_storage=pipeline.aws:mount_instance_storage",
                                                   "bscopy=pipeline.support.bscopy:main",
                                                   "profile=pipeline.support.profile:main",
@@ -34,7 +38,13 @@ package =  {"name": "pipeline",
                                                   "ontarget=pipeline.ontarget:main",
                                                   "annotate_panel=pipeline.annotate_panel:main",
                                                   "size=pipeline.size:main",
-                                                  "breakpoint=pipeline.breakpoint:main"]},
+                                                  "report=pipeline.report:main",
+                                                  "compact_stats=pipeline.stats:main",
+                                                  "cohort=pipeline.cohort:main",
+                                                  "cnv=pipeline.cnv:main",
+                                                  "breakpoint=pipeline.breakpoint:main",
+                                                  "trim_fixmate=pipeline.trim_fixmate:main",
+                                                  "benchmark=pipeline.benchmarks.runner:main"]},
             }
 
 setup(**package)